@@ -8,7 +8,7 @@
 # TODO: Dont use query_models, nicer fixes for AlertTask
 
 from lib.alerttask import AlertTask
-from mozdef_util.query_models import SearchQuery, TermMatch, QueryStringMatch
+from mozdef_util.query_models import SearchQuery, TermMatch, QueryStringMatch, ExistsMatch
 from mozdef_util.utilities.dot_dict import DotDict
 from mozdef_util.utilities.logger import logger
 import hjson
@@ -17,6 +17,7 @@ import traceback
 import glob
 import os
 from os.path import basename
+from typing import Any, List, NamedTuple, Tuple
 
 # Minimum data needed for an alert (this is an example alert json)
 '''
@@ -63,6 +64,46 @@ from os.path import basename
 '''
 
 
+class Rule(NamedTuple):
+    '''A rule file parsed once and reused until its mtime changes.
+    '''
+
+    mtime: float
+    config: DotDict
+    # filters and search_string matchers
+    terms: List[Any]
+    # (additional_summary_field, its keys to walk down an event _source)
+    summary_fields: List[Tuple[str, Tuple[str, ...]]]
+
+
+# Rules parsed by this worker process, by rule file path
+RULES = {}
+
+
+def compile_terms(alert_config):
+    terms = []
+    for i in alert_config.filters:
+        terms.append(TermMatch(i[0], i[1]))
+    terms.append(QueryStringMatch(str(alert_config.search_string)))
+    return terms
+
+
+def compile_summary_fields(alert_config):
+    summary_fields = []
+    for additional_field in alert_config.get('additional_summary_fields') or []:
+        summary_fields.append((additional_field, tuple(additional_field.split('.'))))
+    return summary_fields
+
+
+def value_by_path(source, path):
+    '''Same as DotDict(source).get('.'.join(path)) without the DotDict'''
+    for key in path:
+        if not isinstance(source, dict) or key not in source:
+            return None
+        source = source[key]
+    return source
+
+
 class AlertGenericLoader(AlertTask):
     required_fields = [
         "search_string",
@@ -78,53 +119,132 @@ class AlertGenericLoader(AlertTask):
         "alert_url",
     ]
 
+    # Rule of each custom_alert_name, filled in by load_configs
+    rules = {}
+
     def validate_alert(self, alert):
         for key in self.required_fields:
             if key not in alert:
                 logger.error('Your alert does not have the required field {}'.format(key))
                 raise KeyError
 
+    def parse_rule(self, rule_file, mtime):
+        with open(rule_file) as fd:
+            cfg = DotDict(hjson.load(fd))
+        self.validate_alert(cfg)
+        # We set the alert name to the filename (excluding .json)
+        alert_name = basename(rule_file).replace('.json', '')
+        cfg['custom_alert_name'] = alert_name
+        return Rule(
+            mtime=mtime,
+            config=cfg,
+            terms=compile_terms(cfg),
+            summary_fields=compile_summary_fields(cfg),
+        )
+
     def load_configs(self):
-        '''Load all configured rules'''
+        '''Load all configured rules, only parsing the rule files
+           that changed since the last time'''
         self.configs = []
+        # rules by custom_alert_name
+        self.rules = {}
         rules_location = os.path.join(self.config.alert_data_location, "rules")
         files = glob.glob(rules_location + "/*.json")
         for f in files:
-            with open(f) as fd:
-                try:
-                    cfg = DotDict(hjson.load(fd))
-                    self.validate_alert(cfg)
-                    # We set the alert name to the filename (excluding .json)
-                    alert_name = basename(f).replace('.json', '')
-                    cfg['custom_alert_name'] = alert_name
-                    self.configs.append(cfg)
-                except Exception:
-                    logger.error("Loading rule file {} failed".format(f))
-
-    def process_alert(self, alert_config):
+            try:
+                mtime = os.path.getmtime(f)
+                rule = RULES.get(f)
+                if rule is None or rule.mtime != mtime:
+                    rule = self.parse_rule(f, mtime)
+                    RULES[f] = rule
+            except Exception:
+                RULES.pop(f, None)
+                logger.error("Loading rule file {} failed".format(f))
+                continue
+            self.configs.append(rule.config)
+            self.rules[rule.config['custom_alert_name']] = rule
+        # forget the rules whose file was removed
+        for f in set(RULES) - set(files):
+            del RULES[f]
+
+    def rule_alert_name(self, alert_config):
+        return "{0}:{1}".format(self.classname(), alert_config['custom_alert_name'])
+
+    def build_query(self, alert_config):
         # Set instance variable to populate event attributes about an alert
-        self.custom_alert_name = "{0}:{1}".format(self.classname(), alert_config['custom_alert_name'])
+        self.custom_alert_name = self.rule_alert_name(alert_config)
         search_query = SearchQuery(minutes=int(alert_config.time_window))
-        terms = []
-        for i in alert_config.filters:
-            terms.append(TermMatch(i[0], i[1]))
-        terms.append(QueryStringMatch(str(alert_config.search_string)))
-        search_query.add_must(terms)
+        rule = self.rules.get(alert_config['custom_alert_name'])
+        if rule is not None:
+            search_query.add_must(rule.terms)
+        else:
+            search_query.add_must(compile_terms(alert_config))
+        # searchEventsAggregated would add it, but we search before calling it
+        search_query.add_must(ExistsMatch(alert_config.aggregation_key))
         self.filtersManual(search_query)
-        self.searchEventsAggregated(alert_config.aggregation_key, samplesLimit=int(alert_config.num_samples))
+        return search_query
+
+    def process_alert(self, alert_config, search_query=None, esresults=None):
+        if search_query is None:
+            search_query = self.build_query(alert_config)
+        else:
+            self.custom_alert_name = self.rule_alert_name(alert_config)
+            self.main_query = search_query
+        self.searchEventsAggregated(alert_config.aggregation_key, samplesLimit=int(alert_config.num_samples), esresults=esresults)
         self.walkAggregations(threshold=int(alert_config.num_aggregations), config=alert_config)
 
+    def search_batch(self, configs):
+        '''Search for the events of every rule in configs
+           with a single multi search, yields (config, query, results)
+        '''
+        queries = []
+        for cfg in configs:
+            try:
+                queries.append((cfg, self.build_query(cfg)))
+            except Exception:
+                logger.exception("Building the query of rule file {} failed".format(cfg.__str__()))
+        try:
+            results = SearchQuery.execute_multiple(
+                self.es,
+                [search_query for cfg, search_query in queries],
+                indices=self.event_indices,
+                batch_size=max(len(queries), 1)
+            )
+        except Exception as e:
+            logger.error("Error while searching events in ES: {0}".format(e))
+            for cfg, search_query in queries:
+                self.discardWatermark(self.rule_alert_name(cfg))
+            return
+        for (cfg, search_query), esresults in zip(queries, results):
+            if esresults is None:
+                logger.error("Searching events for rule file {} failed".format(cfg.__str__()))
+                self.discardWatermark(self.rule_alert_name(cfg))
+                continue
+            yield cfg, search_query, esresults
+
     def main(self):
-        self.parse_config('generic_alert_loader.conf', ['alert_data_location'])
+        self.parse_config('generic_alert_loader.conf', ['alert_data_location', 'msearch_batch_size'])
 
         self.load_configs()
-        for cfg in self.configs:
-            try:
-                self.process_alert(cfg)
-            except Exception as err:
-                self.error_thrown = err
-                traceback.print_exc(file=sys.stdout)
-                logger.exception("Processing rule file {} failed".format(cfg.__str__()))
+        if self.aggregation_mode != "client":
+            for cfg in self.configs:
+                self.run_rule(cfg)
+            return
+
+        # search for all the rules with a handful of _msearch requests
+        # rather than one request per rule
+        batch_size = int(self.config.msearch_batch_size or 50)
+        for start in range(0, len(self.configs), batch_size):
+            for cfg, search_query, esresults in self.search_batch(self.configs[start:start + batch_size]):
+                self.run_rule(cfg, search_query, esresults)
+
+    def run_rule(self, cfg, search_query=None, esresults=None):
+        try:
+            self.process_alert(cfg, search_query, esresults)
+        except Exception as err:
+            self.error_thrown = err
+            traceback.print_exc(file=sys.stdout)
+            logger.exception("Processing rule file {} failed".format(cfg.__str__()))
 
     def onAggregation(self, aggreg):
         # aggreg['count']: number of items in the aggregation, ex: number of failed login attempts
@@ -153,19 +273,22 @@ class AlertGenericLoader(AlertTask):
         # If additional summary fields is defined, loop through each
         # and pull out the value from each event (if it exists)
         # and append key=value(s) to the summary field
-        if 'additional_summary_fields' in aggreg['config']:
-            for additional_field in aggreg['config']['additional_summary_fields']:
-                values_found = []
-                # If the field exists in each EVENT, include it in alert summary
-                for event in aggreg['events']:
-                    dot_event = DotDict(event['_source'])
-                    value = dot_event.get(additional_field)
-                    if value:
-                        values_found.append(value)
-                # Let's add the key=value(s) to summary
-                if len(values_found) != 0:
-                    values_str = '{}'.format(', '.join(set(values_found)))
-                    summary += " ({0}={1})".format(additional_field, values_str)
+        rule = self.rules.get(aggreg['config']['custom_alert_name'])
+        if rule is not None:
+            summary_fields = rule.summary_fields
+        else:
+            summary_fields = compile_summary_fields(aggreg['config'])
+        for additional_field, path in summary_fields:
+            values_found = []
+            # If the field exists in each EVENT, include it in alert summary
+            for event in aggreg['events']:
+                value = value_by_path(event['_source'], path)
+                if value:
+                    values_found.append(value)
+            # Let's add the key=value(s) to summary
+            if len(values_found) != 0:
+                values_str = '{}'.format(', '.join(set(values_found)))
+                summary += " ({0}={1})".format(additional_field, values_str)
 
         if hostnames:
             summary += ' [{}]'.format(', '.join(set(hostnames)))
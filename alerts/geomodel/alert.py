@@ -1,13 +1,20 @@
 from datetime import datetime
 import math
 from operator import attrgetter
-from typing import List, NamedTuple, Optional
+from typing import List, NamedTuple, Optional, Tuple
 
-from .locality import Coordinates, Locality, distance as geo_distance
+import numpy
+
+from .locality import Coordinates, Locality, distance as geo_distance,\
+    distances as geo_distances
 
 
 _AIR_TRAVEL_SPEED = 277.778  # m/s
 
+# Below this many pairs of localities, `alerts` checks each pair in pure
+# Python, building the numpy arrays costs more than it saves.
+_VECTORIZE_MIN_PAIRS = 32
+
 # TODO: Switch to dataclasses when we move to Python3.7+
 
 
@@ -60,6 +67,47 @@ def _travel_possible(loc1: Locality, loc2: Locality) -> bool:
     return (ttt - pad) <= seconds_between
 
 
+def travel_possible(
+        origins: List[Locality],
+        destinations: List[Locality]
+) -> numpy.ndarray:
+    '''Vectorized `_travel_possible` over each origin and the destination at
+    the same position, returning a mask of the possible ones.
+    '''
+
+    dist_traveled = 1000 * geo_distances(origins, destinations)  # Metres
+
+    seconds_between = numpy.abs(numpy.array([
+        (loc2.lastaction - loc1.lastaction).total_seconds()
+        for (loc1, loc2) in zip(origins, destinations)
+    ], dtype=float))
+
+    radii = numpy.minimum(
+        numpy.array([loc.radius for loc in origins], dtype=float),
+        numpy.array([loc.radius for loc in destinations], dtype=float))
+
+    # We pad the time with an hour to account for things like planes being
+    # slowed, network delays, etc.
+    ttt = (dist_traveled / _AIR_TRAVEL_SPEED)  # Time to travel the distance.
+    pad = numpy.ceil((1000 * radii) / _AIR_TRAVEL_SPEED)
+
+    return (ttt - pad) <= seconds_between
+
+
+def _hops_to_consider(
+        from_evts: List[Locality],
+        from_es: List[Locality]
+) -> List[Tuple[Locality, Locality]]:
+    relevant_es = sorted(from_es, key=attrgetter('lastaction'), reverse=True)[0:1]
+    all_evts = sorted(from_evts, key=attrgetter('lastaction'))
+    locs_to_consider = relevant_es + all_evts
+
+    return [
+        (locs_to_consider[i], locs_to_consider[i + 1])
+        for i in range(len(locs_to_consider) - 1)
+    ]
+
+
 def alert(
         username: str,
         from_evts: List[Locality],
@@ -70,28 +118,45 @@ def alert(
     this function returns `None`.
     '''
 
-    relevant_es = sorted(from_es, key=attrgetter('lastaction'), reverse=True)[0:1]
-    all_evts = sorted(from_evts, key=attrgetter('lastaction'))
-    locs_to_consider = relevant_es + all_evts
+    return alerts([(username, from_evts, from_es)])[0]
 
-    if len(locs_to_consider) < 2:
-        return None
 
-    pairs = [
-        (locs_to_consider[i], locs_to_consider[i + 1])
-        for i in range(len(locs_to_consider) - 1)
-    ]
+def alerts(
+        users: List[Tuple[str, List[Locality], List[Locality]]]
+) -> List[Optional[Alert]]:
+    '''Same as `alert` for a batch of `(username, from_evts, from_es)`,
+    checking the travel between the localities of all of the users in one
+    vectorized call.  Returns the `Alert` (or `None`) of each user in order.
+    '''
 
-    hops = [
-        Hop(_to_origin(o), _to_origin(d))
-        for (o, d) in pairs
-        if not _travel_possible(o, d)
+    pairs_per_user = [
+        _hops_to_consider(from_evts, from_es)
+        for (_, from_evts, from_es) in users
     ]
 
-    if len(hops) == 0:
-        return None
+    all_pairs = [pair for pairs in pairs_per_user for pair in pairs]
+
+    if len(all_pairs) < _VECTORIZE_MIN_PAIRS:
+        possible = [_travel_possible(o, d) for (o, d) in all_pairs]
+    else:
+        possible = travel_possible(
+            [o for (o, _) in all_pairs],
+            [d for (_, d) in all_pairs])
+
+    produced = []
+    offset = 0
+
+    for ((username, _, _), pairs) in zip(users, pairs_per_user):
+        hops = [
+            Hop(_to_origin(o), _to_origin(d))
+            for ((o, d), is_possible) in zip(pairs, possible[offset:offset + len(pairs)])
+            if not is_possible
+        ]
+        offset += len(pairs)
+
+        produced.append(Alert(username, hops) if len(hops) > 0 else None)
 
-    return Alert(username, hops)
+    return produced
 
 
 def summary(alert: Alert) -> str:
@@ -1,10 +1,15 @@
+from collections import defaultdict
+import hashlib
 import math
 from datetime import datetime, timedelta
-from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy
+import pytz
 
 from mozdef_util.elasticsearch_client import ElasticsearchClient as ESClient
 from mozdef_util.utilities.toUTC import toUTC
-from mozdef_util.query_models import SearchQuery, TermMatch
+from mozdef_util.query_models import SearchQuery, TermMatch, TermsMatch
 
 
 # Default radius (in Kilometres) that a locality should have.
@@ -12,6 +17,10 @@ _DEFAULT_RADIUS_KM = 50.0
 
 _EARTH_RADIUS = 6373.0  # km # approximate
 
+# Smallest side (in degrees) of the cells of a `LocalityGrid`, so that tiny
+# radii do not produce an unbounded number of cells to look through.
+_MIN_CELL_DEGREES = 0.01
+
 # TODO: Switch to dataclasses when we move to Python3.7+
 
 
@@ -48,20 +57,23 @@ class State(NamedTuple):
 class Entry(NamedTuple):
     '''A top-level container for locality state that will be inserted into
     ElasticSearch.
-    The `identifier` field here is the `_id` field of the ES document.  When
-    this id is `None`, a new document is inserted whereas when the id is known,
-    the existing document is updated.
+    The `identifier` field here is the `_id` field of the ES document, derived
+    from the username by `entry_id` so that journaling a user's state always
+    inserts or replaces the same document.
     '''
 
     identifier: Optional[str]
     state: State
+    # `_id`s of documents that held the state before it was given its
+    # derived identifier, deleted once it is journaled under that one.
+    legacy_identifiers: Tuple[str, ...] = ()
 
     def new(state: State) -> 'Entry':
-        '''Construct a new `Entry` that, when journaled, will result in a new
-        state entry being recorded rather than replacing an existing one.
+        '''Construct a new `Entry` that, when journaled, will result in the
+        user's state document being inserted or replaced.
         '''
 
-        return Entry('', state)
+        return Entry(entry_id(state.username), state)
 
 
 class Update(NamedTuple):
@@ -75,58 +87,196 @@ class Update(NamedTuple):
 
 
 JournalInterface = Callable[[Entry, str], None]
-QueryInterface = Callable[[SearchQuery, str], Optional[Entry]]
+QueryInterface = Callable[[str, str], Optional[Entry]]
+LoadManyInterface = Callable[[List[str], str], Dict[str, Entry]]
+JournalManyInterface = Callable[[List[Entry], str], None]
 
 
 def _dict_take(dictionary, keys):
     return {key: dictionary[key] for key in keys}
 
 
+def entry_id(username: str) -> str:
+    '''Produce the `_id` of the ES document holding a user's state, derived
+    from their username so that it can be fetched directly.
+    '''
+
+    return hashlib.sha256(username.encode('utf-8')).hexdigest()
+
+
+def _state_document(state: State) -> Dict[str, Any]:
+    document = dict(state._asdict())
+
+    # `Locality`s would otherwise be serialized as lists.
+    document['localities'] = [dict(loc._asdict()) for loc in state.localities]
+
+    return document
+
+
+def _last_action(state: State) -> datetime:
+    # toUTC(datetime.min) overflows when the local timezone is east of UTC.
+    return max(
+        [loc.lastaction for loc in state.localities],
+        default=datetime.min.replace(tzinfo=pytz.utc))
+
+
+def _entry_from_hit(hit: Dict[str, Any]) -> Optional[Entry]:
+    state_dict = dict(hit.get('_source', {}))
+
+    try:
+        state_dict['localities'] = [
+            # Convert dictionary localities into `Locality`s after
+            # parsing the `datetime` from `lastaction`.
+            Locality(**_dict_take({
+                k: v if k != 'lastaction' else toUTC(v)
+                for k, v in loc.items()
+            }, Locality._fields))
+            for loc in state_dict['localities']
+        ]
+
+        state = State(**_dict_take(state_dict, State._fields))
+
+        return Entry(hit['_id'], state)
+    except TypeError:
+        return None
+    except KeyError:
+        return None
+
+
 def wrap_journal(client: ESClient) -> JournalInterface:
     '''Wrap an `ElasticsearchClient` in a closure of type `JournalInterface`.
+    The document is inserted or replaced under the entry's identifier, or the
+    `entry_id` of its user when it has none.
     '''
 
     def wrapper(entry: Entry, esindex: str):
-        document = dict(entry.state._asdict())
-
         client.save_object(
             index=esindex,
-            body=document,
-            doc_id=entry.identifier)
+            body=_state_document(entry.state),
+            doc_id=entry.identifier or entry_id(entry.state.username))
 
     return wrapper
 
 
 def wrap_query(client: ESClient) -> QueryInterface:
-    '''Wrap an `ElasticsearchClient` in a closure of type `QueryInterface`.
+    '''Wrap an `ElasticsearchClient` in a closure of type `QueryInterface`,
+    retrieving an entry by its identifier with a real-time get.
     '''
 
-    def wrapper(query: SearchQuery, esindex: str) -> Optional[Entry]:
-        results = query.execute(client, indices=[esindex]).get('hits', [])
+    def wrapper(identifier: str, esindex: str) -> Optional[Entry]:
+        hit = client.get_objects_by_ids([identifier], esindex).get(identifier)
 
-        if len(results) == 0:
+        if hit is None:
             return None
 
-        state_dict = results[0].get('_source', {})
-        try:
-            state_dict['localities'] = [
-                # Convert dictionary localities into `Locality`s after
-                # parsing the `datetime` from `lastaction`.
-                Locality(**_dict_take({
-                    k: v if k != 'lastaction' else toUTC(v)
-                    for k, v in loc.items()
-                }, Locality._fields))
-                for loc in state_dict['localities']
-            ]
+        return _entry_from_hit(hit)
 
-            eid = results[0]['_id']
-            state = State(**_dict_take(state_dict, State._fields))
+    return wrapper
 
-            return Entry(eid, state)
-        except TypeError:
-            return None
-        except KeyError:
-            return None
+
+def wrap_load_many(client: ESClient) -> LoadManyInterface:
+    '''Wrap an `ElasticsearchClient` in a closure of type `LoadManyInterface`,
+    retrieving the entries of many users at once keyed by username.
+    '''
+
+    def wrapper(usernames: List[str], esindex: str) -> Dict[str, Entry]:
+        usernames_by_id = {entry_id(username): username for username in usernames}
+
+        entries = {}
+
+        for (eid, hit) in client.get_objects_by_ids(list(usernames_by_id), esindex).items():
+            entry = _entry_from_hit(hit)
+
+            if entry is not None:
+                entries[usernames_by_id[eid]] = entry
+
+        missing = [username for username in usernames if username not in entries]
+
+        if len(missing) == 0:
+            return entries
+
+        # States journaled before their id was derived from the username can
+        # only be found by searching.  They are given their derived id here so
+        # that they are moved to it the next time they are journaled, which
+        # deletes the documents found.  Overlapping runs may have recorded
+        # several of them for one user, in which case the most recently
+        # active one is kept.
+        search = SearchQuery()
+        search.add_must([
+            TermMatch('type_', 'locality'),
+            TermsMatch('username', missing)
+        ])
+
+        legacy: Dict[str, Entry] = {}
+        legacy_ids: Dict[str, List[str]] = defaultdict(list)
+
+        for hit in search.execute_iter(client, indices=[esindex]):
+            entry = _entry_from_hit(hit)
+
+            if entry is None:
+                continue
+
+            username = entry.state.username
+            known = legacy.get(username)
+            legacy_ids[username].append(entry.identifier)
+
+            if known is None or _last_action(entry.state) > _last_action(known.state):
+                legacy[username] = Entry(entry_id(username), entry.state)
+
+        for (username, entry) in legacy.items():
+            entries[username] = entry._replace(
+                legacy_identifiers=tuple(legacy_ids[username]))
+
+        return entries
+
+    return wrapper
+
+
+def wrap_journal_many(client: ESClient) -> JournalManyInterface:
+    '''Wrap an `ElasticsearchClient` in a closure of type
+    `JournalManyInterface`, recording many entries in one bulk request.
+    Entries without an identifier are recorded under their derived `entry_id`.
+    The legacy documents of the entries recorded are then deleted.
+    '''
+
+    def wrapper(entries: List[Entry], esindex: str):
+        if len(entries) == 0:
+            return
+
+        identifiers = [
+            entry.identifier or entry_id(entry.state.username)
+            for entry in entries
+        ]
+
+        report = client.save_documents([
+            {
+                '_index': esindex,
+                '_id': identifier,
+                '_source': _state_document(entry.state)
+            }
+            for (identifier, entry) in zip(identifiers, entries)
+        ])
+
+        if not any(entry.legacy_identifiers for entry in entries):
+            return
+
+        # Only once the state is safe under its derived identifier.
+        saved = set(document['_id'] for document in report['succeeded'])
+
+        deletions = [
+            {
+                '_op_type': 'delete',
+                '_index': esindex,
+                '_id': legacy_id
+            }
+            for (identifier, entry) in zip(identifiers, entries)
+            if identifier in saved
+            for legacy_id in entry.legacy_identifiers
+            if legacy_id != identifier
+        ]
+
+        if len(deletions) > 0:
+            client.save_documents(deletions)
 
     return wrapper
 
@@ -168,13 +318,95 @@ def find(qes: QueryInterface, username: str, index: str) -> Optional[Entry]:
     '''Retrieve the locality state for one user from ElasticSearch.
     '''
 
-    search = SearchQuery()
-    search.add_must([
-        TermMatch('type_', 'locality'),
-        TermMatch('username', username)
-    ])
+    return qes(entry_id(username), index)
+
+
+class LocalityGrid:
+    '''An index of the positions in a list of localities by the latitude and
+    longitude grid cell they fall in.  Cells are at least `radius_km` wide, so
+    the localities within `radius_km` of a point can only be found in the
+    cells neighbouring the one containing it.
+    '''
+
+    def __init__(self, localities: List[Locality], radius_km: float):
+        self.radius_km = radius_km
+        self.cell_degrees = min(180.0, max(
+            _MIN_CELL_DEGREES,
+            math.degrees(radius_km / _EARTH_RADIUS)))
+
+        # Columns evenly divide the 360 degrees of longitude so that
+        # neighbouring cells wrap around the antimeridian.
+        self.columns = max(1, int(360.0 // self.cell_degrees))
+        self.column_degrees = 360.0 / self.columns
+
+        self.cells: Dict[Tuple[int, int], List[int]] = defaultdict(list)
 
-    return qes(search, index)
+        for (index, loc) in enumerate(localities):
+            self.add(index, loc)
+
+    def _row(self, latitude: float) -> int:
+        return int(math.floor((latitude + 90.0) / self.cell_degrees))
+
+    def _column(self, longitude: float) -> int:
+        return int(math.floor((longitude + 180.0) / self.column_degrees))
+
+    def _cell(self, loc: Coordinates) -> Tuple[int, int]:
+        return (
+            self._row(loc.latitude),
+            self._column(loc.longitude) % self.columns)
+
+    def add(self, index: int, loc: Locality):
+        self.cells[self._cell(loc)].append(index)
+
+    def remove(self, index: int, loc: Locality):
+        self.cells[self._cell(loc)].remove(index)
+
+    def _columns_near(self, loc: Coordinates, angle: float) -> Iterable[int]:
+        latitude = math.radians(loc.latitude)
+
+        # Every longitude is within reach when the circle contains a pole.
+        if abs(latitude) + angle >= math.pi / 2:
+            return range(self.columns)
+
+        delta = math.degrees(math.asin(math.sin(angle) / math.cos(latitude)))
+
+        first = self._column(loc.longitude - delta)
+        last = self._column(loc.longitude + delta)
+
+        if last - first + 1 >= self.columns:
+            return range(self.columns)
+
+        return set(column % self.columns for column in range(first, last + 1))
+
+    def near(self, loc: Coordinates) -> List[int]:
+        '''Find the positions, in increasing order, of the localities that
+        might be within `radius_km` of `loc`.
+        '''
+
+        # The angle subtended by the radius, padded against rounding errors.
+        angle = self.radius_km / _EARTH_RADIUS + 1e-9
+        delta = math.degrees(angle)
+
+        rows = range(
+            self._row(loc.latitude - delta),
+            self._row(loc.latitude + delta) + 1)
+        columns = self._columns_near(loc, angle)
+
+        if len(rows) * len(columns) > len(self.cells):
+            # Fewer cells are occupied than there are cells to look at.
+            cells = [
+                cell
+                for cell in self.cells
+                if cell[0] in rows and cell[1] in columns
+            ]
+        else:
+            cells = [(row, column) for row in rows for column in columns]
+
+        return sorted(
+            index
+            for cell in cells
+            for index in self.cells.get(cell, [])
+        )
 
 
 def update(state: State, from_evt: State) -> Update:
@@ -184,36 +416,66 @@ def update(state: State, from_evt: State) -> Update:
 
     did_update = False
 
-    for loc1 in from_evt.localities:
-        did_find = False
+    # Two localities match when within the smaller of their radii, so only
+    # the cells neighbouring a new locality within the largest radius need
+    # to be looked at.
+    largest_radius = max(
+        [loc.radius for loc in state.localities + from_evt.localities],
+        default=_DEFAULT_RADIUS_KM)
+    grid = LocalityGrid(state.localities, largest_radius)
 
-        for index, loc2 in enumerate(state.localities):
-            # If we find that the new state's locality has been recorded
-            # for the user in question, we only want to update it if either
-            # their IP changed or the new time of activity is more recent.
-            coord1 = _coordinates(loc1)
-            coord2 = _coordinates(loc2)
-
-            if distance(coord1, coord2) <= min(loc1.radius, loc2.radius):
-                did_find = True
+    for loc1 in from_evt.localities:
+        # If we find that the new state's locality has been recorded
+        # for the user in question, we only want to update it if either
+        # their IP changed or the new time of activity is more recent.
+        index = _first_within_radius(loc1, state.localities, grid.near(loc1))
 
-                new_more_recent = loc1.lastaction > loc2.lastaction
-                new_ip = loc1.sourceipaddress != loc2.sourceipaddress
+        if index is None:
+            grid.add(len(state.localities), loc1)
+            state.localities.append(loc1)
+            did_update = True
+            continue
 
-                if new_more_recent or new_ip:
-                    state.localities[index] = loc1
-                    did_update = True
+        loc2 = state.localities[index]
 
-                # Stop looking for the locality in the records pulled from ES.
-                break
+        new_more_recent = loc1.lastaction > loc2.lastaction
+        new_ip = loc1.sourceipaddress != loc2.sourceipaddress
 
-        if not did_find:
-            state.localities.append(loc1)
+        if new_more_recent or new_ip:
+            grid.remove(index, loc2)
+            grid.add(index, loc1)
+            state.localities[index] = loc1
             did_update = True
 
     return Update(state, did_update)
 
 
+def _first_within_radius(
+        loc: Locality,
+        localities: List[Locality],
+        candidates: List[int]
+) -> Optional[int]:
+    '''Find the position of the first of the `candidates` positions in
+    `localities` that `loc` falls within, measuring the distance to all of
+    them at once.
+    '''
+
+    if len(candidates) == 0:
+        return None
+
+    nearby = [localities[index] for index in candidates]
+
+    dists = distance_matrix([loc], nearby)[0]
+    radii = numpy.minimum(loc.radius, [other.radius for other in nearby])
+
+    matches = numpy.flatnonzero(dists <= radii)
+
+    if len(matches) == 0:
+        return None
+
+    return candidates[int(matches[0])]
+
+
 def remove_outdated(state: State, days_valid: int) -> Update:
     '''Update a state by removing localities that are outdated, determined
     by checking if the last activity within a given locality was at least
@@ -254,5 +516,55 @@ def distance(loc1: Coordinates, loc2: Coordinates) -> float:
     return c * _EARTH_RADIUS
 
 
+def distances(
+        origins: List[Coordinates],
+        destinations: List[Coordinates]
+) -> numpy.ndarray:
+    '''Compute the distance in kilometres between each origin and the
+    destination at the same position in one vectorized call.
+    Any `NamedTuple` with `latitude` and `longitude` fields can be passed.
+    '''
+
+    return _haversine(
+        numpy.array([loc.latitude for loc in origins], dtype=float),
+        numpy.array([loc.longitude for loc in origins], dtype=float),
+        numpy.array([loc.latitude for loc in destinations], dtype=float),
+        numpy.array([loc.longitude for loc in destinations], dtype=float))
+
+
+def distance_matrix(
+        origins: List[Coordinates],
+        destinations: List[Coordinates]
+) -> numpy.ndarray:
+    '''Compute the distance in kilometres between every origin (rows) and
+    every destination (columns) in one vectorized call.
+    '''
+
+    return _haversine(
+        numpy.array([loc.latitude for loc in origins], dtype=float).reshape(-1, 1),
+        numpy.array([loc.longitude for loc in origins], dtype=float).reshape(-1, 1),
+        numpy.array([loc.latitude for loc in destinations], dtype=float),
+        numpy.array([loc.longitude for loc in destinations], dtype=float))
+
+
+def _haversine(lat1, lon1, lat2, lon2) -> numpy.ndarray:
+    '''`distance` over arrays of degrees, broadcasting their shapes.
+    '''
+
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    lon1 = numpy.radians(lon1)
+    lon2 = numpy.radians(lon2)
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = numpy.sin(dlat / 2.0) ** 2 +\
+        numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2.0) ** 2
+    c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+    return c * _EARTH_RADIUS
+
+
 def _coordinates(loc: Locality) -> Coordinates:
     return Coordinates(loc.latitude, loc.longitude)
@@ -95,8 +95,32 @@ class AlertGeoModel(AlertTask):
 
         self.filtersManual(query)
         self.searchEventsAggregated(USERNAME_PATH, samplesLimit=1000)
+
+        # Load the state of every user found at once and record the updated
+        # ones together after walking the aggregations.
+        usernames = [agg['value'] for agg in self.aggregations or []]
+        self._entries = locality.wrap_load_many(self.es)(
+            usernames, cfg.localities.es_index)
+        self._updated_entries = []
+
+        # Check the travel of every user found in one batch, before
+        # walking the aggregations updates their localities.
+        self._checked = {}
+        users = []
+        for agg in self.aggregations or []:
+            username = agg['value']
+            (new_state, cleaned_entry) = self._states(username, agg['events'], cfg)
+            self._checked[username] = (new_state, cleaned_entry)
+            users.append((username, new_state.localities, cleaned_entry.state.localities))
+        self._alerts = dict(zip(
+            [username for (username, _, _) in users],
+            alert.alerts(users)))
+
         self.walkAggregations(threshold=1, config=cfg)
 
+        locality.wrap_journal_many(self.es)(
+            self._updated_entries, cfg.localities.es_index)
+
         if last_execution_record is None:
             updated_exec = execution.Record.new(
                 execution.ExecutionState.new(range_end))
@@ -107,41 +131,45 @@ class AlertGeoModel(AlertTask):
 
         execution.store(self.es)(updated_exec, _EXEC_INDEX)
 
-    def onAggregation(self, agg):
-        username = agg['value']
-        events = agg['events']
-        cfg = agg['config']
-
-        query = locality.wrap_query(self.es)
-        journal = locality.wrap_journal(self.es)
+    def _states(self, username, events, cfg):
+        '''The state of the localities of a user's events and the user's
+        stored entry without its outdated localities.
+        '''
 
         locs_from_evts = list(filter(
             lambda state: state is not None,
             map(locality.from_event, events)))
 
-        entry_from_es = locality.find(query, username, cfg.localities.es_index)
-
         new_state = locality.State('locality', username, locs_from_evts)
 
+        entry_from_es = self._entries.get(username)
+
         if entry_from_es is None:
-            entry_from_es = locality.Entry(
-                '', locality.State('locality', username, []))
+            entry_from_es = locality.Entry.new(
+                locality.State('locality', username, []))
 
         cleaned = locality.remove_outdated(
             entry_from_es.state, cfg.localities.valid_duration_days)
 
-        # Determine if we should trigger an alert before updating the state.
-        new_alert = alert.alert(
-            cleaned.state.username,
-            new_state.localities,
-            cleaned.state.localities)
+        return (new_state, entry_from_es._replace(state=cleaned.state))
+
+    def onAggregation(self, agg):
+        username = agg['value']
+        events = agg['events']
+
+        (new_state, cleaned_entry) = self._checked[username]
+
+        # Determined in main before updating the state.
+        new_alert = self._alerts[username]
 
-        updated = locality.update(cleaned.state, new_state)
+        updated = locality.update(cleaned_entry.state, new_state)
 
-        if updated.did_update:
-            entry_from_es = locality.Entry(entry_from_es.identifier, updated.state)
+        # States found under a legacy id are journaled to be moved to their
+        # derived id even when they didn't change.
+        if updated.did_update or cleaned_entry.legacy_identifiers:
+            entry_from_es = cleaned_entry._replace(state=updated.state)
 
-            journal(entry_from_es, cfg.localities.es_index)
+            self._updated_entries.append(entry_from_es)
 
         if new_alert is not None:
             summary = alert.summary(new_alert)
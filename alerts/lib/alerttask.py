@@ -8,25 +8,90 @@
 import collections
 import json
 import kombu
+import kombu.pools
 import os
 import socket
 import netaddr
 
 from configlib import getConfig, OptionParser
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import Counter
 from celery import Task
 from celery.utils.log import get_task_logger
 
 from mozdef_util.utilities.toUTC import toUTC
 from mozdef_util.utilities.logger import logger
-from mozdef_util.elasticsearch_client import ElasticsearchClient
-from mozdef_util.query_models import TermMatch, ExistsMatch
+from mozdef_util.elasticsearch_client import ElasticsearchClient, ElasticsearchInvalidIndex
+from mozdef_util.query_models import SearchQuery, TermMatch, ExistsMatch, RangeMatch, Aggregation, BooleanMatch, QueryCache
 
-from lib.config import RABBITMQ, ES, ALERT_PLUGINS
+from lib.config import RABBITMQ, ES, ALERT_PLUGINS, QUERY_CACHE
 from lib.alert_plugin_set import AlertPluginSet
 
 
+# painless script appending an alert reference and alert name
+# to an event, used by AlertTask.tagEventsAlert in bulk mode
+TAG_EVENT_SCRIPT = (
+    "if (ctx._source.alerts == null) { ctx._source.alerts = []; } "
+    "ctx._source.alerts.add(params.alert); "
+    "if (ctx._source.alert_names == null) { ctx._source.alert_names = []; } "
+    "ctx._source.alert_names.add(params.alert_name);"
+)
+
+
+# Connections shared by every alert task of a worker process,
+# keyed by process id so a forked worker opens its own
+_ES_CLIENTS = {}
+_ALERT_QUEUES = {}
+
+
+def get_es_client(servers):
+    """
+        ElasticsearchClient for servers shared by the alert tasks of this process
+    """
+    key = (os.getpid(), tuple(servers))
+    if key not in _ES_CLIENTS:
+        _ES_CLIENTS[key] = ElasticsearchClient(servers)
+    return _ES_CLIENTS[key]
+
+
+def get_alert_queue(conn_string):
+    """
+        kombu connection, alert exchange and producer pool shared by the
+        alert tasks of this process, the exchange and queue are declared once
+        returns (connection, exchange, producers)
+    """
+    key = (os.getpid(), conn_string)
+    if key not in _ALERT_QUEUES:
+        connection = kombu.Connection(conn_string)
+        if conn_string.find('sqs') == 0:
+            connection.transport_options['region'] = os.getenv('DEFAULT_AWS_REGION', 'us-west-2')
+            connection.transport_options['is_secure'] = True
+            queue_name = os.getenv('OPTIONS_ALERTSQSQUEUEURL').split('/')[4]
+        else:
+            queue_name = RABBITMQ["alertqueue"]
+        exchange = kombu.Exchange(
+            name=RABBITMQ["alertexchange"], type="topic", durable=True
+        )
+        exchange(connection).declare()
+        kombu.Queue(queue_name, exchange=exchange)(connection).declare()
+        # held here rather than in kombu.pools.producers, which keys its
+        # pools by connection parameters publishing can change
+        producers = kombu.pools.ProducerPool(connection.Pool())
+        _ALERT_QUEUES[key] = (connection, exchange, producers)
+    return _ALERT_QUEUES[key]
+
+
+def release_alert_queues():
+    """
+        Close the kombu connections and producers shared by the alert tasks
+        of this process, called when the worker shuts down (see lib/tasks.py)
+    """
+    for key in list(_ALERT_QUEUES):
+        connection, exchange, producers = _ALERT_QUEUES.pop(key)
+        producers.force_close_all()
+        connection.release()
+
+
 # utility functions used by AlertTask.mostCommon
 # determine most common values
 # in a list of dicts
@@ -62,6 +127,35 @@ def getValueByPath(input_dict, path_string):
     return return_data
 
 
+def groupEventsByValue(events, path_string, samples_limit):
+    """
+        Group events by the value at path_string in their _source
+        in a single pass over the events
+        returns [{value:'evil@evil.com',count:1337,events:[...],allevents:[...]}, ...]
+        most common value first, values with the same count
+        in the order they were first seen
+    """
+    groups = collections.OrderedDict()
+    for event in events:
+        value = getValueByPath(event["_source"], path_string)
+        if value not in groups:
+            groups[value] = []
+        groups[value].append(event)
+
+    aggregations = []
+    for value, value_events in sorted(groups.items(), key=lambda group: len(group[1]), reverse=True):
+        aggregations.append({
+            "value": value,
+            "count": len(value_events),
+            # sampled events, up to our samples limit
+            "events": value_events[:samples_limit],
+            # also all events in a non-sampled list
+            # so we mark all events as alerted and don't re-alert
+            "allevents": value_events,
+        })
+    return aggregations
+
+
 def hostname_from_ip(ip):
     try:
         reversed_dns = socket.gethostbyaddr(ip)
@@ -85,9 +179,42 @@ class AlertTask(Task):
 
     abstract = True
 
+    # How alerted events get tagged with the alert:
+    #   bulk: one bulk partial update per alert, then one refresh per index
+    #   single: save each whole event and refresh its index after each one
+    #     (bulk is used anyway when main_query only fetched part of the
+    #     _source, saving those events would overwrite the stored ones)
+    tag_events_mode = "bulk"
+
+    # How searchEventsAggregated groups events:
+    #   client: fetch up to 1000 matching events and group them here
+    #   server: terms aggregation of up to aggregation_size values, each with
+    #     exact counts and samplesLimit events (top_hits, ES limits these to
+    #     100 by default). Only the samples are in allevents, the rest of the
+    #     events are tagged in place with an update by query.
+    aggregation_mode = "client"
+    aggregation_size = 1000
+
+    # QueryCache shared by the alert workers, see QUERY_CACHE in lib/config.py
+    query_cache = None
+
+    # Incremental window: once an alert ran, only search the events received
+    # since its previous run (a high-water mark on receivedtimestamp kept in
+    # watermark_index) instead of its whole SearchQuery(minutes=N) window.
+    # The mark is saved watermark_lag seconds behind the end of the search
+    # so events indexed late (ie: waiting in a bulk queue) are still seen.
+    incremental_window = False
+    watermark_index = "mozdefstate"
+    watermark_lag = 60
+
     def __init__(self):
         self.alert_name = self.__class__.__name__
         self.main_query = None
+        # field searchEventsAggregated last aggregated on
+        self.aggregation_path = None
+        # high-water marks loaded from ES, and the ones to save after this run
+        self.watermarks = None
+        self.pending_watermarks = {}
 
         # Used to store any alerts that were thrown
         self.alert_ids = []
@@ -104,6 +231,7 @@ class AlertTask(Task):
 
         self._configureKombu()
         self._configureES()
+        self._configureQueryCache()
 
         self.event_indices = ['events', 'events-previous']
         plugin_dir = os.path.join(os.path.dirname(__file__), "../plugins")
@@ -126,7 +254,9 @@ class AlertTask(Task):
             setattr(self.config, config_key, temp_value)
 
     def close_connections(self):
-        self.mqConn.release()
+        # the connections are shared by every alert task of this process,
+        # they're released by release_alert_queues when the worker shuts down
+        pass
 
     def _discover_task_exchange(self):
         """Use configuration information to understand the message queue protocol.
@@ -156,27 +286,7 @@ class AlertTask(Task):
         """
         try:
             connString = self.__build_conn_string()
-            self.mqConn = kombu.Connection(connString)
-            if connString.find('sqs') == 0:
-                self.mqConn.transport_options['region'] = os.getenv('DEFAULT_AWS_REGION', 'us-west-2')
-                self.mqConn.transport_options['is_secure'] = True
-                self.alertExchange = kombu.Exchange(
-                    name=RABBITMQ["alertexchange"], type="topic", durable=True
-                )
-                self.alertExchange(self.mqConn).declare()
-                alertQueue = kombu.Queue(
-                    os.getenv('OPTIONS_ALERTSQSQUEUEURL').split('/')[4], exchange=self.alertExchange
-                )
-            else:
-                self.alertExchange = kombu.Exchange(
-                    name=RABBITMQ["alertexchange"], type="topic", durable=True
-                )
-                self.alertExchange(self.mqConn).declare()
-                alertQueue = kombu.Queue(
-                    RABBITMQ["alertqueue"], exchange=self.alertExchange
-                )
-            alertQueue(self.mqConn).declare()
-            self.mqproducer = self.mqConn.Producer(serializer="json")
+            self.mqConn, self.alertExchange, self.mqProducers = get_alert_queue(connString)
             self.log.debug("Kombu configured")
         except Exception as e:
             self.log.error(
@@ -188,11 +298,23 @@ class AlertTask(Task):
         Configure elasticsearch client
         """
         try:
-            self.es = ElasticsearchClient(ES["servers"])
+            self.es = get_es_client(ES["servers"])
             self.log.debug("ES configured")
         except Exception as e:
             self.log.error("Exception while configuring ES for alerts: {0}".format(e))
 
+    def _configureQueryCache(self):
+        """
+        Configure the search results cache if enabled
+        """
+        if QUERY_CACHE.get("path"):
+            self.query_cache = QueryCache(
+                QUERY_CACHE["path"],
+                ttl=QUERY_CACHE.get("ttl", 60),
+                bucket_seconds=QUERY_CACHE.get("bucket_seconds", 60),
+                max_entries=QUERY_CACHE.get("max_entries", 1000),
+            )
+
     def mostCommon(self, listofdicts, dictkeypath):
         """
             Given a list containing dictionaries,
@@ -217,14 +339,15 @@ class AlertTask(Task):
         """
         try:
             self.log.debug(alertDict)
-            ensurePublish = self.mqConn.ensure(
-                self.mqproducer, self.mqproducer.publish, max_retries=10
-            )
-            ensurePublish(
-                alertDict,
-                exchange=self.alertExchange,
-                routing_key=RABBITMQ["alertqueue"],
-            )
+            with self.mqProducers.acquire(block=True) as producer:
+                producer.publish(
+                    alertDict,
+                    exchange=self.alertExchange,
+                    routing_key=RABBITMQ["alertqueue"],
+                    serializer="json",
+                    retry=True,
+                    retry_policy={"max_retries": 10},
+                )
             self.log.debug("alert sent to the alert queue")
         except Exception as e:
             self.log.error(
@@ -277,8 +400,80 @@ class AlertTask(Task):
         if duplicate_matcher not in query.must_not:
             query.add_must_not(duplicate_matcher)
 
+        if self.incremental_window and query.date_timedelta:
+            self.filtersWatermark(query)
+
         self.main_query = query
 
+    def filtersWatermark(self, query):
+        """
+        Narrow the relative window of query to the events
+        received since the high-water mark of the previous run
+        """
+        alert_name = self.determine_alert_classname()
+        now = toUTC(datetime.now())
+        window_start = now - timedelta(**query.date_timedelta)
+        watermark = self.loadWatermarks().get(alert_name)
+        if watermark is not None and watermark > window_start:
+            query.date_timedelta = {}
+            query.add_must(RangeMatch("receivedtimestamp", watermark, now))
+        self.pending_watermarks[alert_name] = now - timedelta(seconds=self.watermark_lag)
+
+    def watermarkId(self, alert_name):
+        return "alertwatermark_{0}".format(alert_name)
+
+    def loadWatermarks(self):
+        """
+        Load the high-water mark of every alert once per run
+        returns {alert_name: datetime}
+        """
+        if self.watermarks is None:
+            self.watermarks = {}
+            query = SearchQuery()
+            query.add_must(TermMatch("type", "alertwatermark"))
+            try:
+                results = query.execute(self.es, indices=[self.watermark_index], size=10000)
+                for hit in results["hits"]:
+                    self.watermarks[hit["_source"]["alert_name"]] = toUTC(hit["_source"]["watermark"])
+            except ElasticsearchInvalidIndex:
+                # no alert saved a watermark yet
+                pass
+            except Exception as e:
+                self.log.error("Error while loading alert watermarks: {0}".format(e))
+        return self.watermarks
+
+    def discardWatermark(self, alert_name=None):
+        """
+        Don't move the high-water mark of an alert whose search failed
+        """
+        if self.incremental_window:
+            if alert_name is None:
+                alert_name = self.determine_alert_classname()
+            self.pending_watermarks.pop(alert_name, None)
+
+    def saveWatermarks(self):
+        """
+        Save the high-water marks of this run with one bulk request
+        """
+        documents = []
+        for alert_name, watermark in self.pending_watermarks.items():
+            documents.append({
+                "_index": self.watermark_index,
+                "_id": self.watermarkId(alert_name),
+                "_source": {
+                    "type": "alertwatermark",
+                    "alert_name": alert_name,
+                    "watermark": watermark.isoformat(),
+                    "utctimestamp": toUTC(datetime.now()).isoformat(),
+                },
+            })
+        self.pending_watermarks = {}
+        if not documents:
+            return
+        report = self.es.save_documents(documents)
+        if report["dropped"] or report["failed"]:
+            self.log.error("Unable to save {0} alert watermarks".format(len(report["dropped"]) + len(report["failed"])))
+
     def determine_alert_classname(self):
         alert_name = self.classname()
         # Allow alerts like the generic alerts (one python alert but represents many 'alerts')
@@ -291,7 +486,7 @@ class AlertTask(Task):
         """
         Execute the search for simple events
         """
-        return self.main_query.execute(self.es, indices=self.event_indices)
+        return self.main_query.execute(self.es, indices=self.event_indices, query_cache=self.query_cache)
 
     def searchEventsSimple(self):
         """
@@ -303,8 +498,9 @@ class AlertTask(Task):
             self.log.debug(self.events)
         except Exception as e:
             self.log.error("Error while searching events in ES: {0}".format(e))
+            self.discardWatermark()
 
-    def searchEventsAggregated(self, aggregationPath, samplesLimit=5):
+    def searchEventsAggregated(self, aggregationPath, samplesLimit=5, esresults=None):
         """
         Search events, aggregate matching ES filters by aggregationPath,
         store them in self.aggregations as a list of dictionaries
@@ -316,6 +512,8 @@ class AlertTask(Task):
         aggregationPath can be key.subkey.subkey to specify a path to a dictionary value
         relative to the _source that's returned from elastic search.
         ex: details.sourceipaddress
+        esresults can hold the results of main_query if it was already
+        executed (ie: in a multi search), only with the client aggregation mode
         """
 
         # We automatically add the key that we're matching on
@@ -324,34 +522,51 @@ class AlertTask(Task):
         if aggreg_key_exists not in self.main_query.must:
             self.main_query.add_must(aggreg_key_exists)
 
+        self.aggregation_path = aggregationPath
+        if self.aggregation_mode == "server":
+            self.searchEventsAggregatedServer(aggregationPath, samplesLimit)
+            return
+
         try:
-            esresults = self.main_query.execute(self.es, indices=self.event_indices)
+            if esresults is None:
+                esresults = self.main_query.execute(self.es, indices=self.event_indices, query_cache=self.query_cache)
             results = esresults["hits"]
 
-            # List of aggregation values that can be counted/summarized by Counter
-            # Example: ['evil@evil.com','haxoor@noob.com', 'evil@evil.com'] for an email aggregField
-            aggregationValues = []
-            for r in results:
-                aggregationValues.append(getValueByPath(r["_source"], aggregationPath))
+            # [{value:'evil@evil.com',count:1337,events:[...]}, ...]
+            aggregationList = groupEventsByValue(results, aggregationPath, samplesLimit)
+            self.aggregations = aggregationList
+            self.log.debug(self.aggregations)
+        except Exception as e:
+            self.log.error("Error while searching events in ES: {0}".format(e))
+            self.discardWatermark()
+
+    def searchEventsAggregatedServer(self, aggregationPath, samplesLimit):
+        """
+        Same as searchEventsAggregated, but let ES count the values
+        and only return samplesLimit events for each of them
+        """
+        aggregation = Aggregation(aggregationPath, aggregation_size=self.aggregation_size, samples_size=samplesLimit)
+        self.main_query.add_aggregation(aggregation)
+        try:
+            esresults = self.main_query.execute(self.es, indices=self.event_indices, size=0, query_cache=self.query_cache)
 
             # [{value:'evil@evil.com',count:1337,events:[...]}, ...]
             aggregationList = []
-            for i in Counter(aggregationValues).most_common():
-                idict = {"value": i[0], "count": i[1], "events": [], "allevents": []}
-                for r in results:
-                    if getValueByPath(r["_source"], aggregationPath) == i[0]:
-                        # copy events detail into this aggregation up to our samples limit
-                        if len(idict["events"]) < samplesLimit:
-                            idict["events"].append(r)
-                        # also copy all events to a non-sampled list
-                        # so we mark all events as alerted and don't re-alert
-                        idict["allevents"].append(r)
-                aggregationList.append(idict)
+            for term in esresults["aggregations"][aggregationPath]["terms"]:
+                aggregationList.append({
+                    "value": term["key"],
+                    "count": term["count"],
+                    "events": term["hits"],
+                    "allevents": term["hits"],
+                })
 
             self.aggregations = aggregationList
             self.log.debug(self.aggregations)
         except Exception as e:
             self.log.error("Error while searching events in ES: {0}".format(e))
+            self.discardWatermark()
+        finally:
+            self.main_query.aggregation.remove(aggregation)
 
     def walkEvents(self, **kwargs):
         """
@@ -401,7 +616,7 @@ class AlertTask(Task):
                         # even though we only sample events in the alert
                         # tag all events as alerted to avoid re-alerting
                         # on events we've already processed.
-                        self.tagEventsAlert(aggregation["allevents"], alertResultES)
+                        self.tagAggregationAlert(aggregation, alertResultES)
                         self.alertToMessageQueue(full_alert_doc)
                         self.saveAlertID(alertResultES)
 
@@ -499,6 +714,8 @@ class AlertTask(Task):
         not re-alerted
         """
         try:
+            alert_name = self.determine_alert_classname()
+            bulk = self.tag_events_mode == "bulk" or self.partialSource()
             for event in events:
                 if "alerts" not in event["_source"]:
                     event["_source"]["alerts"] = []
@@ -508,11 +725,102 @@ class AlertTask(Task):
 
                 if "alert_names" not in event["_source"]:
                     event["_source"]["alert_names"] = []
-                event["_source"]["alert_names"].append(self.determine_alert_classname())
+                event["_source"]["alert_names"].append(alert_name)
+
+                if not bulk:
+                    self.es.save_event(index=event["_index"], body=event["_source"], doc_id=event["_id"])
+                    # We refresh here to ensure our changes to the events will show up for the next search query results
+                    self.es.refresh(event["_index"])
 
-                self.es.save_event(index=event["_index"], body=event["_source"], doc_id=event["_id"])
-                # We refresh here to ensure our changes to the events will show up for the next search query results
-                self.es.refresh(event["_index"])
+            if bulk:
+                self.bulkTagEventsAlert(events, alertResultES, alert_name)
+            self.invalidateQueryCache()
+        except Exception as e:
+            self.log.error("Error while updating events in ES: {0}".format(e))
+
+    def invalidateQueryCache(self):
+        """
+        Drop the cached results of main_query once its events got
+        tagged, their alert_names in the cache are stale
+        """
+        main_query = getattr(self, "main_query", None)
+        if self.query_cache is None or main_query is None or main_query.last_cache_key is None:
+            return
+        self.query_cache.delete(main_query.last_cache_key)
+
+    def partialSource(self):
+        """
+        Whether the events of main_query only hold part of their _source
+        (add_source_include/add_source_exclude)
+        """
+        main_query = getattr(self, "main_query", None)
+        if main_query is None:
+            return False
+        return bool(main_query.source_includes or main_query.source_excludes)
+
+    def bulkTagEventsAlert(self, events, alertResultES, alert_name):
+        """
+        Append the alert to the events with a single bulk
+        scripted update, refreshing each index touched once
+        """
+        actions = []
+        indices = []
+        for event in events:
+            actions.append({
+                "_op_type": "update",
+                "_index": event["_index"],
+                "_id": event["_id"],
+                "retry_on_conflict": 3,
+                "script": {
+                    "source": TAG_EVENT_SCRIPT,
+                    "lang": "painless",
+                    "params": {
+                        "alert": {"index": alertResultES["_index"], "id": alertResultES["_id"]},
+                        "alert_name": alert_name,
+                    },
+                },
+            })
+            if event["_index"] not in indices:
+                indices.append(event["_index"])
+        if not actions:
+            return
+        report = self.es.save_documents(actions)
+        if report["dropped"] or report["failed"]:
+            self.log.error("Unable to tag {0} events with alert {1}".format(len(report["dropped"]) + len(report["failed"]), alertResultES["_id"]))
+        # We refresh here to ensure our changes to the events will show up for the next search query results
+        for index in indices:
+            self.es.refresh(index)
+
+    def tagAggregationAlert(self, aggregation, alertResultES):
+        """
+        Tag all the events of an aggregation with the alert.
+        Server side aggregations only hold samples of the events,
+        so the remaining ones are tagged with an update by query
+        """
+        self.tagEventsAlert(aggregation["allevents"], alertResultES)
+        if len(aggregation["allevents"]) >= aggregation["count"]:
+            return
+        alert_name = self.determine_alert_classname()
+        # main_query.must doesn't hold the time range of date_timedelta,
+        # the one the search ran with is added explicitly
+        must = self.main_query.must + [TermMatch(self.aggregation_path, aggregation["value"])]
+        if self.main_query.time_range is not None:
+            must.append(self.main_query.time_range)
+        query = BooleanMatch(
+            must=must,
+            must_not=self.main_query.must_not + [TermMatch("alert_names", alert_name)],
+            should=self.main_query.should
+        )
+        script = {
+            "source": TAG_EVENT_SCRIPT,
+            "lang": "painless",
+            "params": {
+                "alert": {"index": alertResultES["_index"], "id": alertResultES["_id"]},
+                "alert_name": alert_name,
+            },
+        }
+        try:
+            self.es.update_by_query(query, self.event_indices, script)
         except Exception as e:
             self.log.error("Error while updating events in ES: {0}".format(e))
 
@@ -526,8 +834,11 @@ class AlertTask(Task):
         """
         Main method launched by celery periodically
         """
+        self.watermarks = None
+        self.pending_watermarks = {}
         try:
             self.main(*args, **kwargs)
+            self.saveWatermarks()
             self.log.debug("finished")
         except Exception as e:
             self.error_thrown = e
@@ -41,6 +41,16 @@ ES = {
     'servers': [es_server]
 }
 
+# Share the results of identical searches run by the alert workers
+# within bucket_seconds of each other, for up to ttl seconds,
+# through this sqlite file. Leave path empty to disable.
+QUERY_CACHE = {
+    'path': '',
+    'ttl': 60,
+    'bucket_seconds': 60,
+    'max_entries': 1000,
+}
+
 RESTAPI_URL = "http://localhost:8081"
 # Leave empty for no auth
 RESTAPI_TOKEN = ""
@@ -1,5 +1,7 @@
 from celery import Celery
+from celery.signals import worker_process_shutdown, worker_shutdown
 
+from lib.alerttask import release_alert_queues
 from lib.celery_scheduler import celery_config
 from lib.celery_scheduler.celery_rest_client import CeleryRestClient
 
@@ -9,5 +11,13 @@ app.config_from_object(celery_config, force=True)
 celery_rest = CeleryRestClient()
 celery_rest.load_and_register_alerts()
 
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def release_shared_connections(**kwargs):
+    # the alert tasks of a worker process share their kombu connections
+    release_alert_queues()
+
+
 if __name__ == "__main__":
     app.start()
@@ -8,6 +8,7 @@
 
 from lib.alerttask import AlertTask
 from mozdef_util.query_models import QueryStringMatch, SearchQuery, TermMatch
+from mozdef_util.utilities.cidr_matcher import CIDRMatcher
 import netaddr
 
 
@@ -30,8 +31,18 @@ class AlertProxyDropIP(AlertTask):
 
         search_query.add_must([QueryStringMatch("details.host: {}".format(ip_regex))])
 
+        whitelisted_networks = []
         for ip in self.config.ip_whitelist.split(","):
-            search_query.add_must_not([TermMatch("details.host", ip)])
+            ip = ip.strip()
+            if not ip:
+                continue
+            if "/" in ip:
+                whitelisted_networks.append(ip)
+            else:
+                search_query.add_must_not([TermMatch("details.host", ip)])
+        # Networks can't be matched by a term query on details.host,
+        # the hosts of the events found are checked against them instead
+        self.whitelisted_networks = CIDRMatcher(whitelisted_networks)
 
         self.filtersManual(search_query)
         self.searchEventsAggregated("details.sourceipaddress", samplesLimit=10)
@@ -56,7 +67,7 @@ class AlertProxyDropIP(AlertTask):
                 ip = netaddr.IPAddress(event["_source"]["details"]["host"])
             except (netaddr.core.AddrFormatError, ValueError):
                 pass
-            if ip is not None:
+            if ip is not None and event["_source"]["details"]["host"] not in self.whitelisted_networks:
                 dropped_destinations.add(event["_source"]["details"]["host"])
                 final_aggr["allevents"].append(event)
                 final_aggr["events"].append(event)
@@ -7,8 +7,8 @@
 
 from lib.alerttask import AlertTask, add_hostname_to_ip
 from mozdef_util.query_models import SearchQuery, TermMatch, PhraseMatch
+from mozdef_util.utilities.cidr_matcher import CIDRMatcher
 import re
-import netaddr
 
 # This alert requires a configuration file, ssh_lateral.json to exist
 # in the alerts directory.
@@ -74,6 +74,11 @@ class SshLateral(AlertTask):
     def __init__(self):
         AlertTask.__init__(self)
         self._config = self.parse_json_alert_config('ssh_lateral.json')
+        self._alertifsource = CIDRMatcher(self._config['alertifsource'])
+        self._notalertifsource = CIDRMatcher(self._config['notalertifsource'])
+        self._exceptions = [
+            (x[0], x[1], CIDRMatcher([x[2]])) for x in self._config['exceptions']
+        ]
 
     def main(self):
         search_query = SearchQuery(minutes=15)
@@ -90,10 +95,10 @@ class SshLateral(AlertTask):
     # Returns true if the user, host, and source IP fall into an exception
     # listed in the configuration file.
     def exception_check(self, user, host, srcip):
-        for x in self._config['exceptions']:
+        for x in self._exceptions:
             if re.match(x[0], user) is not None and \
                     re.match(x[1], host) is not None and \
-                    netaddr.IPAddress(srcip) in netaddr.IPNetwork(x[2]):
+                    srcip in x[2]:
                 return True
         return False
 
@@ -126,31 +131,24 @@ class SshLateral(AlertTask):
         for x in aggreg['events']:
             m = re.match(r'Accepted publickey for (\S+) from (\S+).*', x['_source']['summary'])
             if m is not None and len(m.groups()) == 2:
-                ipaddr = netaddr.IPAddress(m.group(2))
-                for y in self._config['alertifsource']:
-                    if ipaddr in netaddr.IPNetwork(y):
-                        # Validate it's not excepted in the IP negation list
-                        notalertnetwork = False
-                        for z in self._config['notalertifsource']:
-                            if ipaddr in netaddr.IPNetwork(z):
-                                notalertnetwork = True
-                                break
-                        if notalertnetwork:
-                            continue
-                        # Check our user ignore list
-                        skipuser = False
-                        for z in self._config['ignoreusers']:
-                            if re.match(z, m.group(1)):
-                                skipuser = True
-                                break
-                        if skipuser:
-                            continue
-                        # Check our exception list
-                        if self.exception_check(m.group(1), srchost, m.group(2)):
-                            continue
-                        source_ips.append(m.group(2))
-                        users.append(m.group(1))
-                        candidates.append(x)
+                if m.group(2) in self._alertifsource:
+                    # Validate it's not excepted in the IP negation list
+                    if m.group(2) in self._notalertifsource:
+                        continue
+                    # Check our user ignore list
+                    skipuser = False
+                    for z in self._config['ignoreusers']:
+                        if re.match(z, m.group(1)):
+                            skipuser = True
+                            break
+                    if skipuser:
+                        continue
+                    # Check our exception list
+                    if self.exception_check(m.group(1), srchost, m.group(2)):
+                        continue
+                    source_ips.append(m.group(2))
+                    users.append(m.group(1))
+                    candidates.append(x)
         if len(candidates) == 0:
             return None
 
@@ -26,8 +26,8 @@ def getESAlerts(es):
     # We use an ExistsMatch here just to satisfy the
     # requirements of a search query must have some "Matchers"
     search_query.add_must(ExistsMatch('summary'))
-    results = search_query.execute(es, indices=['alerts'], size=10000)
-    return results
+    # iterate over all of them rather than the first 10000
+    return search_query.execute_iter(es, indices=['alerts'])
 
 
 def ensureIndexes(mozdefdb):
@@ -45,7 +45,7 @@ def ensureIndexes(mozdefdb):
 
 def updateMongo(mozdefdb, esAlerts):
     alerts = mozdefdb['alerts']
-    for a in esAlerts['hits']:
+    for a in esAlerts:
         # insert alert into mongo if we don't already have it
         alertrecord = alerts.find_one({'esmetadata.id': a['_id']})
         if alertrecord is None:
@@ -39,10 +39,16 @@ def save_db_data(save_path, db_data):
     logger.debug("Saving db data to " + temp_save_path)
     with open(temp_save_path, "wb+") as text_file:
         text_file.write(db_data)
+        text_file.flush()
+        os.fsync(text_file.fileno())
     logger.debug("Testing temp geolite db file")
-    geo_ip = GeoIP(temp_save_path)
+    geo_ip = GeoIP(temp_save_path, cache_size=0)
     # Do a generic lookup to verify we don't get any errors (malformed data)
     geo_ip.lookup_ip('8.8.8.8')
+    geo_ip.close()
+    # Running workers keep using the old file they have mapped and
+    # switch to the new one the next time GeoIP checks for a reload,
+    # so the file must be replaced atomically rather than rewritten in place
     logger.debug("Moving temp file to " + save_path)
     os.rename(temp_save_path, save_path)
 
@@ -1,18 +1,47 @@
-from threading import Thread, Lock
+from threading import Thread, Lock, Semaphore
+from queue import Queue
 import time
 
+from .utilities.logger import logger
+
 
 class BulkQueue():
 
-    def __init__(self, es_client, threshold=10, flush_time=30):
+    def __init__(self, es_client, threshold=10, flush_time=30, max_bytes=None, max_in_flight=0):
+        """ threshold and max_bytes (if set) are the number of documents
+            and approximate serialized size that trigger a flush.
+            With max_in_flight set, flushed batches are indexed by a
+            background thread so callers of add() don't wait on ES,
+            and add() only blocks once max_in_flight batches are pending.
+            Batches that couldn't be sent to ES, and the documents ES
+            couldn't take once out of retries, are put back in the queue
+        """
         self.es_client = es_client
         self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.max_in_flight = max_in_flight
         self.list = list()
+        self.list_bytes = 0
         self.flush_time = flush_time
         self.flush_thread = Thread(target=self.flush_periodically)
         self.flush_thread.daemon = True
         self.lock = Lock()
         self.running = False
+        # batches swapped out of the queue waiting for the sender thread
+        self.pending = None
+        self.sender_thread = None
+        # one per batch waiting for or being sent by the sender thread
+        self.in_flight_slots = None
+        # metrics
+        self.in_flight = 0
+        self.flush_count = 0
+        self.flushed_documents = 0
+        self.retried_documents = 0
+        self.requeued_documents = 0
+        self.dropped_documents = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
 
     def start_thread(self):
         self.stopping_thread = False
@@ -31,8 +60,21 @@ class BulkQueue():
     def started(self):
         return self.running
 
+    def serialize(self, body):
+        """ Serialize a document the way the ES transport would,
+            the bulk request then sends it as is instead of
+            serializing it a second time
+        """
+        if isinstance(body, str):
+            return body
+        return self.es_client.es_connection.transport.serializer.dumps(body)
+
     def add(self, index, body, doc_id=None):
         """ Add event to queue, flushing if we hit the threshold """
+        doc_bytes = 0
+        if self.max_bytes:
+            body = self.serialize(body)
+            doc_bytes = len(body)
         bulk_doc = {
             "_index": index,
             "_id": doc_id,
@@ -41,9 +83,11 @@ class BulkQueue():
         self.lock.acquire()
         try:
             self.list.append(bulk_doc)
+            self.list_bytes += doc_bytes
+            full = len(self.list) >= self.threshold or (self.max_bytes and self.list_bytes >= self.max_bytes)
         finally:
             self.lock.release()
-        if self.size() >= self.threshold:
+        if full:
             self.flush()
 
     def size(self):
@@ -52,9 +96,112 @@ class BulkQueue():
 
     def flush(self):
         """ Write all stored events to ES """
+        # Swap the buffer while holding the lock, but talk to ES
+        # outside of it so other threads can keep adding documents
         self.lock.acquire()
         try:
-            self.es_client.save_documents(self.list)
+            documents = self.list
             self.list = list()
+            self.list_bytes = 0
+            if documents:
+                self.in_flight += 1
+        finally:
+            self.lock.release()
+        if not documents:
+            return
+        if self.max_in_flight > 0:
+            self.start_sender()
+            # blocks once max_in_flight batches are waiting or being sent,
+            # pushing back on whoever is adding documents
+            self.in_flight_slots.acquire()
+            self.pending.put(documents)
+        else:
+            self.send(documents)
+
+    def requeue(self, documents):
+        """ Put documents that couldn't be sent back at the front of the queue """
+        self.lock.acquire()
+        try:
+            self.list = documents + self.list
+            if self.max_bytes:
+                self.list_bytes += sum(len(document["_source"]) for document in documents)
         finally:
             self.lock.release()
+
+    def start_sender(self):
+        self.lock.acquire()
+        try:
+            if self.sender_thread is None:
+                self.pending = Queue()
+                self.in_flight_slots = Semaphore(self.max_in_flight)
+                self.sender_thread = Thread(target=self.send_pending)
+                self.sender_thread.daemon = True
+                self.sender_thread.start()
+        finally:
+            self.lock.release()
+
+    def send_pending(self):
+        while True:
+            documents = self.pending.get()
+            try:
+                self.send(documents)
+            except Exception:
+                # send() logged the error and requeued the documents
+                pass
+            finally:
+                self.in_flight_slots.release()
+                self.pending.task_done()
+
+    def send(self, documents):
+        start_time = time.time()
+        report = None
+        try:
+            report = self.es_client.save_documents(documents)
+        except Exception as e:
+            logger.exception("Error sending {0} documents to ES, requeueing them: {1}".format(len(documents), e))
+            self.requeue(documents)
+            raise
+        else:
+            if report['failed']:
+                logger.error("ES couldn't take {0} documents, requeueing them".format(len(report['failed'])))
+                self.requeue(report['failed'])
+        finally:
+            latency = time.time() - start_time
+            self.lock.acquire()
+            try:
+                self.in_flight -= 1
+                self.flush_count += 1
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                self.total_flush_latency += latency
+                if report:
+                    self.flushed_documents += len(documents) - len(report['failed'])
+                    self.retried_documents += len(report['retried'])
+                    self.requeued_documents += len(report['failed'])
+                    self.dropped_documents += len(report['dropped'])
+            finally:
+                self.lock.release()
+
+    def wait(self):
+        """ Block until every flushed batch has been sent to ES """
+        if self.pending is not None:
+            self.pending.join()
+
+    def metrics(self):
+        """ Queue depth and flush latency (in seconds) statistics """
+        average_flush_latency = 0.0
+        if self.flush_count:
+            average_flush_latency = self.total_flush_latency / self.flush_count
+        return {
+            'queue_depth': self.size(),
+            'queue_bytes': self.list_bytes,
+            'in_flight': self.in_flight,
+            'flush_count': self.flush_count,
+            'flushed_documents': self.flushed_documents,
+            'retried_documents': self.retried_documents,
+            'requeued_documents': self.requeued_documents,
+            'dropped_documents': self.dropped_documents,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'average_flush_latency': average_flush_latency,
+        }
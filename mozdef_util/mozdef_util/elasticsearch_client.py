@@ -1,12 +1,14 @@
 import json
+import time
 
 from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search
+from elasticsearch_dsl import Search, MultiSearch
 from elasticsearch.exceptions import NotFoundError
-from elasticsearch.helpers import bulk, BulkIndexError
+from elasticsearch.helpers import streaming_bulk, parallel_bulk, scan
 
 from .query_models import SearchQuery, TermMatch, AggregatedResults, SimpleResults
 from .bulk_queue import BulkQueue
+from .serializer import get_serializer
 
 from .utilities.logger import logger
 
@@ -14,6 +16,10 @@ from .event import Event
 
 DOCUMENT_TYPE = '_doc'
 
+# bulk item statuses worth sending again after backing off,
+# N/A is what the bulk helpers report when ES couldn't be reached
+RETRIABLE_BULK_STATUSES = (429, 503, 'N/A')
+
 
 class ElasticsearchBadServer(Exception):
     def __str__(self):
@@ -35,10 +41,24 @@ class ElasticsearchInvalidIndex(Exception):
 
 class ElasticsearchClient():
 
-    def __init__(self, servers, bulk_amount=100, bulk_refresh_time=30):
-        self.es_connection = Elasticsearch(servers)
+    def __init__(self, servers, bulk_amount=100, bulk_refresh_time=30, bulk_max_bytes=None, bulk_max_in_flight=0,
+                 bulk_threads=1, bulk_chunk_size=500, bulk_max_chunk_bytes=100 * 1024 * 1024,
+                 bulk_max_retries=3, bulk_initial_backoff=2, bulk_max_backoff=60):
+        self.es_connection = Elasticsearch(servers, serializer=get_serializer())
         self.es_connection.ping()
-        self.bulk_queue = BulkQueue(self, threshold=bulk_amount, flush_time=bulk_refresh_time)
+        self.bulk_threads = bulk_threads
+        self.bulk_chunk_size = bulk_chunk_size
+        self.bulk_max_chunk_bytes = bulk_max_chunk_bytes
+        self.bulk_max_retries = bulk_max_retries
+        self.bulk_initial_backoff = bulk_initial_backoff
+        self.bulk_max_backoff = bulk_max_backoff
+        self.bulk_queue = BulkQueue(
+            self,
+            threshold=bulk_amount,
+            flush_time=bulk_refresh_time,
+            max_bytes=bulk_max_bytes,
+            max_in_flight=bulk_max_in_flight
+        )
 
     def close_index(self, index_name):
         return self.es_connection.indices.close(index=index_name)
@@ -102,37 +122,186 @@ class ElasticsearchClient():
     def refresh(self, index_name):
         self.es_connection.indices.refresh(index=index_name)
 
-    def search(self, search_query, indices, size, request_timeout):
+    def __search_obj(self, indices, size, request_timeout, source_includes=None, source_excludes=None):
+        search_obj = Search(using=self.es_connection, index=indices).params(size=size, request_timeout=request_timeout)
+        if source_includes or source_excludes:
+            # only return these fields of each document's _source
+            search_obj = search_obj.source(includes=source_includes, excludes=source_excludes)
+        return search_obj
+
+    def search(self, search_query, indices, size, request_timeout, source_includes=None, source_excludes=None, raw_hits=False):
         results = []
         try:
-            results = Search(using=self.es_connection, index=indices).params(size=size, request_timeout=request_timeout).filter(search_query).execute()
+            results = self.__search_obj(indices, size, request_timeout, source_includes, source_excludes).filter(search_query).execute()
         except NotFoundError:
             raise ElasticsearchInvalidIndex(indices)
 
-        result_set = SimpleResults(results)
+        result_set = SimpleResults(results, raw_hits=raw_hits)
         return result_set
 
-    def aggregated_search(self, search_query, indices, aggregations, size, request_timeout):
-        search_obj = Search(using=self.es_connection, index=indices).params(size=size, request_timeout=request_timeout)
+    def search_iter(self, search_query, indices, page_size=1000, request_timeout=30, max_hits=None, scroll='5m',
+                    source_includes=None, source_excludes=None):
+        '''generator yielding every hit matching search_query
+           in the SimpleResults hit format, fetched page_size hits
+           at a time through a scroll so only one page is held in memory
+           stops after max_hits hits when set
+        '''
+        if max_hits is not None:
+            page_size = max(min(page_size, max_hits), 1)
+        query = self.__search_obj(indices, page_size, request_timeout, source_includes, source_excludes).filter(search_query).to_dict()
+        hits = scan(
+            self.es_connection,
+            query=query,
+            index=indices,
+            scroll=scroll,
+            size=page_size,
+            request_timeout=request_timeout
+        )
+        num_hits = 0
+        try:
+            for hit in hits:
+                if max_hits is not None and num_hits >= max_hits:
+                    break
+                num_hits += 1
+                yield {
+                    '_id': hit['_id'],
+                    '_index': hit['_index'],
+                    '_score': hit.get('_score'),
+                    '_source': hit['_source']
+                }
+        except NotFoundError:
+            raise ElasticsearchInvalidIndex(indices)
+        finally:
+            # clears the scroll when we stop early
+            hits.close()
+
+    def aggregated_search(self, search_query, indices, aggregations, size, request_timeout, source_includes=None, source_excludes=None, raw_hits=False):
+        search_obj = self.__search_obj(indices, size, request_timeout, source_includes, source_excludes)
         query_obj = search_obj.filter(search_query)
         for aggregation in aggregations:
             query_obj.aggs.bucket(name=aggregation.to_dict()['terms']['field'], agg_type=aggregation)
         results = query_obj.execute()
 
-        result_set = AggregatedResults(results)
+        result_set = AggregatedResults(results, raw_hits=raw_hits)
         return result_set
 
+    def multi_search(self, searches, request_timeout=30):
+        '''run several searches in a single _msearch request
+           searches is a list of dicts of search_query, indices, size and
+           optionally aggregations, source_includes and source_excludes
+           returns their results in the same order, None for the failed ones
+        '''
+        multi_search_obj = MultiSearch(using=self.es_connection).params(request_timeout=request_timeout)
+        for search in searches:
+            # the msearch header doesn't take a size, it goes in the body
+            search_obj = Search(using=self.es_connection, index=search['indices']).extra(size=search['size'])
+            if search.get('source_includes') or search.get('source_excludes'):
+                search_obj = search_obj.source(includes=search.get('source_includes'), excludes=search.get('source_excludes'))
+            query_obj = search_obj.filter(search['search_query'])
+            for aggregation in search.get('aggregations', []):
+                query_obj.aggs.bucket(name=aggregation.to_dict()['terms']['field'], agg_type=aggregation)
+            multi_search_obj = multi_search_obj.add(query_obj)
+
+        result_sets = []
+        for search, results in zip(searches, multi_search_obj.execute(raise_on_error=False)):
+            if results is None:
+                logger.error("Search in {0} failed in multi search".format(search['indices']))
+                result_sets.append(None)
+            elif search.get('aggregations'):
+                result_sets.append(AggregatedResults(results))
+            else:
+                result_sets.append(SimpleResults(results))
+        return result_sets
+
+    def __bulk_results(self, documents):
+        if self.bulk_threads > 1:
+            return parallel_bulk(
+                self.es_connection,
+                documents,
+                thread_count=self.bulk_threads,
+                chunk_size=self.bulk_chunk_size,
+                max_chunk_bytes=self.bulk_max_chunk_bytes,
+                raise_on_error=False,
+                raise_on_exception=False
+            )
+        return streaming_bulk(
+            self.es_connection,
+            documents,
+            chunk_size=self.bulk_chunk_size,
+            max_chunk_bytes=self.bulk_max_chunk_bytes,
+            raise_on_error=False,
+            raise_on_exception=False
+        )
+
+    def update_by_query(self, search_query, indices, script):
+        '''run a painless script ({source, lang, params}) on every
+           document matching search_query, refreshing the indices once done
+        '''
+        query = Search(using=self.es_connection, index=indices).filter(search_query).to_dict()['query']
+        try:
+            return self.es_connection.update_by_query(
+                index=indices,
+                doc_type=DOCUMENT_TYPE,
+                body={'query': query, 'script': script},
+                conflicts='proceed',
+                refresh=True
+            )
+        except NotFoundError:
+            raise ElasticsearchInvalidIndex(indices)
+
     def save_documents(self, documents):
+        '''index a list of bulk actions (_index, _id, _source, or any
+           other bulk action such as _op_type update with a script),
+           split into chunks sent over bulk_threads connections.
+           Documents rejected with a retriable status (429/503) or that
+           couldn't reach ES are sent again with exponential backoff,
+           up to bulk_max_retries times.
+           returns a report dict with the succeeded, retried (needed at least
+           one more attempt), failed (still retriable once out of retries,
+           to be sent again later) and dropped (rejected by ES) documents
+        '''
+        report = {
+            'succeeded': [],
+            'retried': [],
+            'failed': [],
+            'dropped': [],
+        }
         # ES library still requires _type to be set
         for document in documents:
             document['_type'] = DOCUMENT_TYPE
-        try:
-            bulk(self.es_connection, documents)
-        except BulkIndexError as e:
-            logger.error("Error bulk indexing: " + str(e))
+        retried_ids = set()
+        attempt = 0
+        while documents:
+            retry_documents = []
+            # both helpers yield results in the same order as the documents
+            for document, (ok, info) in zip(documents, self.__bulk_results(documents)):
+                op_type, item = info.popitem()
+                if ok:
+                    report['succeeded'].append(document)
+                elif item.get('status') in RETRIABLE_BULK_STATUSES:
+                    if attempt >= self.bulk_max_retries:
+                        report['failed'].append(document)
+                        continue
+                    retry_documents.append(document)
+                    if id(document) not in retried_ids:
+                        retried_ids.add(id(document))
+                        report['retried'].append(document)
+                else:
+                    logger.error("Error bulk indexing: " + str(item.get('error')))
+                    report['dropped'].append(document)
+            if retry_documents:
+                backoff = min(self.bulk_initial_backoff * 2 ** attempt, self.bulk_max_backoff)
+                logger.warning("Retrying {0} documents rejected by ES in {1} seconds".format(len(retry_documents), backoff))
+                time.sleep(backoff)
+            documents = retry_documents
+            attempt += 1
+        if report['failed']:
+            logger.error("Unable to send {0} documents to ES after {1} retries".format(len(report['failed']), self.bulk_max_retries))
+        return report
 
     def finish_bulk(self):
         self.bulk_queue.flush()
+        self.bulk_queue.wait()
         self.bulk_queue.stop_thread()
 
     def __bulk_save_document(self, index, body, doc_id=None):
@@ -170,6 +339,34 @@ class ElasticsearchClient():
         event.add_required_fields()
         return self.__save_document(index=index, body=event, doc_id=doc_id, bulk=bulk)
 
+    def save_events(self, events):
+        '''index a batch of events with a single bulk request.
+           events is a list of dicts with body, index and doc_id keys.
+           returns a list of (ok, info) tuples in the same order as events,
+           where info is the bulk response item (status, error) for that event
+        '''
+        documents = []
+        for event_entry in events:
+            event = Event(self.__parse_document(event_entry['body']))
+            event.add_required_fields()
+            documents.append({
+                '_index': event_entry.get('index', 'events'),
+                '_id': event_entry.get('doc_id'),
+                # ES library still requires _type to be set
+                '_type': DOCUMENT_TYPE,
+                '_source': event,
+            })
+        if not documents:
+            return []
+        results = []
+        # one chunk so the whole batch is a single bulk request
+        for ok, info in streaming_bulk(self.es_connection, documents, chunk_size=len(documents), raise_on_error=False, raise_on_exception=False):
+            op_type, item = info.popitem()
+            if not ok:
+                logger.error("Error bulk indexing event: " + str(item.get('error')))
+            results.append((ok, item))
+        return results
+
     def get_object_by_id(self, object_id, indices):
         id_match = TermMatch('_id', object_id)
         search_query = SearchQuery()
@@ -180,6 +377,25 @@ class ElasticsearchClient():
         else:
             return results['hits'][0]
 
+    def get_objects_by_ids(self, object_ids, index):
+        '''fetch documents by _id with a single real-time _mget
+           (no refresh needed), returning the ones found
+           in the SimpleResults hit format keyed by _id
+        '''
+        if not object_ids:
+            return {}
+        response = self.es_connection.mget(index=index, doc_type=DOCUMENT_TYPE, body={'ids': list(object_ids)})
+        found = {}
+        for doc in response['docs']:
+            # a missing index is reported per document, not as a 404
+            if doc.get('found'):
+                found[doc['_id']] = {
+                    '_id': doc['_id'],
+                    '_index': doc['_index'],
+                    '_source': doc['_source'],
+                }
+        return found
+
     def get_alert_by_id(self, alert_id):
         return self.get_object_by_id(alert_id, ['alerts'])
 
@@ -13,12 +13,15 @@ class Event(dict):
     DEFAULT_TYPE = 'event'
 
     def add_required_fields(self):
-        if 'receivedtimestamp' not in self:
-            self['receivedtimestamp'] = toUTC(datetime.now()).isoformat()
-        if 'utctimestamp' not in self:
-            self['utctimestamp'] = toUTC(datetime.now()).isoformat()
-        if 'timestamp' not in self:
-            self['timestamp'] = toUTC(datetime.now()).isoformat()
+        if 'receivedtimestamp' not in self or 'utctimestamp' not in self or 'timestamp' not in self:
+            # one "now" for all of the missing timestamps
+            now = toUTC(datetime.now()).isoformat()
+            if 'receivedtimestamp' not in self:
+                self['receivedtimestamp'] = now
+            if 'utctimestamp' not in self:
+                self['utctimestamp'] = now
+            if 'timestamp' not in self:
+                self['timestamp'] = now
         if 'mozdefhostname' not in self:
             self['mozdefhostname'] = socket.gethostname()
         if 'type' not in self:
@@ -1,17 +1,115 @@
+import os
+import time
+from collections import OrderedDict
+
 import geoip2.database
+import maxminddb
+
+from .utilities.logger import logger
 
 
 class GeoIP(object):
-    def __init__(self, db_location):
+    def __init__(self, db_location, cache_size=10000, cache_ttl=3600, reload_interval=60):
+        ''' Lookups are cached per ip (up to cache_size entries, for cache_ttl seconds).
+            Every reload_interval seconds we check if the db file was replaced
+            (ie: by cron/update_geolite_db.py) and if so switch to the new one.
+        '''
+        self.db_location = db_location
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.reload_interval = reload_interval
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.db_version = None
+        self.last_reload_check = 0
+        self.error = None
+        self.load_db()
+
+    def open_db(self):
+        # memory map the db so every worker process shares the page cache
+        # instead of each holding its own copy, preferring the C extension
+        try:
+            return geoip2.database.Reader(self.db_location, mode=maxminddb.MODE_MMAP_EXT)
+        except ValueError:
+            return geoip2.database.Reader(self.db_location, mode=maxminddb.MODE_MMAP)
+
+    def load_db(self):
+        ''' Open the db, or reopen it if the file has been replaced since '''
+        self.last_reload_check = time.time()
+        try:
+            stat = os.stat(self.db_location)
+            db_version = (stat.st_ino, stat.st_mtime, stat.st_size)
+        except OSError:
+            db_version = None
+        if self.db is not None and db_version in (None, self.db_version):
+            return
+
         try:
-            self.db = geoip2.database.Reader(db_location)
+            db = self.open_db()
         except IOError:
-            self.error = 'No Geolite DB Found!'
+            if self.db is None:
+                self.error = 'No Geolite DB Found!'
+            return
+        except Exception as e:
+            if self.db is None:
+                raise
+            logger.error("Unable to load new Geolite DB, keeping the current one: {0}".format(e))
+            return
+
+        old_db = self.db
+        self.db = db
+        self.db_version = db_version
+        self.error = None
+        self.cache.clear()
+        if old_db is not None:
+            logger.info("Reloaded Geolite DB from {0}".format(self.db_location))
+            old_db.close()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        ''' Cache statistics '''
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate,
+            'size': len(self.cache),
+        }
 
     def lookup_ip(self, ip):
-        if hasattr(self, 'error'):
+        now = time.time()
+        if now - self.last_reload_check >= self.reload_interval:
+            self.load_db()
+
+        if self.db is None:
             return {'error': self.error}
 
+        cached = self.cache.get(ip)
+        if cached is not None and now - cached[0] < self.cache_ttl:
+            self.hits += 1
+            self.cache.move_to_end(ip)
+            # callers are free to modify what we hand back
+            return dict(cached[1])
+
+        self.misses += 1
+        geo_dict = self.lookup_db(ip)
+        if self.cache_size > 0:
+            self.cache[ip] = (now, geo_dict)
+            self.cache.move_to_end(ip)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return dict(geo_dict)
+
+    def lookup_db(self, ip):
         try:
             result = self.db.city(ip)
         except Exception as e:
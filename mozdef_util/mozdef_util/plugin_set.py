@@ -3,7 +3,7 @@ import pynsive
 import importlib
 from operator import itemgetter
 
-from .utilities.dict2List import dict2List
+from .utilities.flat_event import FlatEvent
 from .utilities.logger import logger
 
 
@@ -71,17 +71,22 @@ class PluginSet(object):
         if not isinstance(message, dict):
             raise TypeError('event is type {0}, should be a dict'.format(type(message)))
 
-        for plugin in self.ordered_enabled_plugins:
-            send = False
-            message_fields = [e for e in dict2List(message)]
-            # this is to make it so we can match on all fields
-            message_fields.append('*')
+        plugins = self.ordered_enabled_plugins
+        registrations = []
+        for plugin in plugins:
             if isinstance(plugin['registration'], list):
-                if set(plugin['registration']).intersection(message_fields):
-                    send = True
+                registrations.append(set(plugin['registration']))
             elif isinstance(plugin['registration'], str):
-                if plugin['registration'] in message_fields:
-                    send = True
+                registrations.append(set([plugin['registration']]))
+            else:
+                registrations.append(set())
+        max_value_length = max([len(token) for tokens in registrations for token in tokens if isinstance(token, str)] or [0])
+        # flattened once, and again only after a plugin ran on the message
+        flat_message = FlatEvent(message, max_value_length=max_value_length)
+
+        for plugin, tokens in zip(plugins, registrations):
+            # this is to make it so we can match on all fields
+            send = '*' in tokens or len(flat_message.matches(tokens)) > 0
             if send:
                 try:
                     (message, metadata) = self.send_message_to_plugin(plugin_class=plugin['plugin_class'], message=message, metadata=metadata)
@@ -89,6 +94,7 @@ class PluginSet(object):
                     logger.exception('Received exception in {0}: message: {1}\n{2}'.format(plugin['plugin_class'], message, e))
                 if message is None:
                     return (message, metadata)
+                flat_message.mark_dirty(message)
         return (message, metadata)
 
     def send_message_to_plugin(self, plugin_class, message, metadata=None):
@@ -3,6 +3,7 @@ from .aggregation import Aggregation
 from .boolean_match import BooleanMatch
 from .exists_match import ExistsMatch
 from .phrase_match import PhraseMatch
+from .query_cache import QueryCache
 from .query_string_match import QueryStringMatch
 from .range_match import RangeMatch
 from .search_query import SearchQuery
@@ -6,7 +6,10 @@
 # Copyright (c) 2017 Mozilla Corporation
 
 
-def AggregatedResults(input_results):
+from .simple_results import hit_dict
+
+
+def AggregatedResults(input_results, raw_hits=False):
     converted_results = {
         'meta': {
             'timed_out': input_results.timed_out
@@ -14,21 +17,29 @@ def AggregatedResults(input_results):
         'hits': [],
         'aggregations': {}
     }
-    for hit in input_results.hits:
-        hit_dict = {
-            '_id': hit.meta.id,
-            '_index': hit.meta.index,
-            '_score': hit.meta.score,
-            '_source': hit.to_dict()
-        }
-        converted_results['hits'].append(hit_dict)
+    if raw_hits:
+        # the hits as elasticsearch returned them, skipping
+        # the conversion of each one to an elasticsearch_dsl Hit
+        converted_results['hits'] = input_results.to_dict()['hits']['hits']
+    else:
+        converted_results['hits'] = [hit_dict(hit) for hit in input_results.hits]
 
     for agg_name, aggregation in input_results.aggregations.to_dict().items():
         aggregation_dict = {
             'terms': []
         }
         for bucket in aggregation['buckets']:
-            aggregation_dict['terms'].append({'count': bucket['doc_count'], 'key': bucket['key']})
+            term_dict = {'count': bucket['doc_count'], 'key': bucket['key']}
+            if 'samples' in bucket:
+                term_dict['hits'] = []
+                for hit in bucket['samples']['hits']['hits']:
+                    term_dict['hits'].append({
+                        '_id': hit['_id'],
+                        '_index': hit['_index'],
+                        '_score': hit['_score'],
+                        '_source': hit['_source']
+                    })
+            aggregation_dict['terms'].append(term_dict)
 
         converted_results['aggregations'][agg_name] = aggregation_dict
 
@@ -9,5 +9,9 @@
 from elasticsearch_dsl import A
 
 
-def Aggregation(field_name, aggregation_size=20):
-    return A('terms', field=field_name, size=aggregation_size)
+def Aggregation(field_name, aggregation_size=20, samples_size=0):
+    aggregation = A('terms', field=field_name, size=aggregation_size)
+    if samples_size > 0:
+        # return up to samples_size matching documents with each bucket
+        aggregation.metric('samples', 'top_hits', size=samples_size)
+    return aggregation
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+# Copyright (c) 2017 Mozilla Corporation
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from mozdef_util.utilities.logger import logger
+
+
+class QueryCache(object):
+    ''' Search results cache shared by every process opening the same
+        sqlite file (ie: the celery alert workers), so identical
+        searches run within a few seconds of each other only hit ES once.
+
+        Entries are keyed by the normalized query plus the bucket_seconds
+        wide time bucket it ran in, so a relative window (SearchQuery(minutes=5))
+        maps to the same entry until the next bucket. They expire after
+        ttl seconds and only the max_entries newest are kept.
+        Errors using the store are logged and treated as cache misses.
+    '''
+    def __init__(self, path, ttl=60, bucket_seconds=60, max_entries=1000):
+        self.path = path
+        self.ttl = ttl
+        self.bucket_seconds = bucket_seconds
+        self.max_entries = max_entries
+        self.connection = None
+        self.connection_pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        # sqlite connections can't be shared with forked processes
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS query_cache '
+                '(key TEXT PRIMARY KEY, created REAL, expires REAL, results TEXT)'
+            )
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def key(self, query_parts):
+        ''' stable key for json serializable query parts in the current time bucket '''
+        bucket = int(time.time() // self.bucket_seconds)
+        serialized = json.dumps([query_parts, bucket], sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def get(self, key):
+        try:
+            row = self.connect().execute(
+                'SELECT results FROM query_cache WHERE key = ? AND expires > ?',
+                (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error("Unable to read query cache {0}: {1}".format(self.path, e))
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # decoded per call, callers are free to modify the results
+        return json.loads(row[0])
+
+    def set(self, key, results):
+        now = time.time()
+        try:
+            connection = self.connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO query_cache (key, created, expires, results) VALUES (?, ?, ?, ?)',
+                (key, now, now + self.ttl, json.dumps(results, default=str))
+            )
+            connection.execute('DELETE FROM query_cache WHERE expires <= ?', (now,))
+            connection.execute(
+                'DELETE FROM query_cache WHERE key NOT IN '
+                '(SELECT key FROM query_cache ORDER BY created DESC LIMIT ?)',
+                (self.max_entries,)
+            )
+        except sqlite3.Error as e:
+            logger.error("Unable to write query cache {0}: {1}".format(self.path, e))
+
+    def delete(self, key):
+        ''' drop an entry whose results are stale (ie: the events found got tagged) '''
+        try:
+            self.connect().execute('DELETE FROM query_cache WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logger.error("Unable to write query cache {0}: {1}".format(self.path, e))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
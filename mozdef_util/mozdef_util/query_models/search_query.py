@@ -16,12 +16,22 @@ from .boolean_match import BooleanMatch
 
 
 class SearchQuery(object):
+    # must_not TermMatch on these fields (ie: the alert_names an alert
+    # adds to skip the events it already alerted on) are applied to the
+    # hits of a cached search instead of sent to elasticsearch, so searches
+    # only differing by them share one cache entry
+    client_side_fields = ('alert_names',)
+
     def __init__(self, *args, **kwargs):
         self.date_timedelta = dict(kwargs)
         self.must = []
         self.must_not = []
         self.should = []
         self.aggregation = []
+        self.source_includes = []
+        self.source_excludes = []
+        self.time_range = None
+        self.last_cache_key = None
 
     def append_to_array(self, in_array, in_obj):
         """
@@ -46,25 +56,185 @@ class SearchQuery(object):
     def add_aggregation(self, input_obj):
         self.append_to_array(self.aggregation, input_obj)
 
-    def execute(self, elasticsearch_client, indices=['events', 'events-previous'], size=1000, request_timeout=30):
+    def add_source_include(self, input_obj):
+        """
+        Only return these fields (ie: details.sourceipaddress)
+        of the _source of each hit
+        """
+        self.append_to_array(self.source_includes, input_obj)
+
+    def add_source_exclude(self, input_obj):
+        self.append_to_array(self.source_excludes, input_obj)
+
+    def source_kwargs(self):
+        return {
+            'source_includes': self.source_includes or None,
+            'source_excludes': self.source_excludes or None,
+        }
+
+    def build_query(self, must_not=None):
+        """
+        The time range of date_timedelta is added to the built
+        query only, self.time_range holds the one of the last build
+        must_not replaces self.must_not when given
+        """
+        if must_not is None:
+            must_not = self.must_not
         if self.must == [] and self.must_not == [] and self.should == [] and self.aggregation == []:
             raise AttributeError('Must define a must, must_not, should query, or aggregation')
 
+        must = list(self.must)
+        self.time_range = None
         if self.date_timedelta:
             end_date = toUTC(datetime.now())
             begin_date = toUTC(datetime.now() - timedelta(**self.date_timedelta))
             utc_range_query = RangeMatch('utctimestamp', begin_date, end_date)
             received_range_query = RangeMatch('receivedtimestamp', begin_date, end_date)
-            range_query = utc_range_query | received_range_query
-            self.add_must(range_query)
+            self.time_range = utc_range_query | received_range_query
+            must.append(self.time_range)
 
-        search_query = None
-        search_query = BooleanMatch(must=self.must, must_not=self.must_not, should=self.should)
+        return BooleanMatch(must=must, must_not=must_not, should=self.should)
 
-        results = []
+    def split_client_side_must_not(self):
+        """
+        Split must_not into the queries to send to elasticsearch
+        and the (field, value) of the client_side_fields ones
+        to apply to the hits. Nothing is applied client side
+        with aggregations (their counts can't be filtered) or a
+        projected _source (the fields may not be in the hits)
+        """
+        if self.aggregation or self.source_includes or self.source_excludes:
+            return self.must_not, []
+        must_not = []
+        client_side = []
+        for query in self.must_not:
+            match = query.to_dict().get('match', {})
+            if len(match) == 1 and list(match)[0] in self.client_side_fields:
+                field, value = list(match.items())[0]
+                if isinstance(value, dict):
+                    value = value.get('query')
+                client_side.append((field, value))
+            else:
+                must_not.append(query)
+        return must_not, client_side
+
+    @staticmethod
+    def filter_hits(hits, client_side):
+        """
+        Drop the hits that have one of the (field, value) of client_side
+        """
+        filtered_hits = []
+        for hit in hits:
+            source = hit.get('_source', {})
+            excluded = False
+            for field, value in client_side:
+                field_value = source.get(field)
+                if field_value == value or (isinstance(field_value, list) and value in field_value):
+                    excluded = True
+                    break
+            if not excluded:
+                filtered_hits.append(hit)
+        return filtered_hits
+
+    def cache_key(self, query_cache, indices, size, raw_hits, must_not=None):
+        """
+        Key of this query in query_cache, built without the
+        time range so it's the same for every
+        execute of the same relative window in a cache time bucket
+        must_not replaces self.must_not when given
+        """
+        if must_not is None:
+            must_not = self.must_not
+        return query_cache.key({
+            'must': [query.to_dict() for query in self.must],
+            'must_not': [query.to_dict() for query in must_not],
+            'should': [query.to_dict() for query in self.should],
+            'aggregation': [aggregation.to_dict() for aggregation in self.aggregation],
+            'date_timedelta': self.date_timedelta,
+            'source': self.source_kwargs(),
+            'indices': indices,
+            'size': size,
+            'raw_hits': raw_hits,
+        })
+
+    def execute(self, elasticsearch_client, indices=['events', 'events-previous'], size=1000, request_timeout=30, raw_hits=False, query_cache=None):
+        """
+        raw_hits returns the hits as elasticsearch sent them
+        (including _type) which is
+        cheaper than converting each one
+        query_cache (a QueryCache) returns the results of an identical
+        query executed in the same cache time bucket instead of searching,
+        the must_not of client_side_fields are then applied to the hits.
+        When that leaves out hits of a full page (more than size hits
+        matched), elasticsearch is searched again with them so none of
+        the other matching hits get missed.
+        The key used is kept in self.last_cache_key to invalidate it
+        once the events found are modified
+        """
+        must_not = self.must_not
+        client_side = []
+        cache_key = None
+        if query_cache is not None:
+            must_not, client_side = self.split_client_side_must_not()
+            cache_key = self.cache_key(query_cache, indices, size, raw_hits, must_not)
+        self.last_cache_key = cache_key
+
+        search_query = self.build_query(must_not)
+
+        results = None
+        if cache_key is not None:
+            results = query_cache.get(cache_key)
+
+        if results is None:
+            results = self.search(elasticsearch_client, search_query, indices, size, request_timeout, raw_hits)
+
+            if cache_key is not None:
+                query_cache.set(cache_key, results)
+
+        if client_side:
+            hits = self.filter_hits(results['hits'], client_side)
+            if len(results['hits']) >= size and len(hits) < len(results['hits']):
+                return self.search(elasticsearch_client, self.build_query(), indices, size, request_timeout, raw_hits)
+            results['hits'] = hits
+
+        return results
+
+    def search(self, elasticsearch_client, search_query, indices, size, request_timeout, raw_hits):
         if len(self.aggregation) == 0:
-            results = elasticsearch_client.search(search_query, indices, size, request_timeout)
-        else:
-            results = elasticsearch_client.aggregated_search(search_query, indices, self.aggregation, size, request_timeout)
+            return elasticsearch_client.search(search_query, indices, size, request_timeout, raw_hits=raw_hits, **self.source_kwargs())
+        return elasticsearch_client.aggregated_search(search_query, indices, self.aggregation, size, request_timeout, raw_hits=raw_hits, **self.source_kwargs())
+
+    def execute_iter(self, elasticsearch_client, indices=['events', 'events-previous'], page_size=1000, request_timeout=30, max_hits=None):
+        """
+        Lazily yield every matching hit (same format as the
+        hits of execute) instead of a single page of size results,
+        holding at most page_size hits in memory at a time.
+        Aggregations aren't run, use execute for those.
+        """
+        if self.aggregation != [] and self.must == [] and self.must_not == [] and self.should == []:
+            raise AttributeError('Must define a must, must_not or should query to iterate over')
+        search_query = self.build_query()
+        return elasticsearch_client.search_iter(search_query, indices, page_size, request_timeout, max_hits=max_hits, **self.source_kwargs())
 
+    @staticmethod
+    def execute_multiple(elasticsearch_client, search_queries, indices=['events', 'events-previous'], size=1000, request_timeout=30, batch_size=50):
+        """
+        Execute several SearchQuery objects with one _msearch
+        request per batch_size queries instead of one request each.
+        Returns the results of each query in the same order
+        (None for a query elasticsearch failed to run).
+        """
+        searches = []
+        for search_query in search_queries:
+            searches.append(dict(
+                search_query=search_query.build_query(),
+                indices=indices,
+                size=size,
+                aggregations=search_query.aggregation,
+                **search_query.source_kwargs()
+            ))
+
+        results = []
+        for start in range(0, len(searches), batch_size):
+            results.extend(elasticsearch_client.multi_search(searches[start:start + batch_size], request_timeout))
         return results
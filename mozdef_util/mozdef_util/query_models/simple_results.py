@@ -6,21 +6,27 @@
 # Copyright (c) 2017 Mozilla Corporation
 
 
-def SimpleResults(input_results):
+def hit_dict(hit):
+    return {
+        '_id': hit.meta.id,
+        '_index': hit.meta.index,
+        '_score': hit.meta.score,
+        '_source': hit.to_dict()
+    }
+
+
+def SimpleResults(input_results, raw_hits=False):
     converted_results = {
         'meta': {
             'timed_out': input_results.timed_out,
         },
         'hits': []
     }
-    for hit in input_results.hits:
-        hit_dict = {
-            '_id': hit.meta.id,
-            '_index': hit.meta.index,
-            '_score': hit.meta.score,
-            '_source': hit.to_dict()
-        }
-
-        converted_results['hits'].append(hit_dict)
+    if raw_hits:
+        # the hits as elasticsearch returned them, skipping
+        # the conversion of each one to an elasticsearch_dsl Hit
+        converted_results['hits'] = input_results.to_dict()['hits']['hits']
+    else:
+        converted_results['hits'] = [hit_dict(hit) for hit in input_results.hits]
 
     return converted_results
@@ -7,10 +7,23 @@
 
 
 import ipaddress
+from elasticsearch_dsl import Q
 from .query_string_match import QueryStringMatch
 
 
-def SubnetMatch(key, value):
-    ips = [str(ip) for ip in ipaddress.IPv4Network(value)]
-    subnet_str = "{0}: [{1} TO {2}]".format(key, ips[0], ips[-1])
+def SubnetMatch(key, value, ip_field=False):
+    '''match the IPv4 or IPv6 addresses of key within the value network.
+       ip_field=True sends the network as is in a term query, which
+       Elasticsearch only understands on fields mapped with the ip type
+    '''
+    network = ipaddress.ip_network(value)
+    if ip_field:
+        return Q('term', **{key: str(network)})
+    first = network.network_address
+    last = network.broadcast_address
+    if network.version == 6:
+        # colons have a meaning in query strings
+        subnet_str = '{0}: ["{1}" TO "{2}"]'.format(key, first, last)
+    else:
+        subnet_str = "{0}: [{1} TO {2}]".format(key, first, last)
     return QueryStringMatch(subnet_str)
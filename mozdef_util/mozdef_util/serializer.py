@@ -0,0 +1,36 @@
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonSerializer(JSONSerializer):
+    '''Elasticsearch transport serializer using orjson,
+       falling back to the stock json serializer for anything
+       orjson refuses (ie: integers over 64 bits)
+    '''
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            return super().dumps(data)
+
+
+def get_serializer():
+    '''the fastest serializer available'''
+    if orjson is not None:
+        return OrjsonSerializer()
+    return JSONSerializer()
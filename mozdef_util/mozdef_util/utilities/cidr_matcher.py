@@ -0,0 +1,40 @@
+import ipaddress
+from bisect import bisect_right
+
+
+class CIDRMatcher(object):
+    '''Compiled set of IPv4 and IPv6 networks to check addresses against.
+       Networks are merged into sorted, non overlapping integer intervals
+       per ip version so a lookup is one bisect instead of a comparison
+       with every network.
+       Networks with host bits set (ie: 10.1.1.1/24) are accepted,
+       anything else that isn't a network raises ValueError.
+    '''
+    def __init__(self, networks):
+        intervals = {4: [], 6: []}
+        for network in networks:
+            parsed = ipaddress.ip_network(network, strict=False)
+            intervals[parsed.version].append((int(parsed.network_address), int(parsed.broadcast_address)))
+        self.starts = {}
+        self.ends = {}
+        for version, version_intervals in intervals.items():
+            merged = []
+            for start, end in sorted(version_intervals):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.starts[version] = [start for start, end in merged]
+            self.ends[version] = [end for start, end in merged]
+
+    def __contains__(self, ip):
+        '''ip (a string or ipaddress address) is in one of the networks,
+           False when it isn't an ip address
+        '''
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        value = int(address)
+        position = bisect_right(self.starts[address.version], value) - 1
+        return position >= 0 and value <= self.ends[address.version][position]
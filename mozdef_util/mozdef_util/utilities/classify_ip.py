@@ -0,0 +1,64 @@
+import ipaddress
+from functools import lru_cache
+from typing import NamedTuple
+
+
+class IPClassification(NamedTuple):
+    version: int
+    # True when the text was a network (ie: 10.0.0.0/8), the
+    # classification is then of the first address in the network
+    cidr: bool
+    private: bool
+    loopback: bool
+    reserved: bool
+    # compressed/lowercased form of the address or network
+    text: str
+
+
+@lru_cache(maxsize=10000)
+def parse_ip(ip):
+    try:
+        address = ipaddress.ip_address(ip)
+        cidr = False
+        text = str(address)
+    except ValueError:
+        if '/' not in ip:
+            return None
+        try:
+            network = ipaddress.ip_network(ip, strict=False)
+        except ValueError:
+            return None
+        address = network.network_address
+        cidr = True
+        text = str(network)
+    return IPClassification(
+        version=address.version,
+        cidr=cidr,
+        private=address.is_private,
+        loopback=address.is_loopback,
+        reserved=address.is_reserved,
+        text=text,
+    )
+
+
+def classify_ip(ip, allow_cidr=False):
+    '''Parse an ip address string (or network when allow_cidr is set)
+       into an IPClassification, None if it isn't one.
+       Results are cached since events keep repeating the same addresses.
+    '''
+    if not isinstance(ip, str):
+        return None
+    classification = parse_ip(ip)
+    if classification is None or (classification.cidr and not allow_cidr):
+        return None
+    return classification
+
+
+def is_ipv4(ip, allow_cidr=False):
+    classification = classify_ip(ip, allow_cidr=allow_cidr)
+    return classification is not None and classification.version == 4
+
+
+def is_ipv6(ip, allow_cidr=False):
+    classification = classify_ip(ip, allow_cidr=allow_cidr)
+    return classification is not None and classification.version == 6
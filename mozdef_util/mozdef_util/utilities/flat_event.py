@@ -0,0 +1,64 @@
+class FlatEvent(object):
+    '''Flattened view of an event for matching plugin registrations.
+       keys holds the lowercased keys and values the lowercased string
+       values that dict2List would yield for the event, built in a single
+       pass and reused until mark_dirty() says the event may have changed
+       (ie: a plugin ran on it).
+       String values longer than max_value_length can't equal any
+       registration so they are skipped instead of lowercased
+       (lowercasing never makes a string shorter).
+    '''
+    def __init__(self, event, max_value_length=None):
+        self.event = event
+        self.max_value_length = max_value_length
+        self.version = 0
+        self.flattened_version = None
+        self.keys = set()
+        self.values = set()
+
+    def mark_dirty(self, event=None):
+        '''the event (or its replacement) needs to be flattened again'''
+        if event is not None:
+            self.event = event
+        self.version += 1
+
+    def refresh(self):
+        if self.flattened_version != self.version:
+            self.keys = set()
+            self.values = set()
+            self.flatten(self.event)
+            self.flattened_version = self.version
+
+    def matches(self, tokens):
+        '''the tokens found in the event keys or values'''
+        self.refresh()
+        return self.keys.intersection(tokens).union(self.values.intersection(tokens))
+
+    def add_value(self, value):
+        if isinstance(value, str):
+            if self.max_value_length is None or len(value) <= self.max_value_length:
+                self.values.add(value.lower())
+        else:
+            try:
+                self.values.add(value)
+            except TypeError:
+                # unhashable values can't match a registration
+                pass
+
+    def flatten(self, inObj):
+        if isinstance(inObj, dict):
+            for key, value in inObj.items():
+                if isinstance(value, dict):
+                    self.flatten(value)
+                elif isinstance(value, list):
+                    self.keys.add(key.lower())
+                    self.flatten(value)
+                else:
+                    self.keys.add(key.lower())
+                    self.add_value(value)
+        elif isinstance(inObj, list):
+            for value in inObj:
+                if isinstance(value, (list, dict)):
+                    self.flatten(value)
+                else:
+                    self.add_value(value)
@@ -0,0 +1,236 @@
+from .remove_at import removeAt
+from .toUTC import toUTC
+from .to_unicode import toUnicode
+
+
+# memo of raw key -> normalized key, shippers send the same
+# handful of keys over and over again
+NORMALIZED_KEYS = {}
+NORMALIZED_KEYS_MAX_SIZE = 10000
+
+
+def normalize_key(key):
+    '''strip the leading @ and lowercase a field name'''
+    normalized_key = NORMALIZED_KEYS.get(key)
+    if normalized_key is None:
+        normalized_key = removeAt(key).lower()
+        if len(NORMALIZED_KEYS) >= NORMALIZED_KEYS_MAX_SIZE:
+            NORMALIZED_KEYS.clear()
+        NORMALIZED_KEYS[key] = normalized_key
+    return normalized_key
+
+
+# Field handlers
+# Each handler receives the normalized event being built,
+# the value of the field and the original message
+def map_summary(returndict, value, aDict):
+    returndict["summary"] = toUnicode(value)
+
+
+def map_payload(returndict, value, aDict):
+    if "summary" not in aDict:
+        # special case for heka if it sends payload as well as a summary, keep both but move payload to the details section.
+        returndict["summary"] = toUnicode(value)
+    else:
+        returndict["details"]["payload"] = toUnicode(value)
+
+
+def map_timestamp(returndict, value, aDict):
+    # remember the timestamp format per event source
+    source = aDict.get("source")
+    if not isinstance(source, str):
+        source = None
+    timestamp = toUTC(value, source=source).isoformat()
+    returndict["utctimestamp"] = timestamp
+    returndict["timestamp"] = timestamp
+
+
+def map_hostname(returndict, value, aDict):
+    returndict["hostname"] = toUnicode(value)
+
+
+def map_tags(returndict, value, aDict):
+    if len(value) > 0:
+        returndict["tags"] = value
+
+
+def append_tags(returndict, value, aDict):
+    if "tags" not in returndict:
+        returndict["tags"] = []
+    if type(value) == list:
+        returndict["tags"] += value
+    else:
+        if len(value) > 0:
+            returndict["tags"].append(value)
+
+
+def map_severity(returndict, value, aDict):
+    returndict["severity"] = toUnicode(value).upper()
+
+
+def map_source(returndict, value, aDict):
+    returndict["source"] = toUnicode(value)
+
+
+def map_raw_source(returndict, value, aDict):
+    returndict["source"] = value
+
+
+def map_facility(returndict, value, aDict):
+    returndict["facility"] = toUnicode(value)
+
+
+def map_processid(returndict, value, aDict):
+    returndict["processid"] = toUnicode(value)
+
+
+def map_processname(returndict, value, aDict):
+    returndict["processname"] = toUnicode(value)
+
+
+def map_eventsource(returndict, value, aDict):
+    returndict["eventsource"] = toUnicode(value)
+
+
+def map_category(returndict, value, aDict):
+    returndict["category"] = toUnicode(value)
+
+
+def map_eventsourceipaddress(returndict, value, aDict):
+    returndict["details"]["eventsourceipaddress"] = value
+
+
+def map_details(returndict, value, aDict):
+    # custom fields as a list/array
+    if type(value) is not dict:
+        returndict["details"]["message"] = value
+    else:
+        if len(value) > 0:
+            for details_key, details_value in value.items():
+                returndict["details"][details_key] = details_value
+
+
+def map_dotted_detail(returndict, key, value):
+    # custom fields/details as a one off, not in an array
+    # i.e. fields.something=value or details.something=value
+    # move them to a dict for consistency in querying
+    newName = key.replace("fields.", "")
+    newName = newName.lower().replace("details.", "")
+    # add field with a special case for shippers that
+    # don't send details
+    # in an array as int/floats/strings
+    # we let them dictate the data type with field_datatype
+    # convention
+    if newName.endswith("_int"):
+        returndict["details"][str(newName)] = int(value)
+    elif newName.endswith("_float"):
+        returndict["details"][str(newName)] = float(value)
+    else:
+        returndict["details"][str(newName)] = toUnicode(value)
+
+
+# nxlog windows event fields copied to details, each event id
+# has its own set of fields so copying them all would keep
+# adding new fields to the index mapping
+NXLOG_WINDOWS_DETAILS = (
+    "EventID",
+    "EventType",
+    "Channel",
+    "Domain",
+    "AccountName",
+    "AccountType",
+    "UserID",
+    "SourceModuleName",
+    "SourceModuleType",
+    "SubjectUserName",
+    "SubjectDomainName",
+    "TargetUserName",
+    "TargetDomainName",
+    "LogonType",
+    "IpAddress",
+    "IpPort",
+    "WorkstationName",
+    "RecordNumber",
+)
+
+
+def map_nxlog_windows(aDict, returndict):
+    '''nxlog parses windows event fields very well,
+       copy the ones we know about to details'''
+    if "Domain" in aDict and "SourceModuleType" in aDict:
+        for k in NXLOG_WINDOWS_DETAILS:
+            if k in aDict:
+                returndict["details"][normalize_key(k)] = aDict[k]
+    return returndict
+
+
+class KeyMapping(object):
+    '''Table driven field normalizer.
+       field_handlers maps field names to the handler(s) to run
+       for that field, and is expanded once into a dict keyed by
+       each lowercased field name so normalizing a message is
+       a single dict lookup per key.
+       Keys that aren't in the table but start with fields. or details.
+       are moved into details, anything else goes to default_handler
+       (if set) which receives (returndict, key, value)
+    '''
+    def __init__(self, field_handlers, default_handler=None):
+        self.dispatch = {}
+        for field_names, handler in field_handlers:
+            for field_name in field_names:
+                self.dispatch.setdefault(field_name, []).append(handler)
+        self.default_handler = default_handler
+
+    def map_fields(self, aDict, returndict):
+        '''run every field of aDict through its handlers into returndict'''
+        dispatch = self.dispatch
+        for k, v in aDict.items():
+            k = normalize_key(k)
+            handlers = dispatch.get(k)
+            if handlers is not None:
+                for handler in handlers:
+                    handler(returndict, v, aDict)
+            elif k.startswith("fields.") or k.startswith("details."):
+                map_dotted_detail(returndict, k, v)
+            elif self.default_handler is not None:
+                self.default_handler(returndict, k, v)
+        return returndict
+
+
+# The default mapping used by the mq workers
+# Special accomodations made for logstash,nxlog, beaver, heka and CEF
+DEFAULT_KEY_MAPPING = KeyMapping([
+    (("sourceip",), map_eventsourceipaddress),
+    (("facility", "source"), map_raw_source),
+    (("message", "summary"), map_summary),
+    (("payload",), map_payload),
+    (("eventtime", "timestamp", "utctimestamp", "date"), map_timestamp),
+    (("hostname", "source_host", "host"), map_hostname),
+    (("tags",), append_tags),
+    # nxlog keeps the severity name in syslogseverity,everyone else should use severity or level.
+    (("syslogseverity", "severity", "severityvalue", "level", "priority"), map_severity),
+    (("facility", "syslogfacility"), map_facility),
+    (("pid", "processid"), map_processid),
+    # nxlog sets sourcename to the processname (i.e. sshd), everyone else should call it process name or pname
+    (("pname", "processname", "sourcename", "program"), map_processname),
+    # the file, or source
+    (("path", "logger", "file"), map_eventsource),
+    (("type", "eventtype", "category"), map_category),
+    (("fields", "details"), map_details),
+])
+
+# Mapping used by the sqs based workers (sqs, papertrail)
+SQS_KEY_MAPPING = KeyMapping([
+    (("message", "summary"), map_summary),
+    (("payload",), map_payload),
+    (("eventtime", "timestamp", "utctimestamp"), map_timestamp),
+    (("hostname", "source_host", "host"), map_hostname),
+    (("tags",), map_tags),
+    (("syslogseverity", "severity", "severityvalue", "level"), map_severity),
+    (("facility", "syslogfacility", "source"), map_source),
+    (("pid", "processid"), map_processid),
+    (("pname", "processname", "sourcename"), map_processname),
+    (("path", "logger", "file"), map_eventsource),
+    (("type", "eventtype", "category"), map_category),
+    (("fields", "details"), map_details),
+])
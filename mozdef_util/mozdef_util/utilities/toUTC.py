@@ -2,13 +2,131 @@ from datetime import datetime
 from dateutil.parser import parse
 import pytz
 import math
+import re
 import tzlocal
 
 LOCAL_TIMEZONE = tzlocal.get_localzone()
 
+# Common timestamp formats we can parse strictly with strptime
+# before falling back to dateutil's (much slower) fuzzy parser
+KNOWN_FORMATS = (
+    # RFC3339/ISO-8601
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f%z',
+    '%Y-%m-%d %H:%M:%S%z',
+    '%Y-%m-%d %H:%M:%S %z',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    # RFC 2822
+    '%a, %d %b %Y %H:%M:%S %z',
+    # apache/nginx access logs
+    '%d/%b/%Y:%H:%M:%S %z',
+    # syslog
+    '%b %d %H:%M:%S',
+)
+# formats without a year, like dateutil we assume the current one
+YEARLESS_FORMATS = ('%b %d %H:%M:%S',)
 
-def toUTC(suspectedDate):
-    '''make a UTC date out of almost anything'''
+# datetime.fromisoformat (python 3.7+) is the fastest way to
+# parse most of what we see, so try it first when we have it
+ISO_FORMAT = 'isoformat'
+if hasattr(datetime, 'fromisoformat'):
+    STRICT_FORMATS = (ISO_FORMAT,) + KNOWN_FORMATS
+else:
+    STRICT_FORMATS = KNOWN_FORMATS
+
+# strptime's %a and %b use the names of the current locale,
+# timestamps use the english ones
+ENGLISH_MONTHS = dict(
+    (name, '{0:02d}'.format(number))
+    for number, name in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)
+)
+ENGLISH_WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MONTH_NAME = re.compile(r'(?<![A-Za-z])[A-Za-z]{3}(?![A-Za-z])')
+
+# event source -> format that last parsed a timestamp from it
+# sources come from the events, so the memo is bounded
+DETECTED_FORMATS = {}
+DETECTED_FORMATS_MAX_SIZE = 10000
+
+
+def normalize_offset(suspectedDate):
+    '''python 3.6's %z only understands +HHMM offsets'''
+    if suspectedDate.endswith('Z'):
+        return suspectedDate[:-1] + '+0000'
+    if len(suspectedDate) > 6 and suspectedDate[-3] == ':' and suspectedDate[-6] in '+-':
+        return suspectedDate[:-3] + suspectedDate[-2:]
+    return suspectedDate
+
+
+def replace_english_names(suspectedDate, date_format):
+    '''drop the english day name (%a, ) and swap the english month
+       name (%b) for its number so parsing doesn't depend on the locale
+    '''
+    if date_format.startswith('%a, '):
+        day, separator, suspectedDate = suspectedDate.partition(', ')
+        if day.lower() not in ENGLISH_WEEKDAYS:
+            raise ValueError("unknown day name %r" % day)
+        date_format = date_format[len('%a, '):]
+    if '%b' in date_format:
+        match = MONTH_NAME.search(suspectedDate)
+        month = None
+        if match is not None:
+            month = ENGLISH_MONTHS.get(match.group().lower())
+        if month is None:
+            raise ValueError("no month name in %r" % suspectedDate)
+        suspectedDate = suspectedDate[:match.start()] + month + suspectedDate[match.end():]
+        date_format = date_format.replace('%b', '%m')
+    return (suspectedDate, date_format)
+
+
+def strict_parse(suspectedDate, date_format):
+    if date_format == ISO_FORMAT:
+        return datetime.fromisoformat(suspectedDate)
+    strptime_format = date_format
+    if strptime_format.endswith('%z'):
+        suspectedDate = normalize_offset(suspectedDate)
+    if '%a' in strptime_format or '%b' in strptime_format:
+        (suspectedDate, strptime_format) = replace_english_names(suspectedDate, strptime_format)
+    objDate = datetime.strptime(suspectedDate, strptime_format)
+    if date_format in YEARLESS_FORMATS:
+        objDate = objDate.replace(year=datetime.now().year)
+    return objDate
+
+
+def parseDate(suspectedDate, source=None):
+    '''parse a date string, trying the format last detected for
+       this source, then ISO-8601 and the known formats and only
+       then dateutil's fuzzy parser
+    '''
+    detected_format = DETECTED_FORMATS.get(source)
+    if detected_format is not None:
+        try:
+            return strict_parse(suspectedDate, detected_format)
+        except ValueError:
+            pass
+    for date_format in STRICT_FORMATS:
+        if date_format == detected_format:
+            continue
+        try:
+            objDate = strict_parse(suspectedDate, date_format)
+        except ValueError:
+            continue
+        if source not in DETECTED_FORMATS and len(DETECTED_FORMATS) >= DETECTED_FORMATS_MAX_SIZE:
+            DETECTED_FORMATS.clear()
+        DETECTED_FORMATS[source] = date_format
+        return objDate
+    return parse(suspectedDate, fuzzy=True)
+
+
+def toUTC(suspectedDate, source=None):
+    '''make a UTC date out of almost anything
+       source optionally identifies where the date came from (i.e. the
+       event source) so the detected string format can be reused
+    '''
     utc = pytz.UTC
     objDate = None
     if type(suspectedDate) == datetime:
@@ -40,7 +158,7 @@ def toUTC(suspectedDate):
         except ValueError:
             pass
         if objDate is None:
-            objDate = parse(suspectedDate, fuzzy=True)
+            objDate = parseDate(suspectedDate, source)
     try:
         if objDate.tzinfo is None:
             objDate = LOCAL_TIMEZONE.localize(objDate)
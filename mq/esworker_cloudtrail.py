@@ -28,8 +28,22 @@ from mozdef_util.elasticsearch_client import (
     ElasticsearchException,
 )
 from mozdef_util.utilities.logger import logger, initLogger
-from mozdef_util.utilities.to_unicode import toUnicode
-from mozdef_util.utilities.remove_at import removeAt
+from mozdef_util.utilities.key_mapping import (
+    KeyMapping,
+    map_raw_source,
+    map_summary,
+    map_payload,
+    map_timestamp,
+    map_hostname,
+    append_tags,
+    map_severity,
+    map_facility,
+    map_processid,
+    map_processname,
+    map_eventsource,
+    map_category,
+    map_details,
+)
 
 from lib.aws import get_aws_credentials
 from lib.plugins import sendEventToPlugins, registerPlugins
@@ -38,6 +52,47 @@ from lib.sqs import connect_sqs
 
 CLOUDTRAIL_VERB_REGEX = re.compile(r"^([A-Z][^A-Z]*)")
 
+
+def map_sourceipaddress(returndict, value, aDict):
+    returndict["details"]["sourceipaddress"] = value
+
+
+def map_eventsource_hostname(returndict, value, aDict):
+    returndict["hostname"] = value
+
+
+def map_cloudtrail_category(returndict, value, aDict):
+    map_category(returndict, value, aDict)
+    returndict["type"] = "cloudtrail"
+
+
+def map_unknown_key(returndict, key, value):
+    returndict["details"][key] = value
+
+
+# each key maps to exactly one handler, anything
+# we don't know about is kept as is in details
+CLOUDTRAIL_KEY_MAPPING = KeyMapping([
+    (("sourceip", "sourceipaddress"), map_sourceipaddress),
+    (("facility", "source"), map_raw_source),
+    (("eventsource",), map_eventsource_hostname),
+    (("message", "summary"), map_summary),
+    (("payload",), map_payload),
+    (("eventtime", "timestamp", "utctimestamp", "date"), map_timestamp),
+    (("hostname", "source_host", "host"), map_hostname),
+    (("tags",), append_tags),
+    # nxlog keeps the severity name in syslogseverity,everyone else should use severity or level.
+    (("syslogseverity", "severity", "severityvalue", "level", "priority"), map_severity),
+    (("syslogfacility",), map_facility),
+    (("pid", "processid"), map_processid),
+    # nxlog sets sourcename to the processname (i.e. sshd), everyone else should call it process name or pname
+    (("pname", "processname", "sourcename", "program"), map_processname),
+    # the file, or source
+    (("path", "logger", "file"), map_eventsource),
+    (("type", "eventtype", "category"), map_cloudtrail_category),
+    (("fields", "details"), map_details),
+], default_handler=map_unknown_key)
+
 # running under uwsgi?
 try:
     import uwsgi
@@ -79,103 +134,11 @@ def keyMapping(aDict):
     returndict["receivedtimestamp"] = toUTC(datetime.now()).isoformat()
     returndict["mozdefhostname"] = options.mozdefhostname
     try:
-        for k, v in aDict.items():
-            k = removeAt(k).lower()
-
-            if k == "sourceip":
-                returndict["details"]["sourceipaddress"] = v
-
-            elif k == "sourceipaddress":
-                returndict["details"]["sourceipaddress"] = v
-
-            elif k in ("facility", "source"):
-                returndict["source"] = v
-
-            elif k in ("eventsource"):
-                returndict["hostname"] = v
-
-            elif k in ("message", "summary"):
-                returndict["summary"] = toUnicode(v)
-
-            elif k in ("payload") and "summary" not in aDict:
-                # special case for heka if it sends payload as well as a summary, keep both but move payload to the details section.
-                returndict["summary"] = toUnicode(v)
-            elif k in ("payload"):
-                returndict["details"]["payload"] = toUnicode(v)
-
-            elif k in ("eventtime", "timestamp", "utctimestamp", "date"):
-                returndict["utctimestamp"] = toUTC(v).isoformat()
-                returndict["timestamp"] = toUTC(v).isoformat()
-
-            elif k in ("hostname", "source_host", "host"):
-                returndict["hostname"] = toUnicode(v)
-
-            elif k in ("tags"):
-                if "tags" not in returndict:
-                    returndict["tags"] = []
-                if type(v) == list:
-                    returndict["tags"] += v
-                else:
-                    if len(v) > 0:
-                        returndict["tags"].append(v)
-
-            # nxlog keeps the severity name in syslogseverity,everyone else should use severity or level.
-            elif k in ("syslogseverity", "severity", "severityvalue", "level", "priority"):
-                returndict["severity"] = toUnicode(v).upper()
-
-            elif k in ("facility", "syslogfacility"):
-                returndict["facility"] = toUnicode(v)
-
-            elif k in ("pid", "processid"):
-                returndict["processid"] = toUnicode(v)
-
-            # nxlog sets sourcename to the processname (i.e. sshd), everyone else should call it process name or pname
-            elif k in ("pname", "processname", "sourcename", "program"):
-                returndict["processname"] = toUnicode(v)
-
-            # the file, or source
-            elif k in ("path", "logger", "file"):
-                returndict["eventsource"] = toUnicode(v)
-
-            elif k in ("type", "eventtype", "category"):
-                returndict["category"] = toUnicode(v)
-                returndict["type"] = "cloudtrail"
-
-            # custom fields as a list/array
-            elif k in ("fields", "details"):
-                if type(v) is not dict:
-                    returndict["details"]["message"] = v
-                else:
-                    if len(v) > 0:
-                        for details_key, details_value in v.items():
-                            returndict["details"][details_key] = details_value
-
-            # custom fields/details as a one off, not in an array
-            # i.e. fields.something=value or details.something=value
-            # move them to a dict for consistency in querying
-            elif k.startswith("fields.") or k.startswith("details."):
-                newName = k.replace("fields.", "")
-                newName = newName.lower().replace("details.", "")
-                # add a dict to hold the details if it doesn't exist
-                if "details" not in returndict:
-                    returndict["details"] = dict()
-                # add field with a special case for shippers that
-                # don't send details
-                # in an array as int/floats/strings
-                # we let them dictate the data type with field_datatype
-                # convention
-                if newName.endswith("_int"):
-                    returndict["details"][str(newName)] = int(v)
-                elif newName.endswith("_float"):
-                    returndict["details"][str(newName)] = float(v)
-                else:
-                    returndict["details"][str(newName)] = toUnicode(v)
-            else:
-                returndict["details"][k] = v
+        CLOUDTRAIL_KEY_MAPPING.map_fields(aDict, returndict)
 
         if "utctimestamp" not in returndict:
             # default in case we don't find a reasonable timestamp
-            returndict["utctimestamp"] = toUTC(datetime.now()).isoformat()
+            returndict["utctimestamp"] = returndict["receivedtimestamp"]
 
     except Exception as e:
         logger.exception(e)
@@ -320,16 +283,13 @@ class taskConsumer(object):
             if normalizedDict is None:
                 return
 
-            # make a json version for posting to elastic search
-            jbody = json.JSONEncoder().encode(normalizedDict)
-
             try:
                 bulk = False
                 if options.esbulksize != 0:
                     bulk = True
 
                 bulk = False
-                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=jbody, bulk=bulk)
+                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=normalizedDict, bulk=bulk)
 
             except (ElasticsearchBadServer, ElasticsearchInvalidIndex) as e:
                 # handle loss of server or race condition with index rotation/creation/aliasing
@@ -10,6 +10,7 @@ import json
 import kombu
 import sys
 import socket
+import time
 from configlib import getConfig, OptionParser
 from datetime import datetime
 from kombu import Connection, Queue, Exchange
@@ -24,8 +25,7 @@ from mozdef_util.elasticsearch_client import (
 
 from mozdef_util.utilities.toUTC import toUTC
 from mozdef_util.utilities.logger import logger, initLogger
-from mozdef_util.utilities.to_unicode import toUnicode
-from mozdef_util.utilities.remove_at import removeAt
+from mozdef_util.utilities.key_mapping import DEFAULT_KEY_MAPPING, map_nxlog_windows
 
 from lib.plugins import sendEventToPlugins, registerPlugins
 
@@ -57,97 +57,14 @@ def keyMapping(aDict):
     returndict["mozdefhostname"] = options.mozdefhostname
     returndict["details"] = {}
     try:
-        for k, v in aDict.items():
-            k = removeAt(k).lower()
-
-            if k == "sourceip":
-                returndict["details"]["eventsourceipaddress"] = v
-
-            if k in ("facility", "source"):
-                returndict["source"] = v
-
-            if k in ("message", "summary"):
-                returndict["summary"] = toUnicode(v)
-
-            if k in ("payload") and "summary" not in aDict:
-                # special case for heka if it sends payload as well as a summary, keep both but move payload to the details section.
-                returndict["summary"] = toUnicode(v)
-            elif k in ("payload"):
-                returndict["details"]["payload"] = toUnicode(v)
-
-            if k in ("eventtime", "timestamp", "utctimestamp", "date"):
-                returndict["utctimestamp"] = toUTC(v).isoformat()
-                returndict["timestamp"] = toUTC(v).isoformat()
-
-            if k in ("hostname", "source_host", "host"):
-                returndict["hostname"] = toUnicode(v)
-
-            if k in ("tags"):
-                if "tags" not in returndict:
-                    returndict["tags"] = []
-                if type(v) == list:
-                    returndict["tags"] += v
-                else:
-                    if len(v) > 0:
-                        returndict["tags"].append(v)
-
-            # nxlog keeps the severity name in syslogseverity,everyone else should use severity or level.
-            if k in ("syslogseverity", "severity", "severityvalue", "level", "priority"):
-                returndict["severity"] = toUnicode(v).upper()
-
-            if k in ("facility", "syslogfacility"):
-                returndict["facility"] = toUnicode(v)
-
-            if k in ("pid", "processid"):
-                returndict["processid"] = toUnicode(v)
-
-            # nxlog sets sourcename to the processname (i.e. sshd), everyone else should call it process name or pname
-            if k in ("pname", "processname", "sourcename", "program"):
-                returndict["processname"] = toUnicode(v)
-
-            # the file, or source
-            if k in ("path", "logger", "file"):
-                returndict["eventsource"] = toUnicode(v)
-
-            if k in ("type", "eventtype", "category"):
-                returndict["category"] = toUnicode(v)
-
-            # custom fields as a list/array
-            if k in ("fields", "details"):
-                if type(v) is not dict:
-                    returndict["details"]["message"] = v
-                else:
-                    if len(v) > 0:
-                        for details_key, details_value in v.items():
-                            returndict["details"][details_key] = details_value
-
-            # custom fields/details as a one off, not in an array
-            # i.e. fields.something=value or details.something=value
-            # move them to a dict for consistency in querying
-            if k.startswith("fields.") or k.startswith("details."):
-                newName = k.replace("fields.", "")
-                newName = newName.lower().replace("details.", "")
-                # add field with a special case for shippers that
-                # don't send details
-                # in an array as int/floats/strings
-                # we let them dictate the data type with field_datatype
-                # convention
-                if newName.endswith("_int"):
-                    returndict["details"][str(newName)] = int(v)
-                elif newName.endswith("_float"):
-                    returndict["details"][str(newName)] = float(v)
-                else:
-                    returndict["details"][str(newName)] = toUnicode(v)
+        DEFAULT_KEY_MAPPING.map_fields(aDict, returndict)
 
         # nxlog windows log handling
-        if "Domain" in aDict and "SourceModuleType" in aDict:
-            # nxlog parses all windows event fields very well
-            # copy all fields to details
-            returndict["details"][k] = v
+        map_nxlog_windows(aDict, returndict)
 
         if "utctimestamp" not in returndict:
             # default in case we don't find a reasonable timestamp
-            returndict["utctimestamp"] = toUTC(datetime.now()).isoformat()
+            returndict["utctimestamp"] = returndict["receivedtimestamp"]
 
         if "type" not in returndict:
             # default replacement for old _type subcategory.
@@ -164,7 +81,13 @@ def keyMapping(aDict):
 
 def esConnect():
     """open or re-open a connection to elastic search"""
-    return ElasticsearchClient((list("{0}".format(s) for s in options.esservers)), options.esbulksize)
+    return ElasticsearchClient(
+        (list("{0}".format(s) for s in options.esservers)),
+        options.esbulksize,
+        bulk_max_bytes=options.esbulkmaxbytes,
+        bulk_max_in_flight=options.esbulkinflight,
+        bulk_threads=options.esbulkthreads
+    )
 
 
 class taskConsumer(ConsumerMixin):
@@ -174,51 +97,67 @@ class taskConsumer(ConsumerMixin):
         self.taskQueue = taskQueue
         self.topicExchange = topicExchange
         self.mqproducer = self.connection.Producer(serializer="json")
+        # (message, event) tuples waiting to be indexed in batch mode
+        self.batch = []
+        self.batchStarted = time.time()
+        # seconds to wait before handing a failed batch back to the queue
+        self.backoff = 0
         if hasUWSGI:
             self.muleid = uwsgi.mule_id()
         else:
             self.muleid = 0
 
     def get_consumers(self, Consumer, channel):
+        if options.batchmode:
+            callbacks = [self.on_batch_message]
+        else:
+            callbacks = [self.on_message]
         consumer = Consumer(
-            self.taskQueue, callbacks=[self.on_message], accept=["json", "text/plain"], no_ack=(not options.mqack)
+            self.taskQueue, callbacks=callbacks, accept=["json", "text/plain"], no_ack=(not options.mqack)
         )
         consumer.qos(prefetch_count=options.prefetch)
         return [consumer]
 
-    def on_message(self, body, message):
-        # print("RECEIVED MESSAGE: %r" % (body, ))
-        try:
-            # default elastic search metadata for an event
-            metadata = {"index": "events", "id": None}
-            # just to be safe..check what we were sent.
-            if isinstance(body, dict):
-                bodyDict = body
-            elif isinstance(body, str):
-                try:
-                    bodyDict = json.loads(body)  # lets assume it's json
-                except ValueError as e:
-                    # not json..ack but log the message
-                    logger.error("Exception: unknown body type received: %r" % body)
-                    message.ack()
-                    return
-            else:
+    def normalize_message(self, body):
+        """turn a message body into a normalized event dict
+           and send it through the plugins.
+           returns a (normalizedDict, metadata) tuple where
+           normalizedDict is None if the message should be dropped
+        """
+        # default elastic search metadata for an event
+        metadata = {"index": "events", "id": None}
+        # just to be safe..check what we were sent.
+        if isinstance(body, dict):
+            bodyDict = body
+        elif isinstance(body, str):
+            try:
+                bodyDict = json.loads(body)  # lets assume it's json
+            except ValueError as e:
+                # not json..ack but log the message
                 logger.error("Exception: unknown body type received: %r" % body)
-                message.ack()
-                return
+                return (None, metadata)
+        else:
+            logger.error("Exception: unknown body type received: %r" % body)
+            return (None, metadata)
 
-            if "customendpoint" in bodyDict and bodyDict["customendpoint"]:
-                # custom document
-                # send to plugins to allow them to modify it if needed
-                (normalizedDict, metadata) = sendEventToPlugins(bodyDict, metadata, pluginList)
-            else:
-                # normalize the dict
-                # to the mozdef events standard
-                normalizedDict = keyMapping(bodyDict)
+        if "customendpoint" in bodyDict and bodyDict["customendpoint"]:
+            # custom document
+            # send to plugins to allow them to modify it if needed
+            (normalizedDict, metadata) = sendEventToPlugins(bodyDict, metadata, pluginList)
+        else:
+            # normalize the dict
+            # to the mozdef events standard
+            normalizedDict = keyMapping(bodyDict)
+
+            # send to plugins to allow them to modify it if needed
+            if normalizedDict is not None and isinstance(normalizedDict, dict):
+                (normalizedDict, metadata) = sendEventToPlugins(normalizedDict, metadata, pluginList)
+        return (normalizedDict, metadata)
 
-                # send to plugins to allow them to modify it if needed
-                if normalizedDict is not None and isinstance(normalizedDict, dict):
-                    (normalizedDict, metadata) = sendEventToPlugins(normalizedDict, metadata, pluginList)
+    def on_message(self, body, message):
+        # print("RECEIVED MESSAGE: %r" % (body, ))
+        try:
+            (normalizedDict, metadata) = self.normalize_message(body)
 
             # drop the message if a plug in set it to None
             # signaling a discard
@@ -226,15 +165,12 @@ class taskConsumer(ConsumerMixin):
                 message.ack()
                 return
 
-            # make a json version for posting to elastic search
-            jbody = json.JSONEncoder().encode(normalizedDict)
-
             try:
                 bulk = False
                 if options.esbulksize != 0:
                     bulk = True
 
-                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=jbody, bulk=bulk)
+                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=normalizedDict, bulk=bulk)
 
             except (ElasticsearchBadServer, ElasticsearchInvalidIndex) as e:
                 # handle loss of server or race condition with index rotation/creation/aliasing
@@ -270,6 +206,99 @@ class taskConsumer(ConsumerMixin):
             logger.exception(e)
             logger.error("Malformed message body: %r" % body)
 
+    def on_batch_message(self, body, message):
+        """batch mode: normalize the message and hold it
+           until we have a full batch (prefetch messages)
+           to index with one bulk request and ack at once
+        """
+        try:
+            (normalizedDict, metadata) = self.normalize_message(body)
+        except Exception as e:
+            logger.exception(e)
+            logger.error("Malformed message body: %r" % body)
+            message.ack()
+            return
+
+        if normalizedDict is None:
+            message.ack()
+        else:
+            if not self.batch:
+                self.batchStarted = time.time()
+            self.batch.append((message, {"body": normalizedDict, "index": metadata["index"], "doc_id": metadata["id"]}))
+
+        if len(self.batch) >= options.prefetch:
+            self.flush_batch()
+
+    def on_iteration(self):
+        # called by the consumer loop between message deliveries
+        # flush a partial batch once it has waited long enough
+        if self.batch and time.time() - self.batchStarted >= options.batchtimeout:
+            self.flush_batch()
+
+    def flush_batch(self):
+        """index the current batch with a single bulk request
+           and ack the messages only once elastic search confirmed them
+        """
+        batch = self.batch
+        self.batch = []
+        if not batch:
+            return
+        try:
+            results = self.esConnection.save_events([event for (message, event) in batch])
+        except Exception as e:
+            # nothing was confirmed, hand the whole batch back to the queue
+            logger.exception("Exception while bulk indexing a batch of %d events: %r" % (len(batch), e))
+            self.requeue_messages([message for (message, event) in batch])
+            try:
+                self.esConnection = esConnect()
+            except Exception as e:
+                # elastic search is still down, keep consuming and
+                # reconnect after the next batch fails again
+                logger.exception("Unable to reconnect to elastic search: %r" % e)
+            return
+
+        lastIndexed = None
+        retry = []
+        for (message, event), (indexed, info) in zip(batch, results):
+            if indexed:
+                lastIndexed = message
+            elif info.get("status") in (429, 503, "N/A"):
+                # elastic search is busy or unreachable, try this one again later
+                retry.append(message)
+            else:
+                # elastic search rejected the document itself, retrying won't help
+                logger.error("Dropping event rejected by elastic search: %r" % event["body"])
+                if options.mqack:
+                    message.ack()
+        if retry:
+            # requeue before the multiple ack below would settle these deliveries too
+            self.requeue_messages(retry)
+        else:
+            self.backoff = 0
+        if lastIndexed is not None and options.mqack:
+            # acks every outstanding delivery on the channel up to and including this one
+            lastIndexed.ack(multiple=True)
+
+    def requeue_messages(self, messages):
+        """hand messages elastic search did not take back to the queue,
+           waiting a little longer after each consecutive failure
+           so an outage doesn't turn into a redelivery loop
+        """
+        self.backoff = min(max(self.backoff * 2, 1), options.batchbackoff)
+        if not options.mqack:
+            # no_ack consumers had their messages acked on delivery,
+            # there is nothing left to requeue
+            logger.error("Unable to index %d events, lost since mqack is disabled" % len(messages))
+            time.sleep(self.backoff)
+            return
+        logger.error("Requeueing %d events in %d seconds" % (len(messages), self.backoff))
+        time.sleep(self.backoff)
+        for message in messages:
+            try:
+                message.requeue()
+            except kombu.exceptions.MessageStateError as e:
+                logger.exception("RabbitMQ exception (message lost) while requeueing event: %r" % e)
+
 
 def main():
     # connect and declare the message queue/kombu objects.
@@ -330,6 +359,13 @@ def initConfig():
     options.esservers = list(getConfig("esservers", "http://localhost:9200", options.configfile).split(","))
     options.esbulksize = getConfig("esbulksize", 0, options.configfile)
     options.esbulktimeout = getConfig("esbulktimeout", 30, options.configfile)
+    # flush the bulk queue once it holds this many bytes of events (0 to only flush on esbulksize)
+    options.esbulkmaxbytes = getConfig("esbulkmaxbytes", 0, options.configfile)
+    # number of bulk requests allowed to be indexing in the background while we keep
+    # normalizing events, 0 to send each bulk request before processing more events
+    options.esbulkinflight = getConfig("esbulkinflight", 0, options.configfile)
+    # number of connections used to send each bulk request's chunks in parallel
+    options.esbulkthreads = getConfig("esbulkthreads", 1, options.configfile)
 
     # message queue options
     options.mqserver = getConfig("mqserver", "localhost", options.configfile)
@@ -347,6 +383,14 @@ def initConfig():
     # also toggles transient/persistant delivery (messages in memory only or stored on disk)
     # ack=True sets persistant delivery, False sets transient delivery
     options.mqack = getConfig("mqack", True, options.configfile)
+    # batch mode: index up to prefetch messages with a single bulk request
+    # and ack them together once elastic search has confirmed them.
+    # batchtimeout is how many seconds a partial batch waits before it is flushed
+    options.batchmode = getConfig("batchmode", False, options.configfile)
+    options.batchtimeout = getConfig("batchtimeout", 1, options.configfile)
+    # batchbackoff caps the seconds waited before requeueing a batch elastic search
+    # did not take, the wait doubles with each consecutive failed batch
+    options.batchbackoff = getConfig("batchbackoff", 30, options.configfile)
 
 
 if __name__ == "__main__":
@@ -90,15 +90,12 @@ class PubSubtaskConsumer(object):
             if event is None:
                 return
 
-            # make a json version for posting to elastic search
-            jbody = json.JSONEncoder().encode(event)
-
             try:
                 bulk = False
                 if self.options.esbulksize != 0:
                     bulk = True
 
-                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=jbody, bulk=bulk)
+                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=event, bulk=bulk)
 
             except (ElasticsearchBadServer, ElasticsearchInvalidIndex) as e:
                 # handle loss of server or race condition with index rotation/creation/aliasing
@@ -110,7 +107,7 @@ class PubSubtaskConsumer(object):
                     return
             except ElasticsearchException as e:
                 logger.exception("ElasticSearchException: {0} reported while indexing event".format(e))
-                logger.error("Malformed jbody: %r" % jbody)
+                logger.error("Malformed event: %r" % event)
                 return
         except Exception as e:
             logger.exception(e)
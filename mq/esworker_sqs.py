@@ -21,8 +21,7 @@ import base64
 from ssl import SSLEOFError, SSLError
 
 from mozdef_util.utilities.toUTC import toUTC
-from mozdef_util.utilities.to_unicode import toUnicode
-from mozdef_util.utilities.remove_at import removeAt
+from mozdef_util.utilities.key_mapping import SQS_KEY_MAPPING, map_nxlog_windows
 from mozdef_util.utilities.logger import logger, initLogger
 from mozdef_util.elasticsearch_client import (
     ElasticsearchClient,
@@ -62,86 +61,14 @@ def keyMapping(aDict):
     returndict["mozdefhostname"] = options.mozdefhostname
     returndict["details"] = {}
     try:
-        for k, v in aDict.items():
-            k = removeAt(k).lower()
-
-            if k in ("message", "summary"):
-                returndict["summary"] = toUnicode(v)
-
-            if k in ("payload") and "summary" not in aDict:
-                # special case for heka if it sends payload as well as a summary, keep both but move payload to the details section.
-                returndict["summary"] = toUnicode(v)
-            elif k in ("payload"):
-                returndict["details"]["payload"] = toUnicode(v)
-
-            if k in ("eventtime", "timestamp", "utctimestamp"):
-                returndict["utctimestamp"] = toUTC(v).isoformat()
-                returndict["timestamp"] = toUTC(v).isoformat()
-
-            if k in ("hostname", "source_host", "host"):
-                returndict["hostname"] = toUnicode(v)
-
-            if k in ("tags"):
-                if len(v) > 0:
-                    returndict["tags"] = v
-
-            # nxlog keeps the severity name in syslogseverity,everyone else should use severity or level.
-            if k in ("syslogseverity", "severity", "severityvalue", "level"):
-                returndict["severity"] = toUnicode(v).upper()
-
-            if k in ("facility", "syslogfacility", "source"):
-                returndict["source"] = toUnicode(v)
-
-            if k in ("pid", "processid"):
-                returndict["processid"] = toUnicode(v)
-
-            # nxlog sets sourcename to the processname (i.e. sshd), everyone else should call it process name or pname
-            if k in ("pname", "processname", "sourcename"):
-                returndict["processname"] = toUnicode(v)
-
-            # the file, or source
-            if k in ("path", "logger", "file"):
-                returndict["eventsource"] = toUnicode(v)
-
-            if k in ("type", "eventtype", "category"):
-                returndict["category"] = toUnicode(v)
-
-            # custom fields as a list/array
-            if k in ("fields", "details"):
-                if type(v) is not dict:
-                    returndict["details"]["message"] = v
-                else:
-                    if len(v) > 0:
-                        for details_key, details_value in v.items():
-                            returndict["details"][details_key] = details_value
-
-            # custom fields/details as a one off, not in an array
-            # i.e. fields.something=value or details.something=value
-            # move them to a dict for consistency in querying
-            if k.startswith("fields.") or k.startswith("details."):
-                newName = k.replace("fields.", "")
-                newName = newName.lower().replace("details.", "")
-                # add field with a special case for shippers that
-                # don't send details
-                # in an array as int/floats/strings
-                # we let them dictate the data type with field_datatype
-                # convention
-                if newName.endswith("_int"):
-                    returndict["details"][str(newName)] = int(v)
-                elif newName.endswith("_float"):
-                    returndict["details"][str(newName)] = float(v)
-                else:
-                    returndict["details"][str(newName)] = toUnicode(v)
+        SQS_KEY_MAPPING.map_fields(aDict, returndict)
 
         # nxlog windows log handling
-        if "Domain" in aDict and "SourceModuleType" in aDict:
-            # nxlog parses all windows event fields very well
-            # copy all fields to details
-            returndict["details"][k] = v
+        map_nxlog_windows(aDict, returndict)
 
         if "utctimestamp" not in returndict:
             # default in case we don't find a reasonable timestamp
-            returndict["utctimestamp"] = toUTC(datetime.now()).isoformat()
+            returndict["utctimestamp"] = returndict["receivedtimestamp"]
 
         if "type" not in returndict:
             # default replacement for old _type subcategory.
@@ -270,15 +197,12 @@ class taskConsumer(object):
                 # message.ack()
                 return
 
-            # make a json version for posting to elastic search
-            jbody = json.JSONEncoder().encode(normalizedDict)
-
             try:
                 bulk = False
                 if options.esbulksize != 0:
                     bulk = True
 
-                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=jbody, bulk=bulk)
+                self.esConnection.save_event(index=metadata["index"], doc_id=metadata["id"], body=normalizedDict, bulk=bulk)
 
             except (ElasticsearchBadServer, ElasticsearchInvalidIndex) as e:
                 # handle loss of server or race condition with index rotation/creation/aliasing
@@ -12,10 +12,48 @@ from datetime import datetime
 import pynsive
 import importlib
 
-from mozdef_util.utilities.dict2List import dict2List
+from mozdef_util.utilities.flat_event import FlatEvent
 from mozdef_util.utilities.logger import logger
 
 
+class PluginRouter(list):
+    '''priority ordered list of (module,registration,priority) tuples
+       with an inverted index from each lowercased registration token
+       to the positions of the plugins registered for it.
+       Built once when plugins are (re)registered so that events
+       only need to be flattened and looked up, not compared against
+       every plugin registration.
+    '''
+    def __init__(self, plugins=()):
+        super().__init__(sorted(plugins, key=itemgetter(2), reverse=False))
+        self.token_index = {}
+        self.plugin_names = []
+        for position, plugin in enumerate(self):
+            self.plugin_names.append(plugin[0].__module__.replace('plugins.', ''))
+            if isinstance(plugin[1], list):
+                for token in set([item.lower() for item in plugin[1]]):
+                    self.token_index.setdefault(token, []).append(position)
+        self.max_token_length = max([len(token) for token in self.token_index] or [0])
+
+    def flatten(self, anevent):
+        '''a FlatEvent of anevent to pass to matching_plugins'''
+        return FlatEvent(anevent, max_value_length=self.max_token_length)
+
+    def matching_plugins(self, anevent, start=0):
+        '''return the sorted positions (at or after start)
+           of the plugins registered for any token in the event
+           (an event dict or a FlatEvent from flatten())
+        '''
+        if not isinstance(anevent, FlatEvent):
+            anevent = self.flatten(anevent)
+        positions = set()
+        for token in anevent.matches(self.token_index):
+            for position in self.token_index[token]:
+                if position >= start:
+                    positions.add(position)
+        return sorted(positions)
+
+
 def sendEventToPlugins(anevent, metadata, pluginList):
     '''compare the event to the plugin registrations.
        plugins register with a list of keys or values
@@ -28,28 +66,36 @@ def sendEventToPlugins(anevent, metadata, pluginList):
         raise TypeError('event is type {0}, should be a dict'.format(type(anevent)))
 
     # expecting tuple of module,criteria,priority in pluginList
-    # sort the plugin list by priority
+    # plain lists are indexed on the fly, registerPlugins() returns
+    # an already indexed PluginRouter
+    if not isinstance(pluginList, PluginRouter):
+        pluginList = PluginRouter(pluginList)
+
     executed_plugins = []
-    for plugin in sorted(pluginList, key=itemgetter(2), reverse=False):
-        # assume we don't run this event through the plugin
-        send = False
-        if isinstance(plugin[1], list):
-            try:
-                plugin_matching_keys = set([item.lower() for item in plugin[1]])
-                event_tokens = [e for e in dict2List(anevent)]
-                if plugin_matching_keys.intersection(event_tokens):
-                    send = True
-            except TypeError:
-                logger.error('TypeError on set intersection for dict {0}'.format(anevent))
-                return (anevent, metadata)
-        if send:
-            (anevent, metadata) = plugin[0].onMessage(anevent, metadata)
-            if anevent is None:
-                # plug-in is signalling to drop this message
-                # early exit
-                return (anevent, metadata)
-            plugin_name = plugin[0].__module__.replace('plugins.', '')
-            executed_plugins.append(plugin_name)
+    # flattened once, and again only after a plugin ran on the event
+    flat_event = pluginList.flatten(anevent)
+    try:
+        pending = pluginList.matching_plugins(flat_event)
+    except TypeError:
+        logger.error('TypeError on set intersection for dict {0}'.format(anevent))
+        return (anevent, metadata)
+    while pending:
+        position = pending[0]
+        plugin = pluginList[position]
+        (anevent, metadata) = plugin[0].onMessage(anevent, metadata)
+        if anevent is None:
+            # plug-in is signalling to drop this message
+            # early exit
+            return (anevent, metadata)
+        executed_plugins.append(pluginList.plugin_names[position])
+        # the plugin may have changed the event
+        # so re-match the plugins that have yet to run
+        flat_event.mark_dirty(anevent)
+        try:
+            pending = pluginList.matching_plugins(flat_event, start=position + 1)
+        except TypeError:
+            logger.error('TypeError on set intersection for dict {0}'.format(anevent))
+            return (anevent, metadata)
     # Tag all events with what plugins ran on it
     anevent['plugins'] = executed_plugins
 
@@ -78,7 +124,7 @@ def registerPlugins():
                     if isinstance(mreg, list):
                         logger.info('[*] plugin {0} registered to receive messages with {1}'.format(mname, mreg))
                         pluginList.append((mclass, mreg, mpriority))
-    return pluginList
+    return PluginRouter(pluginList)
 
 
 def checkPlugins(pluginList, lastPluginCheck, checkFrequency):
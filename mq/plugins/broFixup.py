@@ -3,40 +3,18 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 # Copyright (c) 2017 Mozilla Corporation
 
-import netaddr
 import json
 from datetime import datetime
 from platform import node
 from mozdef_util.utilities.toUTC import toUTC
 from mozdef_util.utilities.key_exists import key_exists
-
-
-def isIPv4(ip):
-    try:
-        # netaddr on it's own considers 1 and 0 to be valid_ipv4
-        # so a little sanity check prior to netaddr.
-        # Use IPNetwork instead of valid_ipv4 to allow CIDR
-        if '.' in ip and len(ip.split('.'))==4:
-            # some ips are quoted
-            netaddr.IPNetwork(ip)
-            return True
-        else:
-            return False
-    except:
-        return False
-
-
-def isIPv6(ip):
-    try:
-        return netaddr.valid_ipv6(ip)
-    except:
-        return False
+from mozdef_util.utilities.classify_ip import is_ipv4, is_ipv6
 
 
 def findIPv4(words):
     for word in words.strip().split():
         saneword = word.strip().strip('"').strip("'").strip(",")
-        if isIPv4(saneword):
+        if is_ipv4(saneword, allow_cidr=True):
             yield saneword
 
 
@@ -97,16 +75,17 @@ class message(object):
             del(newmessage['details']['resp_cc'])
 
         # add mandatory fields
+        now = toUTC(datetime.now()).isoformat()
         if 'ts' in newmessage['details']:
             newmessage['utctimestamp'] = toUTC(float(newmessage['details']['ts'])).isoformat()
-            newmessage['timestamp'] = toUTC(float(newmessage['details']['ts'])).isoformat()
+            newmessage['timestamp'] = newmessage['utctimestamp']
             # del(newmessage['details']['ts'])
         else:
             # a malformed message somehow managed to crawl to us, let's put it somewhat together
-            newmessage['utctimestamp'] = toUTC(datetime.now()).isoformat()
-            newmessage['timestamp'] = toUTC(datetime.now()).isoformat()
+            newmessage['utctimestamp'] = now
+            newmessage['timestamp'] = now
 
-        newmessage['receivedtimestamp'] = toUTC(datetime.now()).isoformat()
+        newmessage['receivedtimestamp'] = now
         newmessage['eventsource'] = 'nsm'
         newmessage['severity'] = 'INFO'
         newmessage['mozdefhostname'] = self.mozdefhostname
@@ -388,12 +367,12 @@ class message(object):
                     # remove the details.src field and add it to indicators
                     # as it may not be the actual source.
                     if 'src' in newmessage['details']:
-                        if isIPv4(newmessage['details']['src']):
+                        if is_ipv4(newmessage['details']['src'], allow_cidr=True):
                             newmessage['details']['indicators'].append(newmessage['details']['src'])
                             # If details.src is present overwrite the source IP address with it
                             newmessage['details']['sourceipaddress'] = newmessage['details']['src']
                             newmessage['details']['sourceipv4address'] = newmessage['details']['src']
-                        if isIPv6(newmessage['details']['src']):
+                        if is_ipv6(newmessage['details']['src']):
                             newmessage['details']['indicators'].append(newmessage['details']['src'])
                             # If details.src is present overwrite the source IP address with it
                             newmessage['details']['sourceipv6address'] = newmessage['details']['src']
@@ -410,10 +389,10 @@ class message(object):
                     if 'dst' in newmessage['details']:
                         sumstruct['dst'] = newmessage['details']['dst']
                         del(newmessage['details']['dst'])
-                        if isIPv4(sumstruct['dst']):
+                        if is_ipv4(sumstruct['dst'], allow_cidr=True):
                             newmessage['details']['destinationipaddress'] = sumstruct['dst']
                             newmessage['details']['destinationipv4address'] = sumstruct['dst']
-                        if isIPv6(sumstruct['dst']):
+                        if is_ipv6(sumstruct['dst']):
                             newmessage['details']['destinationipv6address'] = sumstruct['dst']
                     else:
                         sumstruct['dst'] = 'unknown'
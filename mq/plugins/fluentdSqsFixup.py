@@ -5,15 +5,8 @@
 #
 # This script copies the format/handling mechanism of ipFixup.py (git f5734b0c7e412424b44a6d7af149de6250fc70a2)
 
-import netaddr
 from mozdef_util.utilities.toUTC import toUTC
-
-
-def isIPv4(ip):
-    try:
-        return netaddr.valid_ipv4(ip)
-    except:
-        return False
+from mozdef_util.utilities.classify_ip import is_ipv4
 
 
 def addError(message, error):
@@ -68,7 +61,7 @@ class message(object):
             tmp = message['host']
             if tmp.startswith('ip-'):
                 ipText = tmp.split('ip-')[1].replace('-', '.')
-                if isIPv4(ipText):
+                if is_ipv4(ipText):
                     if 'destinationipaddress' not in message:
                         message['details']['destinationipaddress'] = ipText
                     if 'destinationipv4address' not in message:
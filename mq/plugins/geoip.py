@@ -3,18 +3,10 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 # Copyright (c) 2014 Mozilla Corporation
 
-import netaddr
 import os
 
 from mozdef_util.geo_ip import GeoIP
-
-
-def isIP(ip):
-    try:
-        netaddr.IPNetwork(ip)
-        return True
-    except:
-        return False
+from mozdef_util.utilities.classify_ip import classify_ip
 
 
 class message(object):
@@ -48,9 +40,9 @@ class message(object):
                 ip_key = '{0}ipaddress'.format(key)
                 if ip_key in message['details']:
                     ipText = message['details'][ip_key]
-                    if isIP(ipText):
-                        ip = netaddr.IPNetwork(ipText)[0]
-                        if (not ip.is_loopback() and not ip.is_private() and not ip.is_reserved()):
+                    ip = classify_ip(ipText, allow_cidr=True)
+                    if ip is not None:
+                        if (not ip.loopback and not ip.private and not ip.reserved):
                             '''lookup geoip info'''
                             geo_key = '{0}ipgeolocation'.format(key)
                             message['details'][geo_key] = self.ipLocation(ipText)
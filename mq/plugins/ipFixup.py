@@ -3,21 +3,7 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 # Copyright (c) 2014 Mozilla Corporation
 
-import netaddr
-
-
-def isIPv4(ip):
-    try:
-        return netaddr.valid_ipv4(ip)
-    except:
-        return False
-
-
-def isIPv6(ip):
-    try:
-        return netaddr.valid_ipv6(ip)
-    except:
-        return False
+from mozdef_util.utilities.classify_ip import is_ipv4, is_ipv6
 
 
 def addError(message, error):
@@ -60,20 +46,20 @@ class message(object):
             if 'http_x_forwarded_for' in message['details']:
                 # should be a comma delimited list of ips with the original client listed first
                 ipText = message['details']['http_x_forwarded_for'].split(',')[0]
-                if isIPv4(ipText) and 'sourceipaddress' not in message['details']:
+                if is_ipv4(ipText) and 'sourceipaddress' not in message['details']:
                     message['details']['sourceipaddress'] = ipText
-                if isIPv4(ipText) and 'sourceipv4address' not in message['details']:
+                if is_ipv4(ipText) and 'sourceipv4address' not in message['details']:
                     message['details']['sourceipv4address'] = ipText
-                if isIPv6(ipText) and 'sourceipv6address' not in message['details']:
+                if is_ipv6(ipText) and 'sourceipv6address' not in message['details']:
                     message['details']['sourceipv6address'] = ipText
 
             if 'sourceipaddress' in message['details']:
                 ipText = message['details']['sourceipaddress']
-                if isIPv6(ipText):
+                if is_ipv6(ipText):
                     message['details']['sourceipv6address'] = ipText
                     message['details']['sourceipaddress'] = '0.0.0.0'
                     addError(message, 'plugin: {0} error: {1}'.format('ipFixUp.py', 'sourceipaddress is ipv6, moved'))
-                elif isIPv4(ipText):
+                elif is_ipv4(ipText):
                     message['details']['sourceipv4address'] = ipText
                 else:
                     # Smells like a hostname, let's save it as source field
@@ -82,11 +68,11 @@ class message(object):
 
             if 'destinationipaddress' in message['details']:
                 ipText = message['details']['destinationipaddress']
-                if isIPv6(ipText):
+                if is_ipv6(ipText):
                     message['details']['destinationipv6address'] = ipText
                     message['details']['destinationipaddress'] = '0.0.0.0'
                     addError(message, 'plugin: {0} error: {1}'.format('ipFixUp.py', 'destinationipaddress is ipv6, moved'))
-                elif isIPv4(ipText):
+                elif is_ipv4(ipText):
                     message['details']['destinationipv4address'] = ipText
                 else:
                     # Smells like a hostname, let's save it as destination field
@@ -95,40 +81,40 @@ class message(object):
 
             if 'src' in message['details']:
                 ipText = message['details']['src']
-                if isIPv4(ipText):
+                if is_ipv4(ipText):
                     message['details']['sourceipaddress'] = ipText
                     message['details']['sourceipv4address'] = ipText
-                if isIPv6(ipText):
+                if is_ipv6(ipText):
                     message['details']['sourceipv6address'] = ipText
 
             if 'srcip' in message['details']:
                 ipText = message['details']['srcip']
-                if isIPv4(ipText):
+                if is_ipv4(ipText):
                     message['details']['sourceipaddress'] = ipText
                     message['details']['sourceipv4address'] = ipText
-                if isIPv6(ipText):
+                if is_ipv6(ipText):
                     message['details']['sourceipv6address'] = ipText
             if 'dst' in message['details']:
                 ipText = message['details']['dst']
-                if isIPv4(ipText):
+                if is_ipv4(ipText):
                     message['details']['destinationipaddress'] = ipText
                     message['details']['destinationipv4address'] = ipText
-                if isIPv6(ipText):
+                if is_ipv6(ipText):
                     message['details']['destinationipv6address'] = ipText
 
             if 'dstip' in message['details']:
                 ipText = message['details']['dstip']
-                if isIPv4(ipText):
+                if is_ipv4(ipText):
                     message['details']['destinationipaddress'] = ipText
                     message['details']['destinationipv4address'] = ipText
-                if isIPv6(ipText):
+                if is_ipv6(ipText):
                     message['details']['destinationipv6address'] = ipText
 
             if 'cluster_client_ip' in message['details']:
                 ipText = message['details']['cluster_client_ip']
-                if isIPv4(ipText):
+                if is_ipv4(ipText):
                     message['details']['sourceipaddress'] = ipText
-                if isIPv6(ipText):
+                if is_ipv6(ipText):
                     message['details']['sourceipv6address'] = ipText
 
         return (message, metadata)
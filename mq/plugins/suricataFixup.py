@@ -66,16 +66,17 @@ class message(object):
         eventtype = newmessage['event_type']
 
         # add mandatory fields
+        now = toUTC(datetime.now()).isoformat()
         if 'flow' in newmessage['details']:
             if 'start' in newmessage['details']['flow']:
-                newmessage['utctimestamp'] = toUTC(newmessage['details']['flow']['start']).isoformat()
-                newmessage['timestamp'] = toUTC(newmessage['details']['flow']['start']).isoformat()
+                newmessage['utctimestamp'] = toUTC(newmessage['details']['flow']['start'], source='suricata').isoformat()
+                newmessage['timestamp'] = newmessage['utctimestamp']
         else:
             # a malformed message somehow managed to crawl to us, let's put it somewhat together
-            newmessage['utctimestamp'] = toUTC(datetime.now()).isoformat()
-            newmessage['timestamp'] = toUTC(datetime.now()).isoformat()
+            newmessage['utctimestamp'] = now
+            newmessage['timestamp'] = now
 
-        newmessage['receivedtimestamp'] = toUTC(datetime.now()).isoformat()
+        newmessage['receivedtimestamp'] = now
         newmessage['eventsource'] = 'nsm'
         newmessage['severity'] = 'INFO'
         newmessage['mozdefhostname'] = self.mozdefhostname
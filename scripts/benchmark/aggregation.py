@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+# Copyright (c) 2017 Mozilla Corporation
+
+# Micro-benchmark of the client side grouping done by
+# AlertTask.searchEventsAggregated on a synthetic search result.
+# Compares the previous Counter + rescan per value with
+# the single pass groupEventsByValue, in seconds per search.
+
+import optparse
+import os
+import random
+import sys
+import timeit
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../alerts'))
+
+from lib.alerttask import getValueByPath, groupEventsByValue  # noqa: E402
+
+
+AGGREGATION_PATH = 'details.sourceipaddress'
+
+
+def legacy_group(results, aggregationPath, samplesLimit):
+    '''the grouping searchEventsAggregated used before groupEventsByValue'''
+    aggregationValues = []
+    for r in results:
+        aggregationValues.append(getValueByPath(r["_source"], aggregationPath))
+
+    aggregationList = []
+    for i in Counter(aggregationValues).most_common():
+        idict = {"value": i[0], "count": i[1], "events": [], "allevents": []}
+        for r in results:
+            if getValueByPath(r["_source"], aggregationPath) == i[0]:
+                if len(idict["events"]) < samplesLimit:
+                    idict["events"].append(r)
+                idict["allevents"].append(r)
+        aggregationList.append(idict)
+    return aggregationList
+
+
+def synthetic_hits(num_hits, num_values):
+    hits = []
+    for num in range(num_hits):
+        hits.append({
+            '_id': str(num),
+            '_index': 'events',
+            '_source': {
+                'summary': 'synthetic event {0}'.format(num),
+                'details': {
+                    'sourceipaddress': '10.0.{0}.{1}'.format(*divmod(random.randrange(num_values), 256)),
+                },
+            },
+        })
+    return hits
+
+
+parser = optparse.OptionParser()
+parser.add_option('--hits', type='int', help='Number of search hits (default: 10000)', default=10000)
+parser.add_option('--values', type='int', help='Number of distinct aggregation values (default: 5000)', default=5000)
+parser.add_option('--samples', type='int', help='samplesLimit (default: 10)', default=10)
+parser.add_option('--iterations', type='int', help='Number of runs to average (default: 3)', default=3)
+options, arguments = parser.parse_args()
+
+hits = synthetic_hits(options.hits, options.values)
+assert legacy_group(hits, AGGREGATION_PATH, options.samples) == groupEventsByValue(hits, AGGREGATION_PATH, options.samples)
+
+for name, function in (('Counter + rescan', legacy_group), ('single pass', groupEventsByValue)):
+    seconds = timeit.timeit(lambda: function(hits, AGGREGATION_PATH, options.samples), number=options.iterations)
+    print('{0:>16}: {1:>10.4f} sec/search'.format(name, seconds / options.iterations))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+# Copyright (c) 2017 Mozilla Corporation
+
+# Micro-benchmark of the mq worker key normalization.
+# Compares the previous chain of tuple membership checks
+# with the table driven KeyMapping, in events/sec.
+
+import optparse
+import timeit
+
+from mozdef_util.utilities.key_mapping import DEFAULT_KEY_MAPPING
+from mozdef_util.utilities.remove_at import removeAt
+from mozdef_util.utilities.to_unicode import toUnicode
+
+
+SAMPLE_EVENTS = [
+    {
+        'CATEGORY': 'syslog',
+        'FACILITY': 'daemon',
+        'HOST': 'ub_server',
+        'HOST_FROM': '10.1.20.139',
+        'LEGACY_MSGHDR': 'systemd[1]: ',
+        'MESSAGE': 'Stopped Getty on tty1.',
+        'PID': '1',
+        'PRIORITY': 'info',
+        'PROGRAM': 'systemd',
+        'SEQNUM': '8',
+        'SOURCE': 'syslog_tcp',
+        'SOURCEIP': '10.1.20.139',
+        'TAGS': '.source.syslog_tcp',
+    },
+    {
+        '@version': '1',
+        'category': 'example',
+        'hostname': 'somehost',
+        'processname': 'someprocess',
+        'severity': 'info',
+        'summary': 'example summary',
+        'tags': ['tag1', 'tag2'],
+        'details': {
+            'sourceipaddress': '1.2.3.4',
+            'username': 'tester',
+        },
+        'fields.count_int': '3',
+    },
+]
+
+
+def legacy_map_fields(aDict, returndict):
+    '''the if chain keyMapping used before KeyMapping, minus timestamps'''
+    for k, v in aDict.items():
+        k = removeAt(k).lower()
+        if k == "sourceip":
+            returndict["details"]["eventsourceipaddress"] = v
+        if k in ("facility", "source"):
+            returndict["source"] = v
+        if k in ("message", "summary"):
+            returndict["summary"] = toUnicode(v)
+        if k in ("payload") and "summary" not in aDict:
+            returndict["summary"] = toUnicode(v)
+        elif k in ("payload"):
+            returndict["details"]["payload"] = toUnicode(v)
+        if k in ("hostname", "source_host", "host"):
+            returndict["hostname"] = toUnicode(v)
+        if k in ("tags"):
+            if "tags" not in returndict:
+                returndict["tags"] = []
+            if type(v) == list:
+                returndict["tags"] += v
+            else:
+                if len(v) > 0:
+                    returndict["tags"].append(v)
+        if k in ("syslogseverity", "severity", "severityvalue", "level", "priority"):
+            returndict["severity"] = toUnicode(v).upper()
+        if k in ("facility", "syslogfacility"):
+            returndict["facility"] = toUnicode(v)
+        if k in ("pid", "processid"):
+            returndict["processid"] = toUnicode(v)
+        if k in ("pname", "processname", "sourcename", "program"):
+            returndict["processname"] = toUnicode(v)
+        if k in ("path", "logger", "file"):
+            returndict["eventsource"] = toUnicode(v)
+        if k in ("type", "eventtype", "category"):
+            returndict["category"] = toUnicode(v)
+        if k in ("fields", "details"):
+            if type(v) is not dict:
+                returndict["details"]["message"] = v
+            else:
+                if len(v) > 0:
+                    for details_key, details_value in v.items():
+                        returndict["details"][details_key] = details_value
+        if k.startswith("fields.") or k.startswith("details."):
+            newName = k.replace("fields.", "")
+            newName = newName.lower().replace("details.", "")
+            if newName.endswith("_int"):
+                returndict["details"][str(newName)] = int(v)
+            elif newName.endswith("_float"):
+                returndict["details"][str(newName)] = float(v)
+            else:
+                returndict["details"][str(newName)] = toUnicode(v)
+    return returndict
+
+
+def run_legacy():
+    for event in SAMPLE_EVENTS:
+        legacy_map_fields(event, {'details': {}})
+
+
+def run_key_mapping():
+    for event in SAMPLE_EVENTS:
+        DEFAULT_KEY_MAPPING.map_fields(event, {'details': {}})
+
+
+parser = optparse.OptionParser()
+parser.add_option('--iterations', type='int', help='Number of passes over the sample events (default: 50000)', default=50000)
+options, arguments = parser.parse_args()
+
+num_events = options.iterations * len(SAMPLE_EVENTS)
+for name, function in (('legacy if chain', run_legacy), ('KeyMapping', run_key_mapping)):
+    seconds = timeit.timeit(function, number=options.iterations)
+    print('{0:>16}: {1:>10.0f} events/sec'.format(name, num_events / seconds))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+# Copyright (c) 2017 Mozilla Corporation
+
+# Micro-benchmark of the GeoModel alert's locality.update for users
+# that accumulated many localities (heavy travel, VPN exits).
+# Compares the previous scan of every stored locality with
+# the LocalityGrid lookup of neighbouring cells, in seconds per user.
+
+import optparse
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../alerts'))
+
+from geomodel import locality  # noqa: E402
+
+
+def legacy_update(state, from_evt):
+    '''the update locality.update did before LocalityGrid'''
+    did_update = False
+
+    for loc1 in from_evt.localities:
+        did_find = False
+
+        for (index, loc2) in enumerate(state.localities):
+            dist = locality.distance(loc1, loc2)
+
+            if dist <= min(loc1.radius, loc2.radius):
+                if loc1.lastaction > loc2.lastaction or loc1.sourceipaddress != loc2.sourceipaddress:
+                    state.localities[index] = loc1
+                    did_update = True
+                did_find = True
+                break
+
+        if not did_find:
+            state.localities.append(loc1)
+            did_update = True
+
+    return locality.Update(state, did_update)
+
+
+def synthetic_localities(num_localities, start):
+    localities = []
+    for num in range(num_localities):
+        localities.append(locality.Locality(
+            sourceipaddress='10.{0}.{1}.{2}'.format(num // 65536, (num // 256) % 256, num % 256),
+            city='City {0}'.format(num),
+            country='XX',
+            lastaction=start + timedelta(seconds=num),
+            latitude=random.uniform(-80, 80),
+            longitude=random.uniform(-180, 180),
+            radius=50))
+    return localities
+
+
+def copy_state(state):
+    return locality.State(state.type_, state.username, list(state.localities))
+
+
+parser = optparse.OptionParser()
+parser.add_option('--localities', type='int', help='Number of stored localities per user (default: 2000)', default=2000)
+parser.add_option('--events', type='int', help='Number of new localities per user (default: 200)', default=200)
+parser.add_option('--users', type='int', help='Number of users (default: 5)', default=5)
+options, arguments = parser.parse_args()
+
+now = datetime.utcnow()
+users = []
+for num in range(options.users):
+    stored = synthetic_localities(options.localities, now - timedelta(days=1))
+    # half of the new localities revisit a stored one, the rest are new places
+    revisits = [
+        loc._replace(lastaction=now, latitude=loc.latitude + 0.01)
+        for loc in random.sample(stored, options.events // 2)
+    ]
+    new_places = synthetic_localities(options.events - len(revisits), now)
+    users.append((
+        locality.State('locality', 'user{0}'.format(num), stored),
+        locality.State('locality', 'user{0}'.format(num), revisits + new_places),
+    ))
+
+for (state, from_evt) in users:
+    assert legacy_update(copy_state(state), from_evt) == locality.update(copy_state(state), from_evt)
+
+for name, function in (('list scan', legacy_update), ('grid cells', locality.update)):
+    seconds = timeit.timeit(
+        lambda: [function(copy_state(state), from_evt) for (state, from_evt) in users],
+        number=1)
+    print('{0:>12}: {1:>10.4f} sec/user'.format(name, seconds / options.users))
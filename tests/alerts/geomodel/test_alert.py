@@ -2,7 +2,7 @@ from datetime import datetime, timedelta
 
 from mozdef_util.utilities.toUTC import toUTC
 
-from alerts.geomodel.alert import alert
+from alerts.geomodel.alert import alert, alerts, travel_possible
 import alerts.geomodel.locality as locality
 
 
@@ -97,3 +97,71 @@ class TestAlert:
         assert alert_produced.hops[0].destination.city == 'Saint Petersburg'
         assert alert_produced.hops[1].origin.city == 'Saint Petersburg'
         assert alert_produced.hops[1].destination.city == 'Toronto'
+
+    def test_batch_matches_single_user_alerts(self):
+        now = toUTC(datetime.now())
+
+        toronto = locality.Locality(
+            sourceipaddress='1.2.3.123',
+            city='Toronto',
+            country='CA',
+            lastaction=now - timedelta(minutes=5),
+            latitude=43.6529,
+            longitude=-79.3849,
+            radius=50)
+        san_francisco = locality.Locality(
+            sourceipaddress='123.3.2.1',
+            city='San Francisco',
+            country='US',
+            lastaction=now - timedelta(hours=1),
+            latitude=37.773972,
+            longitude=-122.431297,
+            radius=50)
+        san_francisco_earlier = san_francisco._replace(
+            lastaction=now - timedelta(hours=10))
+
+        users = [
+            ('impossible', [toronto, san_francisco], []),
+            ('nothing', [], []),
+            ('possible', [toronto], [san_francisco_earlier]),
+            ('from_es', [toronto], [san_francisco]),
+        ]
+
+        produced = alerts(users)
+
+        assert produced == [alert(*user) for user in users]
+        assert [a.username if a else None for a in produced] == [
+            'impossible', None, None, 'from_es'
+        ]
+        assert produced[3].hops[0].origin.city == 'San Francisco'
+
+        # enough pairs to be checked with numpy
+        many_users = users * 20
+        assert alerts(many_users) == produced * 20
+
+    def test_travel_possible_mask(self):
+        now = toUTC(datetime.now())
+
+        toronto = locality.Locality(
+            sourceipaddress='1.2.3.123',
+            city='Toronto',
+            country='CA',
+            lastaction=now,
+            latitude=43.6529,
+            longitude=-79.3849,
+            radius=50)
+        berlin = locality.Locality(
+            sourceipaddress='32.64.128.255',
+            city='Berlin',
+            country='DE',
+            lastaction=now - timedelta(hours=1),
+            latitude=52.520008,
+            longitude=13.404954,
+            radius=50)
+
+        mask = travel_possible(
+            [berlin, berlin._replace(lastaction=now - timedelta(days=1)), toronto],
+            [toronto, toronto, toronto])
+
+        assert mask.tolist() == [False, True, True]
+        assert travel_possible([], []).tolist() == []
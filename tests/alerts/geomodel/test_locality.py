@@ -1,8 +1,12 @@
 from datetime import datetime, timedelta
+import importlib
+import random
 from typing import Optional
 
+import mock
+import pytz
+
 from mozdef_util.utilities.toUTC import toUTC
-from mozdef_util.query_models import SearchQuery
 
 import alerts.geomodel.config as config
 import alerts.geomodel.locality as locality
@@ -14,7 +18,7 @@ def query_interface(results: locality.Entry) -> locality.QueryInterface:
     '''Produce a `QueryInterface` that just returns the provided results.
     '''
 
-    def closure(q: SearchQuery, esi: str) -> Optional[locality.Entry]:
+    def closure(eid: str, esi: str) -> Optional[locality.Entry]:
         return results
 
     return closure
@@ -25,42 +29,35 @@ class TestLocalityElasticSearch(UnitTestSuite):
     '''
 
     def test_simple_query(self):
-        objs = [
-            {
-                'type_': 'locality',
-                'username': 'tester1',
-                'localities': [
-                    {
-                        'sourceipaddress': '1.2.3.4',
-                        'city': 'Toronto',
-                        'country': 'CA',
-                        'lastaction': toUTC(datetime.now()),
-                        'latitude': 43.6529,
-                        'longitude': -79.3849,
-                        'radius': 50
-                    }
-                ]
-            }
-        ]
-
-        for obj in objs:
-            self.populate_test_event(obj)
+        journal = locality.wrap_journal(self.es_client)
 
-        self.refresh(self.event_index_name)
+        journal(locality.Entry.new(locality.State('locality', 'tester1', [
+            locality.Locality(
+                sourceipaddress='1.2.3.4',
+                city='Toronto',
+                country='CA',
+                lastaction=toUTC(datetime.now()),
+                latitude=43.6529,
+                longitude=-79.3849,
+                radius=50)
+        ])), self.event_index_name)
 
+        # Entries are retrieved with a real-time get, no refresh needed.
         query_iface = locality.wrap_query(self.es_client)
         loc_cfg = config.Localities(self.event_index_name, 30, 50.0)
 
         entry = locality.find(query_iface, 'tester1', loc_cfg.es_index)
 
         assert entry is not None
+        assert entry.identifier == locality.entry_id('tester1')
         assert entry.state.username == 'tester1'
+        assert entry.state.localities[0].city == 'Toronto'
 
     def test_journaling(self):
         journal = locality.wrap_journal(self.es_client)
 
-        test_entry = locality.Entry(
-            'testingid1', locality.State('locality', 't1', [
+        test_entry = locality.Entry.new(
+            locality.State('locality', 't1', [
                 locality.Locality(
                     sourceipaddress='1.2.3.4',
                     city='Toronto',
@@ -91,6 +88,32 @@ class TestLocalityElasticSearch(UnitTestSuite):
         assert entry is not None
         assert entry.state.username == 't1'
 
+    def test_journaling_replaces_state(self):
+        journal = locality.wrap_journal(self.es_client)
+
+        journal(locality.Entry.new(
+            locality.State('locality', 't1', [])), self.event_index_name)
+        journal(locality.Entry('', locality.State('locality', 't1', [
+            locality.Locality(
+                sourceipaddress='1.2.3.4',
+                city='Toronto',
+                country='CA',
+                lastaction=toUTC(datetime.now()),
+                latitude=43.6529,
+                longitude=-79.3849,
+                radius=50)
+        ])), self.event_index_name)
+
+        self.refresh(self.event_index_name)
+
+        hits = self.es_client.es_connection.search(
+            index=self.event_index_name,
+            body={'query': {'term': {'username': 't1'}}})['hits']['hits']
+
+        assert len(hits) == 1
+        assert hits[0]['_id'] == locality.entry_id('t1')
+        assert len(hits[0]['_source']['localities']) == 1
+
 
 class TestLocality:
     '''unit tests for the `locality` module.
@@ -157,6 +180,68 @@ class TestLocality:
         assert update.did_update
         assert sorted(cities) == ['Berlin', 'Toronto']
 
+    def test_update_replaces_first_locality_within_radius(self):
+        from_es = locality.State('locality', 'user1', [
+            locality.Locality(
+                sourceipaddress='32.64.128.255',
+                city='Berlin',
+                country='DE',
+                lastaction=toUTC(datetime.now()) - timedelta(days=3),
+                latitude=52.520008,
+                longitude=13.404954,
+                radius=50),
+            locality.Locality(
+                sourceipaddress='1.2.3.4',
+                city='Toronto',
+                country='CA',
+                lastaction=toUTC(datetime.now()) - timedelta(days=3),
+                latitude=43.6529,
+                longitude=-79.3849,
+                radius=50),
+            locality.Locality(
+                sourceipaddress='1.2.3.5',
+                city='Toronto',
+                country='CA',
+                lastaction=toUTC(datetime.now()) - timedelta(days=2),
+                latitude=43.7,
+                longitude=-79.4,
+                radius=50)
+        ])
+
+        from_events = locality.State('locality', 'user1', [
+            locality.Locality(
+                sourceipaddress='1.2.3.6',
+                city='Toronto',
+                country='CA',
+                lastaction=toUTC(datetime.now()) - timedelta(minutes=30),
+                latitude=43.6529,
+                longitude=-79.3849,
+                radius=50)
+        ])
+
+        update = locality.update(from_es, from_events)
+        addresses = [loc.sourceipaddress for loc in update.state.localities]
+
+        assert update.did_update
+        assert addresses == ['32.64.128.255', '1.2.3.6', '1.2.3.5']
+
+    def test_distance_matrix_matches_distance(self):
+        points = [
+            locality.Coordinates(43.6529, -79.3849),
+            locality.Coordinates(52.520008, 13.404954),
+            locality.Coordinates(37.773972, -122.431297),
+        ]
+
+        matrix = locality.distance_matrix(points, points[1:])
+        pairwise = locality.distances(points[1:], points[:2])
+
+        assert matrix.shape == (3, 2)
+        for (i, origin) in enumerate(points):
+            for (j, destination) in enumerate(points[1:]):
+                assert abs(matrix[i][j] - locality.distance(origin, destination)) < 1e-6
+        assert abs(pairwise[0] - locality.distance(points[1], points[0])) < 1e-6
+        assert matrix[1][0] == 0.0
+
     def test_remove_outdated_removes_old_localities(self):
         test_state = locality.State('locality', 'tester1', [
             locality.Locality(
@@ -248,3 +333,281 @@ class TestLocality:
 
         assert loc.sourceipaddress == '1.2.3.4'
         assert loc.lastaction.day == 31
+
+
+class TestLocalityBatches:
+    '''unit tests for loading and journaling many users' states at once.
+    '''
+
+    def state_source(self, username):
+        return {
+            'type_': 'locality',
+            'username': username,
+            'localities': [
+                {
+                    'sourceipaddress': '1.2.3.4',
+                    'city': 'Toronto',
+                    'country': 'CA',
+                    'lastaction': '2019-07-31T17:56:38.908000+00:00',
+                    'latitude': 43.6529,
+                    'longitude': -79.3849,
+                    'radius': 50
+                }
+            ]
+        }
+
+    def test_entry_id_is_stable(self):
+        assert locality.entry_id('tester1') == locality.entry_id('tester1')
+        assert locality.entry_id('tester1') != locality.entry_id('tester2')
+
+    def test_new_entry_uses_entry_id(self):
+        entry = locality.Entry.new(locality.State('locality', 'tester1', []))
+
+        assert entry.identifier == locality.entry_id('tester1')
+
+    def test_find_gets_by_id(self):
+        client = mock.Mock()
+        client.get_objects_by_ids.return_value = {
+            locality.entry_id('tester1'): {
+                '_id': locality.entry_id('tester1'),
+                '_source': self.state_source('tester1')
+            }
+        }
+
+        entry = locality.find(locality.wrap_query(client), 'tester1', 'localities')
+        missing = locality.find(locality.wrap_query(client), 'tester2', 'localities')
+
+        assert entry.state.username == 'tester1'
+        assert missing is None
+        client.get_objects_by_ids.assert_called_with(
+            [locality.entry_id('tester2')], 'localities')
+        assert not client.search.called
+
+    def test_load_many_gets_by_id(self):
+        client = mock.Mock()
+        client.get_objects_by_ids.return_value = {
+            locality.entry_id('tester1'): {
+                '_id': locality.entry_id('tester1'),
+                '_source': self.state_source('tester1')
+            }
+        }
+        client.search_iter.return_value = iter([])
+
+        entries = locality.wrap_load_many(client)(['tester1', 'tester2'], 'localities')
+
+        assert list(entries.keys()) == ['tester1']
+        assert entries['tester1'].identifier == locality.entry_id('tester1')
+        assert entries['tester1'].state.localities[0].lastaction.day == 31
+        ids, index = client.get_objects_by_ids.call_args[0]
+        assert sorted(ids) == sorted([locality.entry_id('tester1'), locality.entry_id('tester2')])
+        assert index == 'localities'
+        # only the users not found by id are searched for
+        query = client.search_iter.call_args[0][0].to_dict()
+        assert {'terms': {'username': ['tester2']}} in query['bool']['must']
+
+    def test_load_many_moves_searched_states_to_derived_id(self):
+        client = mock.Mock()
+        client.get_objects_by_ids.return_value = {}
+        client.search_iter.return_value = iter([
+            {'_id': 'randomid', '_source': self.state_source('tester2')}
+        ])
+
+        entries = locality.wrap_load_many(client)(['tester2'], 'localities')
+
+        assert entries['tester2'].identifier == locality.entry_id('tester2')
+        assert entries['tester2'].state.username == 'tester2'
+
+    def test_load_many_keeps_most_recent_duplicate(self):
+        older = self.state_source('tester2')
+        newer = self.state_source('tester2')
+        newer['localities'][0]['lastaction'] = '2019-08-31T17:56:38.908000+00:00'
+
+        client = mock.Mock()
+        client.get_objects_by_ids.return_value = {}
+        client.search_iter.return_value = iter([
+            {'_id': 'randomid1', '_source': older},
+            {'_id': 'randomid2', '_source': newer},
+            {'_id': 'randomid3', '_source': self.state_source('tester2')}
+        ])
+
+        entries = locality.wrap_load_many(client)(['tester2'], 'localities')
+
+        assert entries['tester2'].state.localities[0].lastaction.month == 8
+
+    def test_load_many_records_legacy_ids(self):
+        client = mock.Mock()
+        client.get_objects_by_ids.return_value = {}
+        client.search_iter.return_value = iter([
+            {'_id': 'randomid1', '_source': self.state_source('tester2')},
+            {'_id': 'randomid2', '_source': self.state_source('tester2')}
+        ])
+
+        entries = locality.wrap_load_many(client)(['tester2'], 'localities')
+
+        assert entries['tester2'].legacy_identifiers == ('randomid1', 'randomid2')
+
+    def test_load_many_duplicates_without_localities_east_of_utc(self):
+        empty = self.state_source('tester2')
+        empty['localities'] = []
+
+        client = mock.Mock()
+        client.get_objects_by_ids.return_value = {}
+        client.search_iter.return_value = iter([
+            {'_id': 'randomid1', '_source': empty},
+            {'_id': 'randomid2', '_source': self.state_source('tester2')}
+        ])
+
+        # the toUTC function shadows its module in mozdef_util.utilities
+        toUTC_module = importlib.import_module('mozdef_util.utilities.toUTC')
+
+        with mock.patch.object(toUTC_module, 'LOCAL_TIMEZONE', pytz.timezone('Asia/Tokyo')):
+            entries = locality.wrap_load_many(client)(['tester2'], 'localities')
+
+        assert len(entries['tester2'].state.localities) == 1
+
+    def test_journal_many_deletes_legacy_documents(self):
+        client = mock.Mock()
+        client.save_documents.side_effect = lambda documents: {
+            'succeeded': [doc for doc in documents if doc['_id'] != locality.entry_id('tester3')],
+            'retried': [],
+            'dropped': [doc for doc in documents if doc['_id'] == locality.entry_id('tester3')]
+        }
+        entries = [
+            locality.Entry(
+                locality.entry_id('tester2'),
+                locality.State('locality', 'tester2', []),
+                ('randomid1', 'randomid2')),
+            locality.Entry(
+                locality.entry_id('tester3'),
+                locality.State('locality', 'tester3', []),
+                ('randomid3',)),
+            locality.Entry.new(locality.State('locality', 'tester4', []))
+        ]
+
+        locality.wrap_journal_many(client)(entries, 'localities')
+
+        assert client.save_documents.call_count == 2
+        deletions = client.save_documents.call_args[0][0]
+        # tester3's state wasn't saved under its derived id, its legacy one is kept
+        assert deletions == [
+            {'_op_type': 'delete', '_index': 'localities', '_id': 'randomid1'},
+            {'_op_type': 'delete', '_index': 'localities', '_id': 'randomid2'}
+        ]
+
+    def test_journal_many_single_bulk(self):
+        client = mock.Mock()
+        entries = [
+            locality.Entry('someid', locality.State('locality', 'tester1', [
+                locality.Locality(
+                    sourceipaddress='1.2.3.4',
+                    city='Toronto',
+                    country='CA',
+                    lastaction=toUTC(datetime.now()),
+                    latitude=43.6529,
+                    longitude=-79.3849,
+                    radius=50)
+            ])),
+            locality.Entry('', locality.State('locality', 'tester2', []))
+        ]
+
+        locality.wrap_journal_many(client)(entries, 'localities')
+        locality.wrap_journal_many(client)([], 'localities')
+
+        assert client.save_documents.call_count == 1
+        documents = client.save_documents.call_args[0][0]
+        assert [doc['_id'] for doc in documents] == ['someid', locality.entry_id('tester2')]
+        assert documents[0]['_index'] == 'localities'
+        assert documents[0]['_source']['localities'][0]['city'] == 'Toronto'
+
+
+class TestLocalityGrid:
+    '''unit tests for the grid cell index used to match localities.
+    '''
+
+    def locality_at(self, latitude, longitude, radius=50):
+        return locality.Locality(
+            sourceipaddress='1.2.3.4',
+            city='Somewhere',
+            country='XX',
+            lastaction=toUTC(datetime.now()),
+            latitude=latitude,
+            longitude=longitude,
+            radius=radius)
+
+    def test_near_finds_every_locality_within_radius(self):
+        random.seed(1)
+        localities = [
+            self.locality_at(random.uniform(-90, 90), random.uniform(-180, 180))
+            for _ in range(2000)
+        ]
+        grid = locality.LocalityGrid(localities, 500)
+
+        points = [
+            self.locality_at(random.uniform(-90, 90), random.uniform(-180, 180))
+            for _ in range(50)
+        ] + [
+            self.locality_at(0.0, 179.99),
+            self.locality_at(0.0, -179.99),
+            self.locality_at(89.9, 10.0),
+            self.locality_at(-89.9, -10.0),
+        ]
+
+        for point in points:
+            near = grid.near(point)
+            within = [
+                index
+                for (index, loc) in enumerate(localities)
+                if locality.distance(point, loc) <= 500
+            ]
+
+            assert near == sorted(near)
+            assert set(within).issubset(near)
+
+    def test_near_across_antimeridian(self):
+        localities = [self.locality_at(0.0, 179.9), self.locality_at(0.0, 0.0)]
+        grid = locality.LocalityGrid(localities, 50)
+
+        assert grid.near(self.locality_at(0.0, -179.9)) == [0]
+
+    def test_add_and_remove(self):
+        grid = locality.LocalityGrid([], 50)
+        toronto = self.locality_at(43.6529, -79.3849)
+
+        grid.add(3, toronto)
+        assert grid.near(toronto) == [3]
+
+        grid.remove(3, toronto)
+        assert grid.near(toronto) == []
+
+    def test_update_matches_list_scan(self):
+        random.seed(2)
+        now = toUTC(datetime.now())
+        stored = [
+            self.locality_at(random.uniform(-60, 60), random.uniform(-180, 180), random.choice([20, 50, 200]))._replace(
+                lastaction=now - timedelta(days=1),
+                sourceipaddress='10.0.0.{0}'.format(num % 256))
+            for num in range(500)
+        ]
+        new = [
+            loc._replace(lastaction=now, latitude=loc.latitude + 0.05)
+            for loc in random.sample(stored, 50)
+        ] + [
+            self.locality_at(random.uniform(-60, 60), random.uniform(-180, 180))
+            for _ in range(50)
+        ]
+
+        expected = list(stored)
+        for loc1 in new:
+            for (index, loc2) in enumerate(expected):
+                if locality.distance(loc1, loc2) <= min(loc1.radius, loc2.radius):
+                    expected[index] = loc1
+                    break
+            else:
+                expected.append(loc1)
+
+        update = locality.update(
+            locality.State('locality', 'user1', list(stored)),
+            locality.State('locality', 'user1', new))
+
+        assert update.did_update
+        assert update.state.localities == expected
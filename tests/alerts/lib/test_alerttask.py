@@ -1,8 +1,13 @@
+import kombu
 import mock
 import socket
 import os
 import sys
 
+from freezegun import freeze_time
+
+from mozdef_util.utilities.toUTC import toUTC
+
 
 def reverse_lookup(ip):
     if ip == '10.1.1.1':
@@ -54,3 +59,336 @@ class TestAddHostnameToIP(AlertTaskTest):
         with mock.patch("socket.gethostbyaddr", side_effect=reverse_lookup):
             hostname_info = self.add_hostname_to_ip('8.8.8.8', self.formatted_string)
         assert hostname_info == '8.8.8.8'
+
+
+class TestTagEventsAlert(AlertTaskTest):
+    def setup(self):
+        super().setup()
+        from lib import alerttask
+        self.task = alerttask.AlertTask.__new__(alerttask.AlertTask)
+        self.task.alert_name = 'AlertTask'
+        self.task.es = mock.Mock()
+        self.task.es.save_documents.return_value = {'succeeded': [], 'retried': [], 'failed': [], 'dropped': []}
+        self.events = [
+            {'_index': 'events-20191004', '_id': 'a', '_source': {'summary': 'first'}},
+            {'_index': 'events-20191004', '_id': 'b', '_source': {'summary': 'second', 'alert_names': ['Other']}},
+            {'_index': 'events-20191003', '_id': 'c', '_source': {'summary': 'third'}},
+        ]
+        self.alert_result = {'_index': 'alerts', '_id': 'alertid'}
+
+    def test_bulk_mode(self):
+        self.task.tagEventsAlert(self.events, self.alert_result)
+        assert self.task.es.save_documents.call_count == 1
+        assert self.task.es.save_event.call_count == 0
+        actions = self.task.es.save_documents.call_args[0][0]
+        assert [action['_id'] for action in actions] == ['a', 'b', 'c']
+        for action in actions:
+            assert action['_op_type'] == 'update'
+            assert action['script']['params'] == {
+                'alert': {'index': 'alerts', 'id': 'alertid'},
+                'alert_name': 'AlertTask',
+            }
+        refreshed = [call[0][0] for call in self.task.es.refresh.call_args_list]
+        assert refreshed == ['events-20191004', 'events-20191003']
+        assert self.events[1]['_source']['alert_names'] == ['Other', 'AlertTask']
+        assert self.events[0]['_source']['alerts'] == [{'index': 'alerts', 'id': 'alertid'}]
+
+    def test_bulk_mode_no_events(self):
+        self.task.tagEventsAlert([], self.alert_result)
+        assert self.task.es.save_documents.call_count == 0
+        assert self.task.es.refresh.call_count == 0
+
+    def test_single_mode(self):
+        self.task.tag_events_mode = 'single'
+        self.task.tagEventsAlert(self.events, self.alert_result)
+        assert self.task.es.save_documents.call_count == 0
+        assert self.task.es.save_event.call_count == 3
+        assert self.task.es.refresh.call_count == 3
+        assert self.task.es.save_event.call_args[1]['body']['alert_names'] == ['AlertTask']
+
+    def test_invalidates_query_cache(self):
+        from mozdef_util.query_models import SearchQuery
+        self.task.query_cache = mock.Mock()
+        self.task.main_query = SearchQuery(minutes=15)
+        self.task.main_query.last_cache_key = 'cachekey'
+        self.task.tagEventsAlert(self.events, self.alert_result)
+        self.task.query_cache.delete.assert_called_once_with('cachekey')
+
+    def test_single_mode_partial_source(self):
+        from mozdef_util.query_models import SearchQuery
+        self.task.tag_events_mode = 'single'
+        self.task.main_query = SearchQuery(minutes=15)
+        self.task.main_query.add_source_include('summary')
+        self.task.tagEventsAlert(self.events, self.alert_result)
+        assert self.task.es.save_event.call_count == 0
+        assert self.task.es.save_documents.call_count == 1
+        assert self.task.es.refresh.call_count == 2
+
+
+class TestSearchEventsAggregatedServer(AlertTaskTest):
+    def setup(self):
+        super().setup()
+        from lib import alerttask
+        from mozdef_util.query_models import SearchQuery, TermMatch
+        self.task = alerttask.AlertTask.__new__(alerttask.AlertTask)
+        self.task.alert_name = 'AlertTask'
+        self.task.aggregation_mode = 'server'
+        self.task.event_indices = ['events', 'events-previous']
+        self.task.es = mock.Mock()
+        self.task.es.save_documents.return_value = {'succeeded': [], 'retried': [], 'failed': [], 'dropped': []}
+        self.task.main_query = SearchQuery(minutes=15)
+        self.task.main_query.add_must(TermMatch('category', 'bro'))
+        self.sample = {'_index': 'events', '_id': 'a', '_score': 0, '_source': {'details': {'sourceipaddress': '1.2.3.4'}}}
+        self.searches = []
+        self.task.es.aggregated_search.side_effect = self.aggregated_search
+        self.alert_result = {'_index': 'alerts', '_id': 'alertid'}
+
+    def aggregated_search(self, search_query, indices, aggregations, size, request_timeout, **kwargs):
+        self.searches.append({'aggregations': [aggregation.to_dict() for aggregation in aggregations], 'size': size})
+        return {
+            'meta': {'timed_out': False},
+            'hits': [],
+            'aggregations': {
+                'details.sourceipaddress': {
+                    'terms': [{'key': '1.2.3.4', 'count': 5000, 'hits': [self.sample]}],
+                },
+            },
+        }
+
+    def test_search(self):
+        self.task.searchEventsAggregated('details.sourceipaddress', samplesLimit=1)
+        assert self.task.aggregations == [
+            {'value': '1.2.3.4', 'count': 5000, 'events': [self.sample], 'allevents': [self.sample]}
+        ]
+        assert len(self.searches) == 1
+        assert self.searches[0]['aggregations'][0]['aggs']['samples'] == {'top_hits': {'size': 1}}
+        # only the aggregation travels back, no raw hits
+        assert self.searches[0]['size'] == 0
+        # the aggregation isn't left on the query
+        assert self.task.main_query.aggregation == []
+
+    def test_tag_aggregation(self):
+        self.task.searchEventsAggregated('details.sourceipaddress', samplesLimit=1)
+        self.task.tagAggregationAlert(self.task.aggregations[0], self.alert_result)
+        assert self.task.es.save_documents.call_count == 1
+        query, indices, script = self.task.es.update_by_query.call_args[0]
+        assert indices == ['events', 'events-previous']
+        assert script['params']['alert_name'] == 'AlertTask'
+        query = query.to_dict()['bool']
+        assert {'match': {'details.sourceipaddress': '1.2.3.4'}} in query['must']
+        assert {'match': {'alert_names': 'AlertTask'}} in query['must_not']
+        assert self.task.main_query.time_range.to_dict() in query['must']
+
+    def test_tag_aggregation_all_events(self):
+        self.task.tagAggregationAlert({'value': 'x', 'count': 1, 'events': [self.sample], 'allevents': [self.sample]}, self.alert_result)
+        assert self.task.es.save_documents.call_count == 1
+        assert self.task.es.update_by_query.call_count == 0
+
+
+class TestSearchEventsAggregatedResults(AlertTaskTest):
+    def setup(self):
+        super().setup()
+        from lib import alerttask
+        from mozdef_util.query_models import SearchQuery, TermMatch
+        self.task = alerttask.AlertTask.__new__(alerttask.AlertTask)
+        self.task.alert_name = 'AlertTask'
+        self.task.event_indices = ['events', 'events-previous']
+        self.task.es = mock.Mock()
+        self.task.main_query = SearchQuery()
+        self.task.main_query.add_must(TermMatch('category', 'bro'))
+
+    def test_executed_results(self):
+        event = {'_index': 'events', '_id': 'a', '_score': 0, '_source': {'details': {'sourceipaddress': '1.2.3.4'}}}
+        self.task.searchEventsAggregated('details.sourceipaddress', samplesLimit=1, esresults={'hits': [event, event]})
+        assert self.task.es.search.call_count == 0
+        assert self.task.aggregations == [
+            {'value': '1.2.3.4', 'count': 2, 'events': [event], 'allevents': [event, event]}
+        ]
+
+
+class TestWatermark(AlertTaskTest):
+    def setup(self):
+        super().setup()
+        from lib import alerttask
+        self.task = alerttask.AlertTask.__new__(alerttask.AlertTask)
+        self.task.alert_name = 'AlertTask'
+        self.task.incremental_window = True
+        self.task.watermarks = None
+        self.task.pending_watermarks = {}
+        self.task.es = mock.Mock()
+        self.task.es.save_documents.return_value = {'succeeded': [], 'retried': [], 'failed': [], 'dropped': []}
+        self.set_watermark(None)
+
+    def set_watermark(self, watermark):
+        hits = []
+        if watermark is not None:
+            hits.append({'_id': 'alertwatermark_AlertTask', '_source': {'type': 'alertwatermark', 'alert_name': 'AlertTask', 'watermark': watermark}})
+        self.task.es.search.return_value = {'meta': {'timed_out': False}, 'hits': hits}
+
+    def search_query(self):
+        from mozdef_util.query_models import SearchQuery, TermMatch
+        query = SearchQuery(minutes=15)
+        query.add_must(TermMatch('category', 'bro'))
+        return query
+
+    @freeze_time('2019-10-04 10:00:00')
+    def test_first_run(self):
+        query = self.search_query()
+        self.task.filtersManual(query)
+        assert query.date_timedelta == {'minutes': 15}
+        assert list(self.task.pending_watermarks.keys()) == ['AlertTask']
+        assert self.task.pending_watermarks['AlertTask'].isoformat() == '2019-10-04T09:59:00+00:00'
+
+    @freeze_time('2019-10-04 10:00:00')
+    def test_since_watermark(self):
+        self.set_watermark('2019-10-04T09:57:00+00:00')
+        query = self.search_query()
+        self.task.filtersManual(query)
+        assert query.date_timedelta == {}
+        assert query.must[-1].to_dict() == {
+            'range': {
+                'receivedtimestamp': {'gte': toUTC('2019-10-04T09:57:00+00:00'), 'lte': toUTC('2019-10-04T10:00:00+00:00')},
+            }
+        }
+
+    @freeze_time('2019-10-04 10:00:00')
+    def test_watermark_older_than_window(self):
+        self.set_watermark('2019-10-04T08:00:00+00:00')
+        query = self.search_query()
+        self.task.filtersManual(query)
+        assert query.date_timedelta == {'minutes': 15}
+
+    def test_watermarks_loaded_once(self):
+        self.task.filtersManual(self.search_query())
+        self.task.filtersManual(self.search_query())
+        assert self.task.es.search.call_count == 1
+
+    def test_disabled(self):
+        self.task.incremental_window = False
+        query = self.search_query()
+        self.task.filtersManual(query)
+        assert query.date_timedelta == {'minutes': 15}
+        assert self.task.es.search.call_count == 0
+        assert self.task.pending_watermarks == {}
+
+    @freeze_time('2019-10-04 10:00:00')
+    def test_save(self):
+        self.task.filtersManual(self.search_query())
+        self.task.saveWatermarks()
+        documents = self.task.es.save_documents.call_args[0][0]
+        assert documents == [{
+            '_index': 'mozdefstate',
+            '_id': 'alertwatermark_AlertTask',
+            '_source': {
+                'type': 'alertwatermark',
+                'alert_name': 'AlertTask',
+                'watermark': '2019-10-04T09:59:00+00:00',
+                'utctimestamp': '2019-10-04T10:00:00+00:00',
+            },
+        }]
+        assert self.task.pending_watermarks == {}
+
+    def test_failed_search_not_saved(self):
+        self.task.filtersManual(self.search_query())
+        self.task.es.search.side_effect = Exception('search failed')
+        self.task.event_indices = ['events']
+        self.task.query_cache = None
+        self.task.searchEventsSimple()
+        self.task.saveWatermarks()
+        assert self.task.es.save_documents.call_count == 0
+
+
+class TestSharedConnections(AlertTaskTest):
+    def setup(self):
+        super().setup()
+        from lib import alerttask
+        self.alerttask = alerttask
+
+    def teardown(self):
+        self.alerttask.release_alert_queues()
+        self.alerttask._ES_CLIENTS.clear()
+        super().teardown()
+
+    def test_es_client_shared(self):
+        with mock.patch.object(self.alerttask, 'ElasticsearchClient', side_effect=lambda servers: mock.Mock()) as mock_client:
+            first_client = self.alerttask.get_es_client(['http://localhost:9200'])
+            second_client = self.alerttask.get_es_client(['http://localhost:9200'])
+            other_client = self.alerttask.get_es_client(['http://otherhost:9200'])
+        assert first_client is second_client
+        assert first_client is not other_client
+        assert mock_client.call_count == 2
+
+    def test_alert_queue_declared_once(self):
+        with mock.patch('kombu.Queue.declare') as declare:
+            connection, exchange, producers = self.alerttask.get_alert_queue('memory://')
+            assert self.alerttask.get_alert_queue('memory://') == (connection, exchange, producers)
+        assert declare.call_count == 1
+        assert exchange.name == self.alerttask.RABBITMQ['alertexchange']
+
+    def test_released(self):
+        connection, exchange, producers = self.alerttask.get_alert_queue('memory://')
+        self.alerttask.release_alert_queues()
+        assert self.alerttask.get_alert_queue('memory://')[0] is not connection
+
+    def test_close_connections_keeps_shared(self):
+        task = self.alerttask.AlertTask.__new__(self.alerttask.AlertTask)
+        task.mqConn, task.alertExchange, task.mqProducers = self.alerttask.get_alert_queue('memory://')
+        connection = task.mqConn
+        task.close_connections()
+        assert self.alerttask.get_alert_queue('memory://')[0] is connection
+
+    def test_released_producers(self):
+        task = self.alerttask.AlertTask.__new__(self.alerttask.AlertTask)
+        task.alert_name = 'AlertTask'
+        task.mqConn, task.alertExchange, task.mqProducers = self.alerttask.get_alert_queue('memory://')
+        producers = len(kombu.pools.producers)
+        task.alertToMessageQueue({'summary': 'test alert'})
+        task.alertToMessageQueue({'summary': 'test alert'})
+        # not registered in the kombu pool groups, which would keep them
+        assert len(kombu.pools.producers) == producers
+        with mock.patch.object(task.mqProducers, 'force_close_all') as force_close_all:
+            self.alerttask.release_alert_queues()
+        assert force_close_all.call_count == 1
+
+    def test_publish(self):
+        task = self.alerttask.AlertTask.__new__(self.alerttask.AlertTask)
+        task.alert_name = 'AlertTask'
+        task.mqConn, task.alertExchange, task.mqProducers = self.alerttask.get_alert_queue('memory://')
+        # bound like the alert consumers (ie: alert_actions_worker) bind theirs
+        queue = kombu.Queue('alertconsumer', exchange=task.alertExchange, routing_key=self.alerttask.RABBITMQ['alertqueue'])
+        with task.mqConn.SimpleQueue(queue) as simple_queue:
+            task.alertToMessageQueue({'summary': 'test alert'})
+            message = simple_queue.get(timeout=1)
+            message.ack()
+        assert message.payload == {'summary': 'test alert'}
+
+
+class TestGroupEventsByValue(AlertTaskTest):
+    def setup(self):
+        super().setup()
+        from lib import alerttask
+        self.group_events_by_value = alerttask.groupEventsByValue
+
+    def event(self, value):
+        return {'_source': {'details': {'username': value}}}
+
+    def test_most_common_first(self):
+        events = [self.event('a'), self.event('b'), self.event('b'), self.event('c'), self.event('b'), self.event('c')]
+        aggregations = self.group_events_by_value(events, 'details.username', 10)
+        assert [(aggregation['value'], aggregation['count']) for aggregation in aggregations] == [('b', 3), ('c', 2), ('a', 1)]
+        assert aggregations[0]['allevents'] == [events[1], events[2], events[4]]
+
+    def test_ties_in_first_seen_order(self):
+        events = [self.event('z'), self.event('y'), self.event('x'), self.event('y'), self.event('z')]
+        aggregations = self.group_events_by_value(events, 'details.username', 10)
+        assert [aggregation['value'] for aggregation in aggregations] == ['z', 'y', 'x']
+
+    def test_samples_limit(self):
+        events = [self.event('a') for num in range(5)]
+        aggregations = self.group_events_by_value(events, 'details.username', 2)
+        assert aggregations[0]['events'] == events[:2]
+        assert aggregations[0]['allevents'] == events
+        assert aggregations[0]['count'] == 5
+
+    def test_no_events(self):
+        assert self.group_events_by_value([], 'details.username', 10) == []
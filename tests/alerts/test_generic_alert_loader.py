@@ -0,0 +1,113 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import hjson
+
+
+class GenericAlertLoaderTest(object):
+    def teardown(self):
+        shutil.rmtree(self.alert_data_location)
+        sys.path.remove(self.alerts_path)
+        sys.path.remove(self.alerts_lib_path)
+        if 'lib' in sys.modules:
+            del sys.modules['lib']
+
+    def setup(self):
+        self.alerts_path = os.path.join(os.path.dirname(__file__), "../../alerts")
+        self.alerts_lib_path = os.path.join(os.path.dirname(__file__), "../../alerts/lib")
+        sys.path.insert(0, self.alerts_path)
+        sys.path.insert(1, self.alerts_lib_path)
+        import generic_alert_loader
+        self.generic_alert_loader = generic_alert_loader
+        generic_alert_loader.RULES.clear()
+
+        self.alert_data_location = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.alert_data_location, 'rules'))
+        self.task = generic_alert_loader.AlertGenericLoader.__new__(generic_alert_loader.AlertGenericLoader)
+        self.task.alert_name = 'AlertGenericLoader'
+        self.task.config = type('Config', (object,), {'alert_data_location': self.alert_data_location})
+        self.rule = {
+            'search_string': 'details.program: sshd',
+            'filters': [['category', 'syslog']],
+            'aggregation_key': 'details.username',
+            'time_window': 5,
+            'num_samples': 10,
+            'num_aggregations': 1,
+            'alert_category': 'generic_alerts',
+            'alert_severity': 'INFO',
+            'alert_summary': 'Example summary',
+            'alert_tags': ['generic'],
+            'alert_url': 'https://mozilla.org',
+            'additional_summary_fields': ['details.sourceipaddress', 'details.nothere'],
+        }
+
+    def write_rule(self, name, rule, mtime=None):
+        rule_file = os.path.join(self.alert_data_location, 'rules', name + '.json')
+        with open(rule_file, 'w') as fd:
+            hjson.dump(rule, fd)
+        if mtime is not None:
+            os.utime(rule_file, (mtime, mtime))
+        return rule_file
+
+
+class TestLoadConfigs(GenericAlertLoaderTest):
+    def test_load(self):
+        self.write_rule('example', self.rule)
+        self.task.load_configs()
+        assert len(self.task.configs) == 1
+        assert self.task.configs[0]['custom_alert_name'] == 'example'
+        rule = self.task.rules['example']
+        assert [term.to_dict() for term in rule.terms] == [
+            {'match': {'category': 'syslog'}},
+            {'query_string': {'query': 'details.program: sshd'}},
+        ]
+        assert rule.summary_fields == [
+            ('details.sourceipaddress', ('details', 'sourceipaddress')),
+            ('details.nothere', ('details', 'nothere')),
+        ]
+
+    def test_unchanged_rule_not_parsed_again(self):
+        self.write_rule('example', self.rule, mtime=time.time() - 60)
+        self.task.load_configs()
+        first_config = self.task.configs[0]
+        self.task.load_configs()
+        assert self.task.configs[0] is first_config
+
+    def test_changed_rule_parsed_again(self):
+        self.write_rule('example', self.rule, mtime=time.time() - 60)
+        self.task.load_configs()
+        self.rule['alert_summary'] = 'Changed summary'
+        self.write_rule('example', self.rule)
+        self.task.load_configs()
+        assert self.task.configs[0]['alert_summary'] == 'Changed summary'
+
+    def test_removed_rule(self):
+        rule_file = self.write_rule('example', self.rule)
+        self.task.load_configs()
+        os.remove(rule_file)
+        self.task.load_configs()
+        assert self.task.configs == []
+        assert self.generic_alert_loader.RULES == {}
+
+    def test_invalid_rule(self):
+        del self.rule['alert_url']
+        self.write_rule('example', self.rule)
+        self.task.load_configs()
+        assert self.task.configs == []
+
+
+class TestOnAggregation(GenericAlertLoaderTest):
+    def test_summary(self):
+        self.write_rule('example', self.rule)
+        self.task.load_configs()
+        events = [
+            {'_index': 'events', '_id': 'a', '_source': {'hostname': 'host1', 'details': {'sourceipaddress': '1.2.3.4'}}},
+            {'_index': 'events', '_id': 'b', '_source': {'details': 'not a dict'}},
+        ]
+        self.task.custom_alert_name = 'AlertGenericLoader:example'
+        aggreg = {'count': 2, 'value': 'bob', 'events': events, 'config': self.task.configs[0]}
+        alert = self.task.onAggregation(aggreg)
+        assert alert['summary'] == 'Example summary (2): bob (details.sourceipaddress=1.2.3.4) [host1]'
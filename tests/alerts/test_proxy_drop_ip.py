@@ -2,6 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 # Copyright (c) 2017 Mozilla Corporation
+import mock
+import os
+import sys
+
 from .positive_alert_test_case import PositiveAlertTestCase
 from .negative_alert_test_case import NegativeAlertTestCase
 
@@ -106,3 +110,52 @@ class TestAlertProxyDropIP(AlertTestSuite):
             description="Negative test case with old timestamp", events=events
         )
     )
+
+
+class TestProxyDropIPWhitelist(object):
+    def teardown(self):
+        sys.path.remove(self.alerts_path)
+        sys.path.remove(self.alerts_lib_path)
+        for module in ('lib', 'proxy_drop_ip'):
+            if module in sys.modules:
+                del sys.modules[module]
+
+    def setup(self):
+        self.alerts_path = os.path.join(os.path.dirname(__file__), "../../alerts")
+        self.alerts_lib_path = os.path.join(os.path.dirname(__file__), "../../alerts/lib")
+        sys.path.insert(0, self.alerts_path)
+        sys.path.insert(1, self.alerts_lib_path)
+        import proxy_drop_ip
+        self.alert = proxy_drop_ip.AlertProxyDropIP.__new__(proxy_drop_ip.AlertProxyDropIP)
+        self.alert.filtersManual = mock.Mock()
+        self.alert.searchEventsAggregated = mock.Mock()
+        self.alert.walkAggregations = mock.Mock()
+        self.alert.createAlertDict = mock.Mock(side_effect=lambda summary, *args: {'summary': summary})
+
+    def run_main(self, ip_whitelist):
+        def parse_config(config_filename, config_keys):
+            self.alert.config = mock.Mock(ip_whitelist=ip_whitelist)
+        with mock.patch.object(self.alert, 'parse_config', side_effect=parse_config):
+            self.alert.main()
+        return self.alert.filtersManual.call_args[0][0]
+
+    def aggregation(self, *hosts):
+        events = [
+            {'_source': {'details': {'sourceipaddress': '1.2.3.4', 'host': host}}}
+            for host in hosts
+        ]
+        return {'value': '1.2.3.4', 'count': len(events), 'events': events, 'allevents': events}
+
+    def test_whitelist_entries_stripped(self):
+        search_query = self.run_main('169.254.169.254, 10.0.0.0/8, 192.168.0.0/16,,')
+        must_not = [query.to_dict() for query in search_query.must_not]
+        assert {'match': {'details.host': '169.254.169.254'}} in must_not
+        assert {'match': {'details.host': ''}} not in must_not
+        assert '10.1.2.3' in self.alert.whitelisted_networks
+        assert '192.168.1.1' in self.alert.whitelisted_networks
+
+    def test_whitelisted_network_not_alerted(self):
+        self.run_main('169.254.169.254, 10.0.0.0/8')
+        assert self.alert.onAggregation(self.aggregation('10.1.2.3', '10.4.5.6')) is None
+        alert = self.alert.onAggregation(self.aggregation('10.1.2.3', '1.2.3.5'))
+        assert alert['summary'].endswith('destination(s): 1.2.3.5')
@@ -213,3 +213,24 @@ class TestAggregation(UnitTestSuite):
         search_query.add_aggregation(Aggregation('keyname', 2))
         results = search_query.execute(self.es_client)
         assert len(results['aggregations']['keyname']['terms']) == 2
+
+    def test_aggregation_with_samples(self):
+        for num in range(0, 10):
+            event = {'keyname': 'value' + str(num % 2), 'number': num}
+            self.populate_test_object(event)
+        self.refresh(self.event_index_name)
+
+        search_query = SearchQuery()
+        search_query.add_must(ExistsMatch('keyname'))
+        search_query.add_aggregation(Aggregation('keyname', samples_size=3))
+        results = search_query.execute(self.es_client, size=0)
+        assert results['hits'] == []
+        terms = results['aggregations']['keyname']['terms']
+        assert len(terms) == 2
+        for term in terms:
+            assert sorted(term.keys()) == ['count', 'hits', 'key']
+            assert term['count'] == 5
+            assert len(term['hits']) == 3
+            for hit in term['hits']:
+                assert sorted(hit.keys()) == ['_id', '_index', '_score', '_source']
+                assert hit['_source']['keyname'] == term['key']
@@ -0,0 +1,200 @@
+import mock
+import os
+import shutil
+import tempfile
+
+from mozdef_util.query_models import Aggregation, QueryCache, SearchQuery, TermMatch
+
+
+class QueryCacheTest(object):
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.cache_dir, 'query_cache.sqlite')
+        self.query_cache = QueryCache(self.cache_path, ttl=60, bucket_seconds=60, max_entries=3)
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+class TestQueryCache(QueryCacheTest):
+
+    def test_miss(self):
+        assert self.query_cache.get(self.query_cache.key({'a': 1})) is None
+        assert self.query_cache.stats() == {'hits': 0, 'misses': 1}
+
+    def test_hit(self):
+        key = self.query_cache.key({'a': 1})
+        self.query_cache.set(key, {'hits': [{'_id': '1'}]})
+        assert self.query_cache.get(key) == {'hits': [{'_id': '1'}]}
+        assert self.query_cache.stats() == {'hits': 1, 'misses': 0}
+
+    def test_results_copied(self):
+        key = self.query_cache.key({'a': 1})
+        self.query_cache.set(key, {'hits': []})
+        self.query_cache.get(key)['hits'].append('modified')
+        assert self.query_cache.get(key) == {'hits': []}
+
+    def test_key_normalized(self):
+        assert self.query_cache.key({'a': 1, 'b': 2}) == self.query_cache.key({'b': 2, 'a': 1})
+        assert self.query_cache.key({'a': 1}) != self.query_cache.key({'a': 2})
+
+    def test_key_time_bucket(self):
+        with mock.patch('time.time', return_value=120):
+            key = self.query_cache.key({'a': 1})
+        with mock.patch('time.time', return_value=179):
+            assert self.query_cache.key({'a': 1}) == key
+        with mock.patch('time.time', return_value=180):
+            assert self.query_cache.key({'a': 1}) != key
+
+    def test_expired(self):
+        key = self.query_cache.key({'a': 1})
+        with mock.patch('time.time', return_value=1000):
+            self.query_cache.set(key, {'hits': []})
+        with mock.patch('time.time', return_value=1059):
+            assert self.query_cache.get(key) == {'hits': []}
+        with mock.patch('time.time', return_value=1060):
+            assert self.query_cache.get(key) is None
+
+    def test_max_entries(self):
+        for num in range(5):
+            self.query_cache.set(self.query_cache.key({'a': num}), {'hits': num})
+        assert self.query_cache.get(self.query_cache.key({'a': 0})) is None
+        assert self.query_cache.get(self.query_cache.key({'a': 1})) is None
+        assert self.query_cache.get(self.query_cache.key({'a': 4})) == {'hits': 4}
+        count = self.query_cache.connect().execute('SELECT COUNT(*) FROM query_cache').fetchone()[0]
+        assert count == 3
+
+    def test_shared_store(self):
+        key = self.query_cache.key({'a': 1})
+        self.query_cache.set(key, {'hits': []})
+        other_process_cache = QueryCache(self.cache_path)
+        assert other_process_cache.get(key) == {'hits': []}
+
+    def test_unusable_store(self):
+        query_cache = QueryCache(os.path.join(self.cache_dir, 'missing', 'query_cache.sqlite'))
+        key = query_cache.key({'a': 1})
+        query_cache.set(key, {'hits': []})
+        assert query_cache.get(key) is None
+
+
+class TestSearchQueryCache(QueryCacheTest):
+
+    def setup(self):
+        super().setup()
+        self.es_client = mock.Mock()
+        self.es_client.search.return_value = {'meta': {'timed_out': False}, 'hits': [{'_id': '1'}]}
+
+    def search_query(self, value='value'):
+        query = SearchQuery(minutes=5)
+        query.add_must(TermMatch('details.username', value))
+        return query
+
+    def test_identical_queries_search_once(self):
+        first_results = self.search_query().execute(self.es_client, query_cache=self.query_cache)
+        second_results = self.search_query().execute(self.es_client, query_cache=self.query_cache)
+        assert first_results == second_results
+        assert self.es_client.search.call_count == 1
+
+    def test_different_queries(self):
+        self.search_query().execute(self.es_client, query_cache=self.query_cache)
+        self.search_query('other').execute(self.es_client, query_cache=self.query_cache)
+        self.search_query().execute(self.es_client, size=10, query_cache=self.query_cache)
+        self.search_query().execute(self.es_client, indices=['alerts'], query_cache=self.query_cache)
+        assert self.es_client.search.call_count == 4
+
+    def test_range_still_built(self):
+        query = self.search_query()
+        query.execute(self.es_client, query_cache=self.query_cache)
+        cached_query = self.search_query()
+        cached_query.execute(self.es_client, query_cache=self.query_cache)
+        assert cached_query.time_range is not None
+        assert len(cached_query.must) == 1
+
+    def test_range_not_accumulated(self):
+        query = self.search_query()
+        query.execute(self.es_client)
+        query.execute(self.es_client)
+        search_query = self.es_client.search.call_args[0][0]
+        assert len(search_query.to_dict()['bool']['must']) == 2
+
+    def test_delete(self):
+        query = self.search_query()
+        query.execute(self.es_client, query_cache=self.query_cache)
+        self.query_cache.delete(query.last_cache_key)
+        self.search_query().execute(self.es_client, query_cache=self.query_cache)
+        assert self.es_client.search.call_count == 2
+
+    def test_without_cache(self):
+        self.search_query().execute(self.es_client)
+        self.search_query().execute(self.es_client)
+        assert self.es_client.search.call_count == 2
+
+
+class TestSearchQueryCacheAlertNames(QueryCacheTest):
+
+    def setup(self):
+        super().setup()
+        self.es_client = mock.Mock()
+        self.es_client.search.return_value = {
+            'meta': {'timed_out': False},
+            'hits': [
+                {'_id': '1', '_source': {'summary': 'untagged'}},
+                {'_id': '2', '_source': {'summary': 'first', 'alert_names': ['FirstAlert']}},
+                {'_id': '3', '_source': {'summary': 'second', 'alert_names': ['SecondAlert']}},
+            ]
+        }
+
+    def search_query(self, alert_name):
+        query = SearchQuery(minutes=5)
+        query.add_must(TermMatch('category', 'bro'))
+        query.add_must_not(TermMatch('alert_names', alert_name))
+        return query
+
+    def test_alerts_share_entry(self):
+        first_results = self.search_query('FirstAlert').execute(self.es_client, query_cache=self.query_cache)
+        second_results = self.search_query('SecondAlert').execute(self.es_client, query_cache=self.query_cache)
+        assert self.es_client.search.call_count == 1
+        assert [hit['_id'] for hit in first_results['hits']] == ['1', '3']
+        assert [hit['_id'] for hit in second_results['hits']] == ['1', '2']
+
+    def test_alert_names_applied_client_side(self):
+        self.search_query('FirstAlert').execute(self.es_client, query_cache=self.query_cache)
+        search_query = self.es_client.search.call_args[0][0].to_dict()['bool']
+        assert 'must_not' not in search_query
+
+    def test_alert_names_sent_without_cache(self):
+        results = self.search_query('FirstAlert').execute(self.es_client)
+        search_query = self.es_client.search.call_args[0][0].to_dict()['bool']
+        assert search_query['must_not'] == [{'match': {'alert_names': 'FirstAlert'}}]
+        assert len(results['hits']) == 3
+
+    def test_full_page_of_alerted_events(self):
+        tagged = [
+            {'_id': str(num), '_source': {'summary': 'tagged', 'alert_names': ['FirstAlert']}}
+            for num in range(3)
+        ]
+        untagged = {'_id': 'new', '_source': {'summary': 'untagged'}}
+
+        def search(search_query, indices, size, request_timeout, **kwargs):
+            # elasticsearch sorts the alerted events first
+            if 'must_not' in search_query.to_dict()['bool']:
+                return {'meta': {'timed_out': False}, 'hits': [untagged]}
+            return {'meta': {'timed_out': False}, 'hits': (tagged + [untagged])[:size]}
+
+        self.es_client.search.side_effect = search
+        results = self.search_query('FirstAlert').execute(self.es_client, size=3, query_cache=self.query_cache)
+        assert [hit['_id'] for hit in results['hits']] == ['new']
+        assert self.es_client.search.call_count == 2
+        search_query = self.es_client.search.call_args[0][0].to_dict()['bool']
+        assert search_query['must_not'] == [{'match': {'alert_names': 'FirstAlert'}}]
+
+    def test_aggregation_keeps_alert_names(self):
+        self.es_client.aggregated_search.return_value = {'meta': {'timed_out': False}, 'hits': [], 'aggregations': {}}
+        for alert_name in ('FirstAlert', 'SecondAlert'):
+            query = self.search_query(alert_name)
+            query.add_aggregation(Aggregation('details.sourceipaddress'))
+            query.execute(self.es_client, query_cache=self.query_cache)
+        assert self.es_client.aggregated_search.call_count == 2
+        search_query = self.es_client.aggregated_search.call_args[0][0].to_dict()['bool']
+        assert search_query['must_not'] == [{'match': {'alert_names': 'SecondAlert'}}]
@@ -478,6 +478,103 @@ class TestExecute(SearchQueryUnitTest):
         results = query.execute(self.es_client)
         assert len(results['hits']) == 1000
 
+    def test_execute_iter_all_hits(self):
+        for num in range(0, 1200):
+            self.populate_example_event()
+        self.refresh(self.event_index_name)
+        query = SearchQuery()
+        query.add_must(ExistsMatch('summary'))
+        results = query.execute_iter(self.es_client, page_size=500)
+        hit = next(results)
+        assert sorted(hit.keys()) == ['_id', '_index', '_score', '_source']
+        assert hit['_source']['summary'] == 'Test Summary'
+        assert len(list(results)) == 1199
+
+    def test_execute_iter_max_hits(self):
+        for num in range(0, 30):
+            self.populate_example_event()
+        self.refresh(self.event_index_name)
+        query = SearchQuery()
+        query.add_must(ExistsMatch('summary'))
+        results = list(query.execute_iter(self.es_client, page_size=10, max_hits=12))
+        assert len(results) == 12
+
+    def test_execute_iter_without_queries(self):
+        query = SearchQuery(minutes=10)
+        query.add_aggregation(Aggregation('note'))
+        with pytest.raises(AttributeError):
+            query.execute_iter(self.es_client)
+
+    def test_execute_source_include(self):
+        self.populate_example_event()
+        self.refresh(self.event_index_name)
+        query = SearchQuery()
+        query.add_must(ExistsMatch('summary'))
+        query.add_source_include(['summary', 'details.information'])
+        results = query.execute(self.es_client)
+        assert results['hits'][0]['_source'] == {
+            'summary': 'Test Summary',
+            'details': {
+                'information': 'Example information'
+            }
+        }
+
+    def test_execute_source_exclude(self):
+        self.populate_example_event()
+        self.refresh(self.event_index_name)
+        query = SearchQuery()
+        query.add_must(ExistsMatch('summary'))
+        query.add_source_exclude('details')
+        results = query.execute(self.es_client)
+        assert 'details' not in results['hits'][0]['_source']
+        assert results['hits'][0]['_source']['note'] == 'Example note'
+
+    def test_execute_raw_hits(self):
+        self.populate_example_event()
+        self.refresh(self.event_index_name)
+        query = SearchQuery()
+        query.add_must(ExistsMatch('summary'))
+        results = query.execute(self.es_client)
+        raw_results = query.execute(self.es_client, raw_hits=True)
+        assert type(raw_results['hits'][0]) is dict
+        assert raw_results['hits'][0]['_id'] == results['hits'][0]['_id']
+        assert raw_results['hits'][0]['_source'] == results['hits'][0]['_source']
+
+    def test_execute_iter_source_include(self):
+        self.populate_example_event()
+        self.refresh(self.event_index_name)
+        query = SearchQuery()
+        query.add_must(ExistsMatch('summary'))
+        query.add_source_include('note')
+        results = list(query.execute_iter(self.es_client))
+        assert results[0]['_source'] == {'note': 'Example note'}
+
+    def test_execute_multiple(self):
+        self.populate_example_event()
+        self.refresh(self.event_index_name)
+        matching_query = SearchQuery()
+        matching_query.add_must(ExistsMatch('summary'))
+        aggregation_query = SearchQuery()
+        aggregation_query.add_must(ExistsMatch('summary'))
+        aggregation_query.add_aggregation(Aggregation('note'))
+        other_query = SearchQuery()
+        other_query.add_must(TermMatch('summary', 'nothere'))
+        results = SearchQuery.execute_multiple(self.es_client, [matching_query, aggregation_query, other_query], batch_size=2)
+        assert len(results) == 3
+        assert len(results[0]['hits']) == 1
+        assert results[0]['hits'][0]['_source']['summary'] == 'Test Summary'
+        assert results[1]['aggregations']['note']['terms'] == [{'count': 1, 'key': 'Example note'}]
+        assert results[2]['hits'] == []
+
+    def test_execute_multiple_size(self):
+        for num in range(0, 30):
+            self.populate_example_event()
+        self.refresh(self.event_index_name)
+        query = SearchQuery()
+        query.add_must(ExistsMatch('summary'))
+        results = SearchQuery.execute_multiple(self.es_client, [query], size=12)
+        assert len(results[0]['hits']) == 12
+
     def test_execute_with_should(self):
         self.populate_example_event()
         self.refresh(self.event_index_name)
@@ -1,3 +1,5 @@
+import pytest
+
 from .positive_test_suite import PositiveTestSuite
 from .negative_test_suite import NegativeTestSuite
 
@@ -26,6 +28,34 @@ class TestSubnetMatchPositiveTestSuite(PositiveTestSuite):
                     },
                 ],
             ],
+            [
+                SubnetMatch('details.sourceipaddress', '2001:db8::/32'), [
+                    {
+                        'details': {
+                            'sourceipaddress': '2001:db8::1'
+                        }
+                    },
+                    {
+                        'details': {
+                            'sourceipaddress': '2001:db8:ffff::1'
+                        }
+                    },
+                ],
+            ],
+            [
+                SubnetMatch('details.sourceipaddress', '10.1.1.0/24', ip_field=True), [
+                    {
+                        'details': {
+                            'sourceipaddress': '10.1.1.1'
+                        }
+                    },
+                    {
+                        'details': {
+                            'sourceipaddress': '10.1.1.255'
+                        }
+                    },
+                ],
+            ],
         ]
         return tests
 
@@ -57,5 +87,49 @@ class TestSubnetMatchNegativeTestSuite(NegativeTestSuite):
                     },
                 ],
             ],
+            [
+                SubnetMatch('details.sourceipaddress', '2001:db8::/32'), [
+                    {
+                        'details': {
+                            'sourceipaddress': '2001:db9::1'
+                        }
+                    },
+                ],
+            ],
+            [
+                SubnetMatch('details.sourceipaddress', '10.1.2.0/24', ip_field=True), [
+                    {
+                        'details': {
+                            'sourceipaddress': '10.1.1.1'
+                        }
+                    },
+                ],
+            ],
         ]
         return tests
+
+
+class TestSubnetMatchQuery(object):
+
+    def test_range_bounds(self):
+        assert SubnetMatch('details.sourceipaddress', '10.0.0.0/8').to_dict() == {
+            'query_string': {'query': 'details.sourceipaddress: [10.0.0.0 TO 10.255.255.255]'}
+        }
+
+    def test_ipv6_range_bounds(self):
+        assert SubnetMatch('details.sourceipaddress', '2001:db8::/120').to_dict() == {
+            'query_string': {'query': 'details.sourceipaddress: ["2001:db8::" TO "2001:db8::ff"]'}
+        }
+
+    def test_ip_field_term(self):
+        assert SubnetMatch('details.sourceipaddress', '2001:db8::/32', ip_field=True).to_dict() == {
+            'term': {'details.sourceipaddress': '2001:db8::/32'}
+        }
+
+    def test_large_network(self):
+        # bounds are computed without enumerating the addresses
+        SubnetMatch('details.sourceipaddress', '::/0')
+
+    def test_invalid_network(self):
+        with pytest.raises(ValueError):
+            SubnetMatch('details.sourceipaddress', '10.0.0.1/8')
@@ -1,5 +1,10 @@
+import threading
 import time
 
+import mock
+import pytest
+from elasticsearch.serializer import JSONSerializer
+
 from mozdef_util.bulk_queue import BulkQueue
 from mozdef_util.query_models import SearchQuery, ExistsMatch
 
@@ -75,6 +80,184 @@ class TestAdd(BulkQueueTest):
         assert self.queue.started() is False
 
 
+class TestMaxBytes(BulkQueueTest):
+
+    def test_add_over_max_bytes(self):
+        queue = BulkQueue(self.es_client, threshold=1000, max_bytes=100)
+        for num in range(0, 4):
+            queue.add(index='events', body={'keyname': 'x' * 30})
+        assert queue.size() == 1
+        assert self.num_objects_saved() == 3
+        assert queue.metrics()['queue_bytes'] < 100
+
+    def test_max_bytes_disabled(self):
+        queue = BulkQueue(self.es_client, threshold=1000)
+        queue.add(index='events', body={'keyname': 'x' * 1000})
+        assert queue.size() == 1
+        assert queue.metrics()['queue_bytes'] == 0
+
+
+class TestMaxInFlight(BulkQueueTest):
+
+    def test_background_send(self):
+        queue = BulkQueue(self.es_client, threshold=10, max_in_flight=2)
+        for num in range(0, 201):
+            queue.add(index='events', body={'keyname': 'value' + str(num)})
+        assert queue.size() == 1
+        queue.wait()
+        assert self.num_objects_saved() == 200
+        queue.flush()
+        queue.wait()
+        assert queue.size() == 0
+        assert self.num_objects_saved() == 201
+        assert queue.metrics()['in_flight'] == 0
+
+
+class MockClientTest(object):
+    def setup(self):
+        self.es_client = mock.Mock()
+        self.es_client.es_connection.transport.serializer = JSONSerializer()
+        self.es_client.save_documents.return_value = {'succeeded': [], 'retried': [], 'failed': [], 'dropped': []}
+
+
+class TestSendFailures(MockClientTest):
+
+    def test_failed_flush_requeued(self):
+        self.es_client.save_documents.side_effect = Exception('connection refused')
+        queue = BulkQueue(self.es_client, threshold=1000)
+        for num in range(0, 3):
+            queue.add(index='events', body={'keyname': 'value' + str(num)})
+        with pytest.raises(Exception):
+            queue.flush()
+        assert queue.size() == 3
+        assert queue.metrics()['in_flight'] == 0
+        assert queue.metrics()['flushed_documents'] == 0
+
+        self.es_client.save_documents.side_effect = None
+        queue.add(index='events', body={'keyname': 'value3'})
+        queue.flush()
+        assert queue.size() == 0
+        documents = self.es_client.save_documents.call_args[0][0]
+        assert [document['_source']['keyname'] for document in documents] == ['value0', 'value1', 'value2', 'value3']
+
+    def test_failed_background_send_requeued(self):
+        self.es_client.save_documents.side_effect = Exception('connection refused')
+        queue = BulkQueue(self.es_client, threshold=2, max_in_flight=1)
+        for num in range(0, 2):
+            queue.add(index='events', body={'keyname': 'value' + str(num)})
+        queue.wait()
+        assert queue.size() == 2
+
+
+class TestLongOutage(MockClientTest):
+
+    def test_failed_documents_survive_outage(self):
+        # save_documents reports the documents it ran out of retries
+        # for as failed, for as long as ES is unreachable
+        outage = {'flushes': 3}
+        indexed = []
+
+        def save_documents(documents):
+            if outage['flushes'] > 0:
+                outage['flushes'] -= 1
+                return {'succeeded': [], 'retried': documents, 'failed': documents, 'dropped': []}
+            indexed.extend(documents)
+            return {'succeeded': documents, 'retried': [], 'failed': [], 'dropped': []}
+
+        self.es_client.save_documents.side_effect = save_documents
+        queue = BulkQueue(self.es_client, threshold=1000)
+        for num in range(0, 5):
+            queue.add(index='events', body={'keyname': 'value' + str(num)})
+        for num in range(0, 3):
+            queue.flush()
+            assert queue.size() == 5
+        assert indexed == []
+        assert queue.metrics()['flushed_documents'] == 0
+        assert queue.metrics()['requeued_documents'] == 15
+
+        queue.flush()
+        assert queue.size() == 0
+        assert [document['_source']['keyname'] for document in indexed] == ['value0', 'value1', 'value2', 'value3', 'value4']
+        assert queue.metrics()['flushed_documents'] == 5
+        assert queue.metrics()['dropped_documents'] == 0
+
+
+class TestMaxBytesSerialized(MockClientTest):
+
+    def test_serialized_once(self):
+        queue = BulkQueue(self.es_client, threshold=1000, max_bytes=1000)
+        queue.add(index='events', body={'keyname': 'value'})
+        assert queue.list[0]['_source'] == '{"keyname":"value"}'
+        assert queue.metrics()['queue_bytes'] == len('{"keyname":"value"}')
+
+    def test_requeued_bytes(self):
+        self.es_client.save_documents.side_effect = Exception('connection refused')
+        queue = BulkQueue(self.es_client, threshold=1000, max_bytes=1000)
+        queue.add(index='events', body={'keyname': 'value'})
+        with pytest.raises(Exception):
+            queue.flush()
+        assert queue.metrics()['queue_bytes'] == len('{"keyname":"value"}')
+
+
+class TestInFlightLimit(MockClientTest):
+
+    def test_max_in_flight_batches(self):
+        release = threading.Event()
+        sending = []
+
+        def save_documents(documents):
+            sending.append(documents)
+            release.wait(5)
+            return {'succeeded': documents, 'retried': [], 'failed': [], 'dropped': []}
+
+        self.es_client.save_documents.side_effect = save_documents
+        queue = BulkQueue(self.es_client, threshold=1, max_in_flight=2)
+        queue.add(index='events', body={'keyname': 'value0'})
+        queue.add(index='events', body={'keyname': 'value1'})
+
+        blocked = threading.Thread(target=queue.add, kwargs={'index': 'events', 'body': {'keyname': 'value2'}})
+        blocked.start()
+        blocked.join(0.2)
+        # a third batch has to wait for one of the two in flight
+        assert blocked.is_alive()
+        assert queue.metrics()['in_flight'] == 3
+
+        release.set()
+        blocked.join(5)
+        queue.wait()
+        assert not blocked.is_alive()
+        assert len(sending) == 3
+        assert queue.metrics()['in_flight'] == 0
+
+
+class TestMetrics(BulkQueueTest):
+
+    def test_initial_metrics(self):
+        queue = BulkQueue(self.es_client)
+        metrics = queue.metrics()
+        assert metrics['queue_depth'] == 0
+        assert metrics['in_flight'] == 0
+        assert metrics['flush_count'] == 0
+        assert metrics['average_flush_latency'] == 0.0
+
+    def test_flush_metrics(self):
+        queue = BulkQueue(self.es_client, threshold=10)
+        for num in range(0, 25):
+            queue.add(index='events', body={'keyname': 'value' + str(num)})
+        metrics = queue.metrics()
+        assert metrics['queue_depth'] == 5
+        assert metrics['in_flight'] == 0
+        assert metrics['flush_count'] == 2
+        assert metrics['flushed_documents'] == 20
+        assert metrics['last_flush_latency'] > 0
+        assert metrics['max_flush_latency'] >= metrics['average_flush_latency'] > 0
+
+    def test_empty_flush(self):
+        queue = BulkQueue(self.es_client)
+        queue.flush()
+        assert queue.metrics()['flush_count'] == 0
+
+
 class TestTimer(BulkQueueTest):
 
     def test_basic_timer(self):
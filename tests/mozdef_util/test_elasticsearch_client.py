@@ -9,6 +9,7 @@ import time
 import json
 
 import pytest
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
 
 from mozdef_util.query_models import SearchQuery, TermMatch, Aggregation, ExistsMatch
 from mozdef_util.elasticsearch_client import ElasticsearchClient, ElasticsearchInvalidIndex, DOCUMENT_TYPE
@@ -48,6 +49,37 @@ class MockTransportClass:
         return self.original_function(method, url, params=params, body=body)
 
 
+class MockRejectingTransportClass(MockTransportClass):
+    '''rejects every document of the first num_rejections bulk requests'''
+
+    def __init__(self, num_rejections=1, status=429):
+        super().__init__()
+        self.num_rejections = num_rejections
+        self.status = status
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        if url == '/_bulk' and self.request_counts < self.num_rejections:
+            self.request_counts += 1
+            num_documents = len(body.strip().split('\n')) // 2
+            item = {'status': self.status, 'error': {'type': 'es_rejected_execution_exception'}}
+            return {'errors': True, 'items': [{'index': dict(item)} for num in range(num_documents)]}
+        return super().perform_request(method, url, headers=headers, params=params, body=body)
+
+
+class MockUnreachableTransportClass(MockTransportClass):
+    '''fails the first num_failures bulk requests with a connection error'''
+
+    def __init__(self, num_failures=1):
+        super().__init__()
+        self.num_failures = num_failures
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        if url == '/_bulk' and self.request_counts < self.num_failures:
+            self.request_counts += 1
+            raise ESConnectionError('N/A', 'connection refused', Exception('connection refused'))
+        return super().perform_request(method, url, headers=headers, params=params, body=body)
+
+
 class TestWriteWithRead(ElasticsearchClientTest):
     def setup(self):
         super().setup()
@@ -112,6 +144,33 @@ class TestNoResultsFound(ElasticsearchClientTest):
         assert results['hits'] == []
 
 
+class TestSearchIter(ElasticsearchClientTest):
+
+    def test_search_iter_no_results(self):
+        search_query = SearchQuery()
+        search_query.add_must(TermMatch('garbagefielddoesntexist', 'testingvalues'))
+        assert list(search_query.execute_iter(self.es_client)) == []
+
+    def test_search_iter_nonexisting_index(self):
+        search_query = SearchQuery()
+        search_query.add_must(TermMatch('key', 'value'))
+        with pytest.raises(ElasticsearchInvalidIndex):
+            list(search_query.execute_iter(self.es_client, indices=['doesnotexist']))
+
+
+class TestMultiSearch(ElasticsearchClientTest):
+
+    def test_multi_search_nonexisting_index(self):
+        search_query = SearchQuery()
+        search_query.add_must(TermMatch('key', 'value'))
+        results = self.es_client.multi_search([
+            {'search_query': search_query.build_query(), 'indices': ['doesnotexist'], 'size': 10},
+            {'search_query': search_query.build_query(), 'indices': [self.event_index_name], 'size': 10},
+        ])
+        assert results[0] is None
+        assert results[1]['hits'] == []
+
+
 class TestCloseIndex(ElasticsearchClientTest):
 
     def teardown(self):
@@ -374,6 +433,105 @@ class TestBulkWritesWithLessThanThreshold(BulkTest):
         assert self.get_num_events() == 6
 
 
+class TestSaveEvents(BulkTest):
+
+    def test_save_events_single_request(self):
+        events = []
+        for num in range(50):
+            events.append({'body': {'key': 'value' + str(num)}, 'index': 'events'})
+        results = self.es_client.save_events(events)
+        assert self.mock_class.request_counts == 1
+        assert len(results) == 50
+        for indexed, info in results:
+            assert indexed is True
+            assert info['status'] == 201
+        self.refresh(self.event_index_name)
+        assert self.get_num_events() == 50
+
+    def test_save_events_empty(self):
+        assert self.es_client.save_events([]) == []
+        assert self.mock_class.request_counts == 0
+
+
+class TestSaveDocuments(ElasticsearchClientTest):
+
+    def setup(self):
+        super().setup()
+        self.es_client.bulk_initial_backoff = 0
+
+    def mock_transport(self, mock_class):
+        mock_class.backup_function(self.es_client.es_connection.transport.perform_request)
+        self.es_client.es_connection.transport.perform_request = mock_class.perform_request
+        return mock_class
+
+    def documents(self, num_documents):
+        documents = []
+        for num in range(num_documents):
+            documents.append({'_index': 'events', '_id': None, '_source': {'key': 'value' + str(num)}})
+        return documents
+
+    def test_parallel_chunks(self):
+        mock_class = self.mock_transport(MockTransportClass())
+        self.es_client.bulk_threads = 4
+        self.es_client.bulk_chunk_size = 10
+        report = self.es_client.save_documents(self.documents(50))
+        assert mock_class.request_counts == 5
+        assert len(report['succeeded']) == 50
+        assert report['retried'] == []
+        assert report['dropped'] == []
+        self.refresh(self.event_index_name)
+        assert self.get_num_events() == 50
+
+    def test_retry_rejected(self):
+        mock_class = self.mock_transport(MockRejectingTransportClass(num_rejections=2))
+        documents = self.documents(20)
+        report = self.es_client.save_documents(documents)
+        assert mock_class.request_counts == 3
+        assert len(report['succeeded']) == 20
+        assert report['retried'] == documents
+        assert report['dropped'] == []
+        self.refresh(self.event_index_name)
+        assert self.get_num_events() == 20
+
+    def test_failed_after_max_retries(self):
+        mock_class = self.mock_transport(MockRejectingTransportClass(num_rejections=10, status=503))
+        self.es_client.bulk_max_retries = 2
+        documents = self.documents(20)
+        report = self.es_client.save_documents(documents)
+        assert mock_class.request_counts == 3
+        assert report['succeeded'] == []
+        assert report['retried'] == documents
+        assert report['failed'] == documents
+        assert report['dropped'] == []
+
+    def test_unreachable_failed_after_max_retries(self):
+        mock_class = self.mock_transport(MockUnreachableTransportClass(num_failures=10))
+        self.es_client.bulk_max_retries = 1
+        documents = self.documents(5)
+        report = self.es_client.save_documents(documents)
+        assert mock_class.request_counts == 2
+        assert report['failed'] == documents
+        assert report['dropped'] == []
+
+    def test_retry_unreachable(self):
+        mock_class = self.mock_transport(MockUnreachableTransportClass(num_failures=2))
+        documents = self.documents(20)
+        report = self.es_client.save_documents(documents)
+        assert mock_class.request_counts == 3
+        assert len(report['succeeded']) == 20
+        assert report['retried'] == documents
+        assert report['dropped'] == []
+
+    def test_no_retry_on_bad_request(self):
+        mock_class = self.mock_transport(MockRejectingTransportClass(status=400))
+        documents = self.documents(5)
+        report = self.es_client.save_documents(documents)
+        assert mock_class.request_counts == 1
+        assert report['retried'] == []
+        assert report['failed'] == []
+        assert report['dropped'] == documents
+
+
 class TestWriteWithID(ElasticsearchClientTest):
 
     def test_write_with_id(self):
@@ -396,6 +554,20 @@ class TestWriteWithIDExists(ElasticsearchClientTest):
         self.es_client.get_event_by_id(event_id)
 
 
+class TestGetObjectsByIds(ElasticsearchClientTest):
+
+    def test_get_objects_by_ids(self):
+        self.es_client.save_object(body={'key': 'value1'}, index=self.event_index_name, doc_id='id1')
+        self.es_client.save_object(body={'key': 'value2'}, index=self.event_index_name, doc_id='id2')
+        # real-time get, no refresh needed
+        found = self.es_client.get_objects_by_ids(['id1', 'id2', 'id3'], self.event_index_name)
+        assert sorted(found.keys()) == ['id1', 'id2']
+        assert found['id2']['_source'] == {'key': 'value2'}
+
+    def test_get_objects_by_ids_no_ids(self):
+        assert self.es_client.get_objects_by_ids([], self.event_index_name) == {}
+
+
 class TestGetIndices(ElasticsearchClientTest):
 
     def teardown(self):
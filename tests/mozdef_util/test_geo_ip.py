@@ -1,6 +1,33 @@
+import time
+from types import SimpleNamespace
+
 from mozdef_util.geo_ip import GeoIP
 
 
+class MockReader(object):
+    '''stands in for a geoip2 Reader since the db file is not present by default'''
+
+    def __init__(self):
+        self.lookups = 0
+        self.closed = False
+
+    def city(self, ip):
+        self.lookups += 1
+        if ip == '127.0.0.1':
+            raise ValueError('The address 127.0.0.1 is not in the database.')
+        return SimpleNamespace(
+            city=SimpleNamespace(name='Rochester', names={'en': 'Rochester'}),
+            continent=SimpleNamespace(code='NA'),
+            country=SimpleNamespace(iso_code='US', name='United States'),
+            location=SimpleNamespace(metro_code=538, latitude=43.1, longitude=-77.6, time_zone='America/New_York'),
+            postal=SimpleNamespace(code='14623'),
+            subdivisions=[SimpleNamespace(iso_code='NY')],
+        )
+
+    def close(self):
+        self.closed = True
+
+
 class TestGeoIPLookup(object):
     # Unfortunately since the db file is not present by default
     # we verify the error
@@ -8,3 +35,69 @@ class TestGeoIPLookup(object):
         geo_ip = GeoIP("nonexistent_db")
         geo_dict = geo_ip.lookup_ip('129.21.1.40')
         assert geo_dict['error'] == 'No Geolite DB Found!'
+
+
+class TestGeoIPCache(object):
+
+    def setup(self):
+        self.geo_ip = GeoIP("nonexistent_db", cache_size=2, reload_interval=3600)
+        self.reader = MockReader()
+        self.geo_ip.db = self.reader
+
+    def test_lookup(self):
+        geo_dict = self.geo_ip.lookup_ip('129.21.1.40')
+        assert geo_dict['city'] == 'Rochester'
+        assert geo_dict['country_code'] == 'US'
+        assert geo_dict['metro_code'] == 'Rochester, NY'
+        assert geo_dict['region_code'] == 'NY'
+        assert geo_dict['latitude'] == 43.1
+
+    def test_cache_hit(self):
+        first = self.geo_ip.lookup_ip('129.21.1.40')
+        second = self.geo_ip.lookup_ip('129.21.1.40')
+        assert first == second
+        assert self.reader.lookups == 1
+        assert self.geo_ip.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'size': 1}
+
+    def test_cached_result_is_a_copy(self):
+        self.geo_ip.lookup_ip('129.21.1.40')['city'] = 'Somewhere'
+        assert self.geo_ip.lookup_ip('129.21.1.40')['city'] == 'Rochester'
+
+    def test_errors_cached(self):
+        assert 'error' in self.geo_ip.lookup_ip('127.0.0.1')
+        assert 'error' in self.geo_ip.lookup_ip('127.0.0.1')
+        assert self.reader.lookups == 1
+
+    def test_least_recently_used_evicted(self):
+        self.geo_ip.lookup_ip('1.1.1.1')
+        self.geo_ip.lookup_ip('2.2.2.2')
+        self.geo_ip.lookup_ip('1.1.1.1')
+        self.geo_ip.lookup_ip('3.3.3.3')
+        assert list(self.geo_ip.cache.keys()) == ['1.1.1.1', '3.3.3.3']
+        self.geo_ip.lookup_ip('2.2.2.2')
+        assert self.reader.lookups == 4
+
+    def test_ttl_expired(self):
+        self.geo_ip.cache_ttl = 0
+        self.geo_ip.lookup_ip('129.21.1.40')
+        self.geo_ip.lookup_ip('129.21.1.40')
+        assert self.reader.lookups == 2
+
+    def test_cache_disabled(self):
+        self.geo_ip.cache_size = 0
+        self.geo_ip.lookup_ip('129.21.1.40')
+        self.geo_ip.lookup_ip('129.21.1.40')
+        assert self.reader.lookups == 2
+        assert self.geo_ip.stats()['size'] == 0
+
+    def test_missing_file_keeps_db(self):
+        self.geo_ip.lookup_ip('129.21.1.40')
+        self.geo_ip.last_reload_check = time.time() - 3600
+        self.geo_ip.lookup_ip('129.21.1.40')
+        assert self.geo_ip.db is self.reader
+        assert self.reader.lookups == 1
+
+    def test_close(self):
+        self.geo_ip.close()
+        assert self.reader.closed is True
+        assert self.geo_ip.db is None
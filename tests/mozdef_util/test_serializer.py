@@ -0,0 +1,70 @@
+import json
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+
+from mozdef_util.event import Event
+from mozdef_util.serializer import OrjsonSerializer, get_serializer
+
+
+class TestGetSerializer(object):
+
+    def test_serializer_type(self):
+        serializer = get_serializer()
+        assert isinstance(serializer, JSONSerializer)
+        assert serializer.mimetype == 'application/json'
+
+
+class TestOrjsonSerializer(object):
+
+    def setup(self):
+        pytest.importorskip('orjson')
+        self.serializer = OrjsonSerializer()
+        self.json_serializer = JSONSerializer()
+
+    def test_get_serializer(self):
+        assert isinstance(get_serializer(), OrjsonSerializer)
+
+    def test_dumps_matches_json(self):
+        event = Event({
+            'summary': 'ünicode summary',
+            'details': {
+                'sourceipaddress': '1.2.3.4',
+                'port': 22,
+                'ratio': 0.5,
+                'tags': ['a', 'b'],
+                'nested': {'none': None, 'bool': True},
+            },
+        })
+        assert json.loads(self.serializer.dumps(event)) == json.loads(self.json_serializer.dumps(event))
+
+    def test_dumps_string(self):
+        assert self.serializer.dumps('{"key": "value"}') == '{"key": "value"}'
+
+    def test_dumps_datetime(self):
+        now = datetime(2019, 10, 4, 12, 30, 15, 123456)
+        assert self.serializer.dumps({'utctimestamp': now}) == self.json_serializer.dumps({'utctimestamp': now})
+
+    def test_dumps_default(self):
+        assert json.loads(self.serializer.dumps({'value': Decimal('1.5')})) == {'value': 1.5}
+
+    def test_dumps_non_str_keys(self):
+        assert json.loads(self.serializer.dumps({1: 'one'})) == {'1': 'one'}
+
+    def test_dumps_big_integer(self):
+        assert self.serializer.dumps({'value': 2 ** 70}) == '{"value":%d}' % 2 ** 70
+
+    def test_dumps_unserializable(self):
+        with pytest.raises(SerializationError):
+            self.serializer.dumps({'value': object()})
+
+    def test_loads(self):
+        assert self.serializer.loads('{"key":"value","count":2}') == {'key': 'value', 'count': 2}
+
+    def test_loads_bad_json(self):
+        with pytest.raises(SerializationError):
+            self.serializer.loads('{"key":')
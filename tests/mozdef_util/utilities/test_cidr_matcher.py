@@ -0,0 +1,54 @@
+import ipaddress
+
+import pytest
+
+from mozdef_util.utilities.cidr_matcher import CIDRMatcher
+
+
+class TestCIDRMatcher(object):
+
+    def test_ipv4(self):
+        matcher = CIDRMatcher(['10.0.0.0/8', '192.168.1.0/24'])
+        assert '10.0.0.0' in matcher
+        assert '10.255.255.255' in matcher
+        assert '192.168.1.77' in matcher
+        assert '11.0.0.0' not in matcher
+        assert '9.255.255.255' not in matcher
+        assert '192.168.2.1' not in matcher
+
+    def test_ipv6(self):
+        matcher = CIDRMatcher(['2001:db8::/32', '10.0.0.0/8'])
+        assert '2001:db8::1' in matcher
+        assert '2001:db8:ffff:ffff:ffff:ffff:ffff:ffff' in matcher
+        assert '2001:db9::' not in matcher
+        # ip versions are matched separately
+        assert '::a00:1' not in matcher
+
+    def test_overlapping_and_adjacent_networks_merged(self):
+        matcher = CIDRMatcher(['10.0.0.0/24', '10.0.0.128/25', '10.0.1.0/24', '10.0.3.0/24'])
+        assert matcher.starts[4] == [int(ipaddress.ip_address('10.0.0.0')), int(ipaddress.ip_address('10.0.3.0'))]
+        assert '10.0.1.255' in matcher
+        assert '10.0.2.1' not in matcher
+        assert '10.0.3.1' in matcher
+
+    def test_host_bits_and_single_addresses(self):
+        matcher = CIDRMatcher(['10.1.1.1/24', '8.8.8.8'])
+        assert '10.1.1.200' in matcher
+        assert '8.8.8.8' in matcher
+        assert '8.8.8.9' not in matcher
+
+    def test_not_an_address(self):
+        matcher = CIDRMatcher(['0.0.0.0/0'])
+        assert 'hostname.example.com' not in matcher
+        assert '' not in matcher
+        assert None not in matcher
+
+    def test_address_objects(self):
+        assert ipaddress.ip_address('10.1.2.3') in CIDRMatcher(['10.0.0.0/8'])
+
+    def test_empty(self):
+        assert '10.1.2.3' not in CIDRMatcher([])
+
+    def test_invalid_network(self):
+        with pytest.raises(ValueError):
+            CIDRMatcher(['10.0.0.0/33'])
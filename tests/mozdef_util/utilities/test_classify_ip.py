@@ -0,0 +1,71 @@
+from mozdef_util.utilities.classify_ip import classify_ip, is_ipv4, is_ipv6, parse_ip
+
+
+class TestClassifyIP(object):
+
+    def test_public_ipv4(self):
+        ip = classify_ip('8.8.8.8')
+        assert ip.version == 4
+        assert ip.cidr is False
+        assert ip.private is False
+        assert ip.loopback is False
+        assert ip.reserved is False
+        assert ip.text == '8.8.8.8'
+
+    def test_private_ipv4(self):
+        assert classify_ip('10.1.2.3').private is True
+        assert classify_ip('192.168.0.1').private is True
+
+    def test_loopback(self):
+        assert classify_ip('127.0.0.1').loopback is True
+        assert classify_ip('::1').loopback is True
+
+    def test_reserved(self):
+        assert classify_ip('240.0.0.1').reserved is True
+
+    def test_ipv6_normalized(self):
+        ip = classify_ip('2001:DB8:0:0:0:0:0:1')
+        assert ip.version == 6
+        assert ip.text == '2001:db8::1'
+
+    def test_cidr(self):
+        assert classify_ip('10.0.0.0/8') is None
+        ip = classify_ip('10.1.2.3/8', allow_cidr=True)
+        assert ip.cidr is True
+        assert ip.private is True
+        assert ip.text == '10.0.0.0/8'
+
+    def test_invalid(self):
+        assert classify_ip('-') is None
+        assert classify_ip('') is None
+        assert classify_ip('1') is None
+        assert classify_ip('1.2.3') is None
+        assert classify_ip('hostname.example.com') is None
+        assert classify_ip('1.2.3.4/abc', allow_cidr=True) is None
+
+    def test_not_a_string(self):
+        assert classify_ip(None) is None
+        assert classify_ip(['1.2.3.4']) is None
+
+    def test_cached(self):
+        parse_ip.cache_clear()
+        first = classify_ip('1.2.3.4')
+        second = classify_ip('1.2.3.4')
+        assert first is second
+        assert parse_ip.cache_info().hits == 1
+
+
+class TestIsIP(object):
+
+    def test_is_ipv4(self):
+        assert is_ipv4('1.2.3.4') is True
+        assert is_ipv4('::1') is False
+        assert is_ipv4('1.2.3.0/24') is False
+        assert is_ipv4('1.2.3.0/24', allow_cidr=True) is True
+        assert is_ipv4('0') is False
+
+    def test_is_ipv6(self):
+        assert is_ipv6('fe80::1') is True
+        assert is_ipv6('1.2.3.4') is False
+        assert is_ipv6('fe80::/10') is False
+        assert is_ipv6('fe80::/10', allow_cidr=True) is True
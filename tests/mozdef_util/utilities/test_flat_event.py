@@ -0,0 +1,65 @@
+from mozdef_util.utilities.dict2List import dict2List
+from mozdef_util.utilities.flat_event import FlatEvent
+
+
+class TestFlatEvent(object):
+
+    def setup(self):
+        self.event = {
+            'Category': 'AWSCloudTrail',
+            'summary': 'A fairly long summary of what happened',
+            'details': {
+                'sourceipaddress': '1.2.3.4',
+                'eventName': 'DescribeInstances',
+                'port': 22,
+                'requestparameters': {
+                    'instancesSet': {
+                        'items': [{'instanceId': 'I-1234'}, ['Nested', 5]],
+                    },
+                },
+            },
+            'tags': ['Tag1', 'tag2'],
+        }
+
+    def test_same_fields_as_dict2list(self):
+        flat_event = FlatEvent(self.event)
+        flat_event.refresh()
+        assert flat_event.keys.union(flat_event.values) == set(dict2List(self.event))
+
+    def test_keys_and_values_separate(self):
+        flat_event = FlatEvent(self.event)
+        flat_event.refresh()
+        assert 'category' in flat_event.keys
+        assert 'awscloudtrail' in flat_event.values
+        assert 'awscloudtrail' not in flat_event.keys
+        # keys of nested dicts aren't fields themselves
+        assert 'details' not in flat_event.keys
+        assert 'items' in flat_event.keys
+
+    def test_matches(self):
+        flat_event = FlatEvent(self.event)
+        assert flat_event.matches(['sourceipaddress', 'i-1234', 'nothere']) == set(['sourceipaddress', 'i-1234'])
+        assert flat_event.matches({'category': [1]}) == set(['category'])
+
+    def test_max_value_length(self):
+        flat_event = FlatEvent(self.event, max_value_length=10)
+        assert flat_event.matches(['tag1', 'summary']) == set(['tag1', 'summary'])
+        assert 'a fairly long summary of what happened' not in flat_event.values
+
+    def test_unhashable_values_skipped(self):
+        flat_event = FlatEvent({'key': set(['value'])})
+        assert flat_event.matches(['key']) == set(['key'])
+
+    def test_cached_until_dirty(self):
+        flat_event = FlatEvent(self.event)
+        assert flat_event.matches(['newkey']) == set()
+        self.event['newkey'] = 'value'
+        assert flat_event.matches(['newkey']) == set()
+        flat_event.mark_dirty()
+        assert flat_event.matches(['newkey']) == set(['newkey'])
+
+    def test_mark_dirty_new_event(self):
+        flat_event = FlatEvent(self.event)
+        assert flat_event.matches(['other']) == set()
+        flat_event.mark_dirty({'other': 'event'})
+        assert flat_event.matches(['other', 'event']) == set(['other', 'event'])
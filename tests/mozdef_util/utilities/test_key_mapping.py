@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+# Copyright (c) 2017 Mozilla Corporation
+
+from mozdef_util.utilities.key_mapping import (
+    KeyMapping,
+    DEFAULT_KEY_MAPPING,
+    SQS_KEY_MAPPING,
+    normalize_key,
+    map_nxlog_windows,
+    map_summary,
+)
+
+
+class TestNormalizeKey():
+    def test_lower(self):
+        assert normalize_key('HOSTNAME') == 'hostname'
+
+    def test_remove_at(self):
+        assert normalize_key('@Timestamp') == 'timestamp'
+
+    def test_memo(self):
+        assert normalize_key('@Fields.Example') == 'fields.example'
+        assert normalize_key('@Fields.Example') == 'fields.example'
+
+
+class TestKeyMapping():
+    def setup(self):
+        self.returndict = {'details': {}}
+
+    def test_dispatch_table(self):
+        assert DEFAULT_KEY_MAPPING.dispatch['facility'][0].__name__ == 'map_raw_source'
+        assert DEFAULT_KEY_MAPPING.dispatch['facility'][1].__name__ == 'map_facility'
+        assert 'facility' in SQS_KEY_MAPPING.dispatch
+        assert 'sourceip' not in SQS_KEY_MAPPING.dispatch
+
+    def test_multiple_handlers(self):
+        DEFAULT_KEY_MAPPING.map_fields({'FACILITY': 'daemon'}, self.returndict)
+        assert self.returndict['source'] == 'daemon'
+        assert self.returndict['facility'] == 'daemon'
+
+    def test_tags_exact_match(self):
+        # used to match on substrings of 'tags'
+        DEFAULT_KEY_MAPPING.map_fields({'ta': 'x', 'tags': 'example'}, self.returndict)
+        assert self.returndict['tags'] == ['example']
+
+    def test_payload_exact_match(self):
+        # used to match on substrings of 'payload'
+        SQS_KEY_MAPPING.map_fields({'load': 'x'}, self.returndict)
+        assert 'summary' not in self.returndict
+        assert self.returndict['details'] == {}
+
+    def test_payload_with_summary(self):
+        SQS_KEY_MAPPING.map_fields({'summary': 'example summary', 'payload': 'examplepayload'}, self.returndict)
+        assert self.returndict['summary'] == 'example summary'
+        assert self.returndict['details']['payload'] == 'examplepayload'
+
+    def test_timestamp(self):
+        DEFAULT_KEY_MAPPING.map_fields({'@timestamp': '2017-09-26T01:33:37.470Z'}, self.returndict)
+        assert self.returndict['utctimestamp'] == '2017-09-26T01:33:37.470000+00:00'
+        assert self.returndict['timestamp'] == '2017-09-26T01:33:37.470000+00:00'
+
+    def test_dotted_details(self):
+        SQS_KEY_MAPPING.map_fields({'details.count_int': '3', 'fields.ratio_float': '0.5', 'Details.Name': 5}, self.returndict)
+        assert self.returndict['details'] == {'count_int': 3, 'ratio_float': 0.5, 'name': '5'}
+
+    def test_default_handler(self):
+        def map_unknown(returndict, key, value):
+            returndict['details'][key] = value
+
+        key_mapping = KeyMapping([(('summary',), map_summary)], default_handler=map_unknown)
+        key_mapping.map_fields({'Summary': 'example', 'Unknown': 1}, self.returndict)
+        assert self.returndict == {'summary': 'example', 'details': {'unknown': 1}}
+
+    def test_unknown_keys_ignored(self):
+        DEFAULT_KEY_MAPPING.map_fields({'somekey': 'somevalue'}, self.returndict)
+        assert self.returndict == {'details': {}}
+
+
+class TestNxlogWindows():
+    def message(self):
+        return {
+            'Domain': 'EXAMPLE',
+            'SourceModuleType': 'im_msvistalog',
+            'EventID': 4624,
+            'TargetUserName': 'kirk',
+            'Message': 'An account was successfully logged on.',
+            'SomeOtherField': 'value',
+        }
+
+    def test_allowed_details(self):
+        returndict = map_nxlog_windows(self.message(), {'details': {}})
+        assert returndict['details'] == {
+            'domain': 'EXAMPLE',
+            'sourcemoduletype': 'im_msvistalog',
+            'eventid': 4624,
+            'targetusername': 'kirk',
+        }
+
+    def test_sqs_mapping_same_details(self):
+        default_returndict = DEFAULT_KEY_MAPPING.map_fields(self.message(), {'details': {}})
+        sqs_returndict = SQS_KEY_MAPPING.map_fields(self.message(), {'details': {}})
+        map_nxlog_windows(self.message(), default_returndict)
+        map_nxlog_windows(self.message(), sqs_returndict)
+        assert default_returndict['details'] == sqs_returndict['details']
+
+    def test_not_nxlog(self):
+        message = self.message()
+        del message['SourceModuleType']
+        assert map_nxlog_windows(message, {'details': {}}) == {'details': {}}
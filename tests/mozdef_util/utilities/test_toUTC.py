@@ -3,6 +3,7 @@ from dateutil.parser import parse
 
 import importlib
 import sys
+import pytest
 import pytz
 
 import tzlocal
@@ -26,6 +27,9 @@ tzlocal.get_localzone = utc_timezone
 if 'mozdef_util.utilities.toUTC' in sys.modules:
     importlib.reload(sys.modules['mozdef_util.utilities.toUTC'])
 
+# imported after the reload so we share the module's format cache
+from mozdef_util.utilities.toUTC import parseDate, replace_english_names, DETECTED_FORMATS, DETECTED_FORMATS_MAX_SIZE
+
 
 class TestToUTC():
 
@@ -117,3 +121,67 @@ class TestToUTC():
     def test_zero_float(self):
         result = toUTC(0.000000)
         assert str(result) == '1970-01-01 00:00:00+00:00'
+
+
+class TestParseDate():
+    def setup(self):
+        DETECTED_FORMATS.clear()
+
+    def test_iso_format(self):
+        result = parseDate("2017-09-26T01:33:37.470Z", 'example')
+        assert result == parse("2017-09-26T01:33:37.470Z")
+
+    def test_offset_without_colon(self):
+        result = parseDate("2017-05-25 07:14:15 +0000", 'example')
+        assert result == parse("2017-05-25 07:14:15 +0000")
+
+    def test_syslog_format(self):
+        result = parseDate("Oct 27 14:01:12", 'example')
+        assert str(result) == str(date.today().year) + '-10-27 14:01:12'
+        assert DETECTED_FORMATS['example'] == '%b %d %H:%M:%S'
+
+    def test_rfc2822_format(self):
+        result = parseDate("Thu, 25 May 2017 07:14:15 +0000", 'example')
+        assert result == parse("Thu, 25 May 2017 07:14:15 +0000")
+        assert DETECTED_FORMATS['example'] == '%a, %d %b %Y %H:%M:%S %z'
+
+    def test_detected_format_per_source(self):
+        parseDate("Oct 27 14:01:12", 'syslog')
+        parseDate("25/May/2017:07:14:15 +0000", 'nginx')
+        assert DETECTED_FORMATS['syslog'] == '%b %d %H:%M:%S'
+        assert DETECTED_FORMATS['nginx'] == '%d/%b/%Y:%H:%M:%S %z'
+
+    def test_changing_format(self):
+        parseDate("Oct 27 14:01:12", 'example')
+        result = parseDate("25/May/2017:07:14:15 +0000", 'example')
+        assert str(result) == '2017-05-25 07:14:15+00:00'
+        assert DETECTED_FORMATS['example'] == '%d/%b/%Y:%H:%M:%S %z'
+
+    def test_fuzzy_fallback(self):
+        result = parseDate("Tue Oct 27 14:01:12 2015 something", 'example')
+        assert str(result) == '2015-10-27 14:01:12'
+        assert 'example' not in DETECTED_FORMATS
+
+    def test_to_utc_source(self):
+        result = toUTC("Thu, 25 May 2017 07:14:15 -0700", source='example')
+        assert str(result) == '2017-05-25 14:14:15+00:00'
+
+    def test_english_names_without_locale(self):
+        # strptime only sees numbers, whatever the locale's names are
+        assert replace_english_names("Thu, 25 May 2017 07:14:15 +0000", '%a, %d %b %Y %H:%M:%S %z') == ("25 05 2017 07:14:15 +0000", '%d %m %Y %H:%M:%S %z')
+        assert replace_english_names("25/Dec/2017:07:14:15 +0000", '%d/%b/%Y:%H:%M:%S %z') == ("25/12/2017:07:14:15 +0000", '%d/%m/%Y:%H:%M:%S %z')
+        assert replace_english_names("oct 27 14:01:12", '%b %d %H:%M:%S') == ("10 27 14:01:12", '%m %d %H:%M:%S')
+
+    def test_english_names_not_found(self):
+        with pytest.raises(ValueError):
+            replace_english_names("Tue Oct 27 14:01:12", '%b %d %H:%M:%S')
+        with pytest.raises(ValueError):
+            replace_english_names("Okt 27 14:01:12", '%b %d %H:%M:%S')
+        with pytest.raises(ValueError):
+            replace_english_names("25 May 2017 07:14:15 +0000", '%a, %d %b %Y %H:%M:%S %z')
+
+    def test_detected_formats_bounded(self):
+        for num in range(DETECTED_FORMATS_MAX_SIZE + 5):
+            parseDate("2017-05-25 07:14:15", 'source' + str(num))
+        assert len(DETECTED_FORMATS) <= DETECTED_FORMATS_MAX_SIZE
+        assert DETECTED_FORMATS['source' + str(DETECTED_FORMATS_MAX_SIZE + 4)] is not None
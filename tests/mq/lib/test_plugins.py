@@ -0,0 +1,97 @@
+from mq.lib.plugins import PluginRouter, sendEventToPlugins
+
+
+class KeyPlugin(object):
+    def __init__(self):
+        self.registration = ['Apples']
+        self.priority = 5
+
+    def onMessage(self, message, metadata):
+        message['secretkey'] = 'somesecretvalue'
+        return message, metadata
+
+
+class ChainedPlugin(object):
+    def __init__(self):
+        self.registration = ['somesecretvalue']
+        self.priority = 10
+
+    def onMessage(self, message, metadata):
+        message['chained'] = True
+        return message, metadata
+
+
+class EarlyPlugin(object):
+    def __init__(self):
+        self.registration = ['somesecretvalue']
+        self.priority = 1
+
+    def onMessage(self, message, metadata):
+        message['early'] = True
+        return message, metadata
+
+
+class DropPlugin(object):
+    def __init__(self):
+        self.registration = ['dropme']
+        self.priority = 2
+
+    def onMessage(self, message, metadata):
+        return None, metadata
+
+
+def plugin_tuple(plugin_class):
+    plugin = plugin_class()
+    return (plugin, plugin.registration, plugin.priority)
+
+
+class TestPluginRouter(object):
+    def setup(self):
+        self.plugins = [
+            plugin_tuple(ChainedPlugin),
+            plugin_tuple(DropPlugin),
+            plugin_tuple(KeyPlugin),
+            plugin_tuple(EarlyPlugin),
+        ]
+        self.router = PluginRouter(self.plugins)
+        self.metadata = {'index': 'events', 'id': None}
+
+    def test_priority_order(self):
+        assert [plugin[2] for plugin in self.router] == [1, 2, 5, 10]
+
+    def test_token_index(self):
+        assert sorted(self.router.token_index.keys()) == ['apples', 'dropme', 'somesecretvalue']
+        assert self.router.token_index['somesecretvalue'] == [0, 3]
+
+    def test_matching_plugins(self):
+        assert self.router.matching_plugins({'apples': 'abc'}) == [2]
+        assert self.router.matching_plugins({'details': {'key': 'SomeSecretValue'}}) == [0, 3]
+        assert self.router.matching_plugins({'details': {'key': 'SomeSecretValue'}}, start=1) == [3]
+        assert self.router.matching_plugins({'nothing': 'here'}) == []
+
+    def test_send_matches_modified_event(self):
+        event = {'apples': 'sometext'}
+        result, metadata = sendEventToPlugins(event, self.metadata, self.router)
+        assert result['secretkey'] == 'somesecretvalue'
+        # matched on the value added by KeyPlugin
+        assert result['chained'] is True
+        # already passed in priority order by the time the value was added
+        assert 'early' not in result
+        assert len(result['plugins']) == 2
+        assert metadata == self.metadata
+
+    def test_send_with_plain_list(self):
+        event = {'apples': 'sometext'}
+        result, metadata = sendEventToPlugins(event, self.metadata, self.plugins)
+        assert result['chained'] is True
+        assert len(result['plugins']) == 2
+
+    def test_send_no_matches(self):
+        event = {'oranges': 'sometext'}
+        result, metadata = sendEventToPlugins(event, self.metadata, self.router)
+        assert result == {'oranges': 'sometext', 'plugins': []}
+
+    def test_send_drop(self):
+        event = {'apples': 'dropme'}
+        result, metadata = sendEventToPlugins(event, self.metadata, self.router)
+        assert result is None
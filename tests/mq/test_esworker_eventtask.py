@@ -8,6 +8,7 @@
 import pytz
 import tzlocal
 import datetime
+import mock
 import os
 import sys
 
@@ -25,6 +26,14 @@ class MockOptions():
         return 'sample'
 
 
+class MockBatchOptions(MockOptions):
+    batchmode = True
+    batchtimeout = 1
+    batchbackoff = 30
+    prefetch = 3
+    mqack = True
+
+
 class TestKeyMapping():
     def teardown(self):
         sys.path.remove(self.mq_path)
@@ -92,9 +101,167 @@ class TestKeyMapping():
         assert result['details']['message'] == 'somestring'
         assert result['details']['payload'] == 'examplepayload'
 
+    def test_nxlog_windows_allowed_details(self):
+        message = {
+            'Domain': 'EXAMPLE',
+            'SourceModuleType': 'im_msvistalog',
+            'EventID': 4624,
+            'TargetUserName': 'kirk',
+            'Message': 'An account was successfully logged on.',
+            'SomeOtherField': 'value',
+        }
+        result = self.key_mapping(message)
+        assert result['summary'] == 'An account was successfully logged on.'
+        assert result['details'] == {
+            'domain': 'EXAMPLE',
+            'sourcemoduletype': 'im_msvistalog',
+            'eventid': 4624,
+            'targetusername': 'kirk',
+        }
+
     def test_no_details(self):
         message = {
             'summary': 'example summary',
         }
         result = self.key_mapping(message)
         assert result['details'] == {}
+
+
+class TestBatchConsumer():
+    def teardown(self):
+        self.sleep_patcher.stop()
+        sys.path.remove(self.mq_path)
+
+    def setup(self):
+        if 'lib' in sys.modules:
+            del sys.modules['lib']
+        self.mq_path = os.path.join(os.path.dirname(__file__), "../../mq/")
+        sys.path.insert(0, self.mq_path)
+        from mq import esworker_eventtask
+        esworker_eventtask.options = MockBatchOptions()
+        esworker_eventtask.pluginList = []
+        self.es_connection = mock.Mock()
+        self.consumer = esworker_eventtask.taskConsumer(mock.Mock(), None, None, self.es_connection)
+        self.sleep_patcher = mock.patch('mq.esworker_eventtask.time.sleep')
+        self.sleep = self.sleep_patcher.start()
+
+    def send_messages(self, num_messages):
+        messages = []
+        for num in range(num_messages):
+            message = mock.Mock()
+            self.consumer.on_batch_message({'summary': 'example summary ' + str(num)}, message)
+            messages.append(message)
+        return messages
+
+    def test_partial_batch_is_held(self):
+        messages = self.send_messages(2)
+        assert len(self.consumer.batch) == 2
+        assert self.es_connection.save_events.call_count == 0
+        for message in messages:
+            assert message.ack.call_count == 0
+
+    def test_full_batch_bulk_ack(self):
+        self.es_connection.save_events.return_value = [(True, {'status': 201})] * 3
+        messages = self.send_messages(3)
+        assert self.es_connection.save_events.call_count == 1
+        events = self.es_connection.save_events.call_args[0][0]
+        assert [event['body']['summary'] for event in events] == ['example summary 0', 'example summary 1', 'example summary 2']
+        assert self.consumer.batch == []
+        assert messages[0].ack.call_count == 0
+        assert messages[1].ack.call_count == 0
+        messages[2].ack.assert_called_once_with(multiple=True)
+
+    def test_partial_failures(self):
+        self.es_connection.save_events.return_value = [
+            (True, {'status': 201}),
+            (False, {'status': 400, 'error': 'mapper_parsing_exception'}),
+            (False, {'status': 429, 'error': 'es_rejected_execution_exception'}),
+        ]
+        messages = self.send_messages(3)
+        messages[0].ack.assert_called_once_with(multiple=True)
+        messages[1].ack.assert_called_once_with()
+        assert messages[2].ack.call_count == 0
+        messages[2].requeue.assert_called_once_with()
+
+    def test_requeue_before_multiple_ack(self):
+        self.es_connection.save_events.return_value = [
+            (False, {'status': 429, 'error': 'es_rejected_execution_exception'}),
+            (True, {'status': 201}),
+            (True, {'status': 201}),
+        ]
+        channel = mock.Mock()
+        for num in range(3):
+            message = mock.Mock()
+            channel.attach_mock(message, 'message' + str(num))
+            self.consumer.on_batch_message({'summary': 'example summary ' + str(num)}, message)
+        assert [call[0] for call in channel.mock_calls] == ['message0.requeue', 'message2.ack']
+
+    def test_bulk_exception_requeues_batch(self):
+        self.es_connection.save_events.side_effect = Exception('connection refused')
+        with mock.patch('mq.esworker_eventtask.esConnect') as es_connect:
+            messages = self.send_messages(3)
+            assert es_connect.call_count == 1
+        for message in messages:
+            assert message.ack.call_count == 0
+            message.requeue.assert_called_once_with()
+
+    def test_reconnect_failure_keeps_consuming(self):
+        self.es_connection.save_events.side_effect = Exception('connection refused')
+        with mock.patch('mq.esworker_eventtask.esConnect') as es_connect:
+            es_connect.side_effect = Exception('ping failed')
+            messages = self.send_messages(3)
+            messages += self.send_messages(3)
+            assert es_connect.call_count == 2
+        assert self.consumer.esConnection is self.es_connection
+        assert self.consumer.batch == []
+        for message in messages:
+            assert message.ack.call_count == 0
+            message.requeue.assert_called_once_with()
+
+    def test_backoff_grows_while_es_is_down(self):
+        self.es_connection.save_events.side_effect = Exception('connection refused')
+        with mock.patch('mq.esworker_eventtask.esConnect') as es_connect:
+            es_connect.return_value = self.es_connection
+            for num in range(7):
+                self.send_messages(3)
+        assert [call[0][0] for call in self.sleep.call_args_list] == [1, 2, 4, 8, 16, 30, 30]
+
+    def test_backoff_resets_after_success(self):
+        self.es_connection.save_events.return_value = [(False, {'status': 429, 'error': 'es_rejected_execution_exception'})] * 3
+        self.send_messages(3)
+        self.send_messages(3)
+        assert self.consumer.backoff == 2
+        self.es_connection.save_events.return_value = [(True, {'status': 201})] * 3
+        self.send_messages(3)
+        assert self.consumer.backoff == 0
+        assert self.sleep.call_count == 2
+
+    def test_no_ack_does_not_requeue(self):
+        from mq import esworker_eventtask
+        esworker_eventtask.options.mqack = False
+        try:
+            self.es_connection.save_events.return_value = [
+                (True, {'status': 201}),
+                (False, {'status': 400, 'error': 'mapper_parsing_exception'}),
+                (False, {'status': 503, 'error': 'unavailable_shards_exception'}),
+            ]
+            messages = self.send_messages(3)
+            self.es_connection.save_events.side_effect = Exception('connection refused')
+            with mock.patch('mq.esworker_eventtask.esConnect'):
+                messages += self.send_messages(3)
+        finally:
+            esworker_eventtask.options.mqack = True
+        for message in messages:
+            assert message.ack.call_count == 0
+            assert message.requeue.call_count == 0
+        assert self.sleep.call_count == 2
+
+    def test_iteration_flushes_old_batch(self):
+        self.es_connection.save_events.return_value = [(True, {'status': 201})]
+        messages = self.send_messages(1)
+        self.consumer.on_iteration()
+        assert self.es_connection.save_events.call_count == 0
+        self.consumer.batchStarted -= 2
+        self.consumer.on_iteration()
+        assert self.es_connection.save_events.call_count == 1
+        messages[0].ack.assert_called_once_with(multiple=True)